@@ -3,6 +3,8 @@ from datetime import datetime, timezone, timedelta
 import logging
 import json
 
+from .. state import State
+
 logger = logging.getLogger("admin.referral")
 logger.setLevel(logging.INFO)
 
@@ -91,6 +93,16 @@ class Offer:
             "discount": self.discount.to_dict(),
         }
 
+    @staticmethod
+    def from_dict(d):
+        return Offer(
+            id=d["id"],
+            referrer=Referrer.from_dict(d["referrer"]),
+            join_up_credits=JoinUpCredits.from_dict(d["join-up-credits"]),
+            discount=Discount.from_dict(d["discount"]),
+            expiry_days=d["expiry"],
+        )
+
     # Take a package and allocate it, which basically just puts an expiry
     # date based on current time
     def allocate(self):
@@ -142,57 +154,133 @@ class Package:
             discount=Discount.from_dict(d["discount"])
         )
 
-class Referrals:
+# Offers as they were before they moved to the store.  Used until the
+# store has been read, and any code the store doesn't define is taken
+# from here.
+def builtin_offers():
 
-    def __init__(self):
+    return {
 
-        self.referrals = {
+        'LAUNCHPAD': Offer(
 
-            'LAUNCHPAD': Offer(
+            id="LAUNCHPAD",
 
-                id="LAUNCHPAD",
+            join_up_credits = JoinUpCredits(
+                vat=6, corptax=1, accounts=1,
+            ),
 
-                join_up_credits = JoinUpCredits(
-                    vat=6, corptax=1, accounts=1,
-                ),
+            discount = Discount(
+                vat=0.2, corptax=0.2, accounts=0.2,
+            ),
+
+            referrer = Referrer(
+                name='Accounts Machine beta',
+                id='20d07be0-1da0-41e8-ac15-6e950cec36c3'
+            ),
+
+            expiry_days=712,
+
+        ),
 
-                discount = Discount(
-                    vat=0.2, corptax=0.2, accounts=0.2,
-                ),
+        'STANDARD': Offer(
 
-                referrer = Referrer(
-                    name='Accounts Machine beta',
-                    id='20d07be0-1da0-41e8-ac15-6e950cec36c3'
-                ),
+            id="STANDARD",
 
-                expiry_days=712,
+            join_up_credits = JoinUpCredits(),
+            discount = Discount(),
 
+            referrer = Referrer(
+                name='Standard package',
+                id='7b6ef04a-03ee-41c2-89a2-df16c1221b2e'
             ),
 
-            'STANDARD': Offer(
+            expiry_days=712,
 
-                id="STANDARD",
+        )
 
-                join_up_credits = JoinUpCredits(),
-                discount = Discount(),
+    }
 
-                referrer = Referrer(
-                    name='Standard package',
-                    id='7b6ef04a-03ee-41c2-89a2-df16c1221b2e'
-                ),
+# Referral offers live in the 'referrals' collection, one document per
+# code in Offer.to_dict() form.  They're loaded into memory at startup and
+# a snapshot listener keeps the index current, so registration never reads
+# the store and a new campaign needs no deploy.  A document with
+# active: false withdraws the code, built-in or not.
+class Referrals:
 
-                expiry_days=712,
+    def __init__(self, store=None):
 
-            )
+        self.store = store
+        self.referrals = builtin_offers()
+        self.watch = None
 
-        }
+    async def start(self, app=None):
 
-    def get_offer(self, ref):
+        if self.store is None:
+            return
 
-        if ref in self.referrals:
-            return self.referrals[ref]
+        try:
+            await self.load()
+        except Exception as e:
+            logger.info("Referral load failed, using built-in: %s", e)
 
-        return None
+        try:
+            self.watch = self.store.docstore.listener().collection(
+                "referrals"
+            ).on_snapshot(self.on_snapshot)
+        except Exception as e:
+            logger.info("Referral listener not started: %s", e)
+
+    async def stop(self, app=None):
+        if self.watch:
+            self.watch.unsubscribe()
+            self.watch = None
+
+    async def load(self):
+
+        offers = {}
+
+        async for id, d in State(self.store).referral_offers().stream():
+            self.add(offers, id, d)
+
+        self.update(offers)
+
+    def on_snapshot(self, docs, changes, read_time):
+
+        offers = {}
+
+        for doc in docs:
+            self.add(offers, doc.id, doc.to_dict())
+
+        self.update(offers)
+
+    # A withdrawn offer is added as None.  One that isn't valid is left
+    # out, so a built-in offer with the code still applies.
+    def add(self, offers, id, d):
+
+        if not d.get("active", True):
+            offers[id] = None
+            return
+
+        try:
+            offers[id] = Offer.from_dict(d)
+        except Exception as e:
+            logger.info("Referral offer %s not valid: %s", id, e)
+
+    def update(self, offers):
+
+        # Store offers override built-in ones with the same code, and
+        # withdraw them if not active
+        offers = {**builtin_offers(), **offers}
+        offers = {k: v for k, v in offers.items() if v is not None}
+
+        # Replacing the whole dict is atomic, readers on the event loop
+        # see either the old index or the new one.
+        self.referrals = offers
+
+        logger.info("Referral offers: %s", ", ".join(sorted(offers)))
+
+    def get_offer(self, ref):
+        return self.referrals.get(ref)
 
     def get_package(self, ref):
 
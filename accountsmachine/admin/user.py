@@ -1,9 +1,11 @@
 
 from datetime import datetime, timezone
+import json
 import logging
 import uuid
 import time
 
+from aiohttp import web
 import firebase_admin
 import firebase_admin.auth
 
@@ -41,7 +43,7 @@ class RequestAuth:
     def verify_scope(self, scope):
         if scope not in self.scope:
             logger.info("Scope forbidden: %s", scope)
-            raise this.scope_invalid()
+            raise self.scope_invalid()
     def scope_invalid(self):
         return web.HTTPForbidden(
             text=json.dumps({
@@ -63,7 +65,7 @@ class UserAdmin:
 
         self.store = store
 
-        self.referrals = Referrals()
+        self.referrals = Referrals(store)
 
     async def delete_user(self, user, uid):
 
@@ -160,7 +162,7 @@ class UserAdmin:
             await user.put(profile)
 
             logger.info("Setting balance...")
-            await user.credits().put({
+            await user.balance().put({
                 "vat": pkg.join_up_credits.vat,
                 "corptax": pkg.join_up_credits.corptax,
                 "accounts": pkg.join_up_credits.accounts,
@@ -220,7 +222,7 @@ class UserAdmin:
 
             # Tidy up, back-track
             try:
-                await user.credits().delete()
+                await user.balance().delete()
             except Exception as f:
                 logger.info("Exception: %s", f)
 
@@ -13,10 +13,10 @@ logger = logging.getLogger("api.accounts")
 logger.setLevel(logging.DEBUG)
 
 class AccountsApi:
-    def __init__(self):
-        pass
+    def __init__(self, renderer):
+        self.renderer = renderer
 
-    async def background_submit(self, user, renderer, id, kind):
+    async def background_submit(self, user, renderer, id, kind, job=None):
 
         try:
 
@@ -50,7 +50,8 @@ class AccountsApi:
 
                 cfg = await user.filing(id).get()
                 cfg["state"] = "errored"
-                cfg = await user.filing(id).put(cfg)
+                await user.filing(id).put(cfg)
+                if job: job.filing_state("errored")
 
                 return
 
@@ -66,12 +67,14 @@ Filing complete."""
             cfg = await user.filing(id).get()
             cfg["state"] = "pending"
             cfg = await user.filing(id).put(cfg)
+            if job: job.filing_state("pending")
 
             await asyncio.sleep(5)
 
             cfg = await user.filing(id).get()
             cfg["state"] = "published"
             cfg = await user.filing(id).put(cfg)
+            if job: job.filing_state("published")
 
         except Exception as e:
 
@@ -92,12 +95,11 @@ Filing complete."""
             id = request.match_info['id']
             kind = "accounts"
 
-            asyncio.create_task(
-                self.background_submit(request["state"],
-                                       request["renderer"], id, kind)
+            job = await request["jobs"].submit(
+                kind, request["auth"].user, id
             )
 
-            return web.json_response()
+            return web.json_response({"job": job})
 
         except Exception as e:
 
@@ -106,6 +108,13 @@ Filing complete."""
                 body=str(e), content_type="text/plain"
             )
 
+    # Job queue handler
+    async def run_job(self, state, job):
+        await self.background_submit(
+            state.user(job.uid), self.renderer, job.filing, job.rec["kind"],
+            job
+        )
+
     async def authorize(self, request):
 
         request["auth"].verify_scope("accounts")
@@ -24,8 +24,17 @@ from . status import StatusApi
 from . corptax import CorptaxApi
 from . accounts import AccountsApi
 from . commerce import CommerceApi
+from . audit import AuditApi
+from . profile import ProfileApi
 from .. commerce.commerce import Commerce
 from .. commerce.crypto import Crypto
+from .. commerce.webhook import WebhookQueue
+from .. audit.writer import AuditWriter
+from .. jobs.queue import JobQueue
+from .. bus import EventBus
+from .. metrics import Metrics, LimiterCollector, GaugeCollector
+from .. import tracing
+from .. watchdog import LoopWatchdog
 
 logger = logging.getLogger("api")
 logger.setLevel(logging.DEBUG)
@@ -49,6 +58,9 @@ class DataPass:
         request["commerce"] = request.app["commerce"]
         request["crypto"] = request.app["crypto"]
         request["store"] = request.app["store"]
+        request["webhooks"] = request.app["webhooks"]
+        request["jobs"] = request.app["jobs"]
+        request["bus"] = request.app["bus"]
         return await handler(request)
 
 class Api:
@@ -57,33 +69,87 @@ class Api:
         self.config = json.loads(open(config_file).read())
         self.port = self.config["port"]
 
+        tracing.setup(self.config)
+
         self.firebase = Firebase(self.config)
 
         self.commerce = Commerce(self.config)
         self.crypto = Crypto(self.config)
 
         self.store = Store(self.config)
+
+        self.audit = AuditWriter(self.config, self.store)
+        self.store.audit = self.audit
+
+        self.webhooks = WebhookQueue(self.config, self.store)
+        self.webhooks.register("stripe", self.commerce.process_event)
+        self.webhooks.register("nowpayments", self.crypto.process_event)
+
         self.auth = AuthApi(self.config, self.store, self.firebase)
         self.books = BooksApi()
         self.company = CompanyApi()
         self.creg = CompanyRegisterApi(self.config)
-        self.filing = FilingApi()
+        self.filing = FilingApi(self.config)
         self.renderer = RendererApi(self.config)
-        self.accounts = AccountsApi()
-        self.corptax = CorptaxApi()
+        self.accounts = AccountsApi(self.renderer)
+        self.corptax = CorptaxApi(self.renderer)
         self.vat = VatApi(self.config, self.store)
+
+        # Filing progress events, for /filing/{id}/events
+        self.bus = EventBus()
+
+        self.jobs = JobQueue(self.config, self.store, self.bus)
+        self.jobs.register("vat", self.vat.run_job)
+        self.jobs.register("accounts", self.accounts.run_job)
+        self.jobs.register("corptax", self.corptax.run_job)
+
         self.status = StatusApi()
+        self.audit_api = AuditApi(self.config)
+        self.profile = ProfileApi(self.config)
+
+        self.metrics = Metrics(self.config)
+        self.metrics.register(LimiterCollector(self.vat.vat.limiter))
+        self.metrics.register(GaugeCollector(
+            "am_jobs", "Submission jobs", self.jobs.scheduler.metrics
+        ))
 
         self.dp = DataPass()
 
-        self.app = web.Application(middlewares=[self.auth.verify,
-                                                self.dp.add_data])
+        self.app = web.Application(middlewares=[tracing.middleware,
+                                                self.metrics.middleware,
+                                                self.auth.verify,
+                                                self.dp.add_data,
+                                                self.profile.middleware])
 
         self.app["store"] = self.store
         self.app["config"] = self.config
         self.app["renderer"] = self.renderer
         self.app["commerce"] = self.commerce
         self.app["crypto"] = self.crypto
+        self.app["webhooks"] = self.webhooks
+        self.app["jobs"] = self.jobs
+        self.app["bus"] = self.bus
+
+        self.watchdog = LoopWatchdog(self.config)
+        self.app.on_startup.append(self.watchdog.start)
+        self.app.on_cleanup.append(self.watchdog.stop)
+
+        self.app.on_startup.append(self.crypto.start)
+        self.app.on_cleanup.append(self.crypto.stop)
+        self.app.on_cleanup.append(self.commerce.stop)
+        self.app.on_startup.append(self.webhooks.start)
+        self.app.on_cleanup.append(self.webhooks.stop)
+        self.app.on_startup.append(self.auth.user_admin.referrals.start)
+        self.app.on_cleanup.append(self.auth.user_admin.referrals.stop)
+        self.app.on_startup.append(self.jobs.start)
+        self.app.on_cleanup.append(self.jobs.stop)
+
+        # Last, so audit records from the other shutdown steps are drained
+        self.app.on_startup.append(self.audit.start)
+        self.app.on_cleanup.append(self.audit.stop)
+        self.app.on_cleanup.append(tracing.shutdown)
+
+        self.app.add_routes([web.get("/metrics", self.metrics.get)])
 
         self.app.add_routes([web.post("/render-html/{id}",
                                       self.renderer.to_html)])
@@ -114,6 +180,11 @@ class Api:
                                      self.filing.get_status)])
         self.app.add_routes([web.post("/filing/{id}/move-draft",
                                       self.filing.move_draft)])
+        self.app.add_routes([web.get("/filing/{id}/log",
+                                     self.filing.get_log)])
+        self.app.add_routes([web.get("/filing/{id}/events",
+                                     self.filing.events)])
+        self.app.add_routes([web.get("/job/{id}", self.filing.get_job)])
 
         self.app.add_routes([web.post("/books/{id}/upload", self.books.upload)])
         self.app.add_routes([web.get("/books/{id}/info", self.books.get_info)])
@@ -167,6 +238,9 @@ class Api:
         self.app.add_routes([web.get("/status", self.status.get_all)])
         self.app.add_routes([web.get("/status/{id}", self.status.get)])
 
+        self.app.add_routes([web.get("/audit/export", self.audit_api.export)])
+        self.app.add_routes([web.post("/admin/profile", self.profile.profile)])
+
         self.app.add_routes([web.get("/company-reg/{id}", self.creg.get)])
 
         self.app.add_routes([web.post("/user-account/delete",
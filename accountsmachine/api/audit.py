@@ -0,0 +1,60 @@
+
+from aiohttp import web
+import logging
+
+from .. audit.export import get_exporter, export, parse_time
+
+logger = logging.getLogger("api.audit")
+logger.setLevel(logging.DEBUG)
+
+class AuditApi():
+
+    def __init__(self, config):
+        self.chunk = config.get("audit-export-chunk", 1000)
+
+    # Streams audit records as an export file.  Query parameters: start and
+    # end (ISO times), type, uid, format (ndjson or parquet).
+    async def export(self, request):
+
+        request["auth"].verify_scope("admin")
+
+        try:
+
+            query = {
+                "type": request.query.get("type"),
+                "uid": request.query.get("uid"),
+            }
+
+            if "start" in request.query:
+                query["start"] = parse_time(request.query["start"])
+
+            if "end" in request.query:
+                query["end"] = parse_time(request.query["end"])
+
+            format = request.query.get("format", "ndjson")
+            exporter = get_exporter(format)
+
+        except Exception as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        logger.info("Audit export %s %s", format, query)
+
+        resp = web.StreamResponse(headers={
+            "Content-Type": exporter.content_type,
+            "Content-Disposition":
+            "attachment; filename=\"audit%s\"" % exporter.suffix,
+        })
+        await resp.prepare(request)
+
+        try:
+            async for data in export(request["store"], exporter,
+                                     chunk=self.chunk, **query):
+                await resp.write(data)
+        except Exception as e:
+            # Truncated output must not look complete
+            logger.error("Audit export: %s", e)
+            request.transport.close()
+            return resp
+
+        await resp.write_eof()
+        return resp
@@ -99,6 +99,10 @@ class AuthApi:
         if request.url.path.startswith("/commerce/callback"):
             return await handler(request)
 
+        # Has its own token, metrics-token, and is off without one
+        if request.url.path == "/metrics":
+            return await handler(request)
+
         request["auth"] = await self.verify_auth(request)
 
         return await handler(request)
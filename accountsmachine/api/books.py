@@ -7,6 +7,7 @@ import uuid
 
 from .. state import Books
 from .. date import to_isoformat
+from . import standard
 
 from ixbrl_reporter.accounts import get_class
 
@@ -144,13 +145,14 @@ class BooksApi:
         request["auth"].verify_scope("books")
         user = request["state"]
 
-        try:
-            data = await Books.get_all_info(user)
-
-            for k in data.keys():
-                data[k]["time"] = to_isoformat(data[k]["time"])
+        def transform(info):
+            info["time"] = to_isoformat(info["time"])
+            return info
 
-            return web.json_response(data)
+        try:
+            return await standard.stream_json(
+                request, Books.stream_all_info(user), transform
+            )
         except Exception as e:
             logger.debug(e)
             return web.HTTPInternalServerError(
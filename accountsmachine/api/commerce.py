@@ -6,7 +6,7 @@ import aiohttp
 import glob
 import logging
 import uuid
-from datetime import timezone
+from datetime import datetime, timezone
 import math
 import copy
 from collections import OrderedDict
@@ -14,6 +14,7 @@ from .. state import State
 
 from .. commerce.exceptions import InvalidOrder
 from .. date import to_isoformat
+from . import standard
 
 logger = logging.getLogger("api.commerce")
 logger.setLevel(logging.DEBUG)
@@ -98,23 +99,94 @@ class CommerceApi():
 
         return web.json_response()
 
+    # Paging/filter parameters from the query string, None if there are
+    # none, in which case the whole list is returned as before.
+    def get_transaction_query(self, request):
+
+        params = [
+            "limit", "cursor", "type", "status", "kind", "start", "end",
+            "fields"
+        ]
+
+        if not any(p in request.query for p in params):
+            return None
+
+        def parse_time(t):
+            t = datetime.fromisoformat(t)
+            if t.tzinfo is None:
+                t = t.replace(tzinfo=timezone.utc)
+            return t
+
+        query = {
+            "limit": standard.get_limit(request),
+            "cursor": request.query.get("cursor"),
+            "type": request.query.get("type"),
+            "status": request.query.get("status"),
+            "kind": request.query.get("kind"),
+        }
+
+        if "start" in request.query:
+            query["start"] = parse_time(request.query["start"])
+
+        if "end" in request.query:
+            query["end"] = parse_time(request.query["end"])
+
+        if "fields" in request.query:
+            query["fields"] = request.query["fields"].split(",")
+
+        return query
+
     async def get_transactions(self, request):
 
         request["auth"].verify_scope("filing-config")
 
         try:
-            ss = await request["commerce"].get_transactions(request["state"])
+            query = self.get_transaction_query(request)
+        except Exception as e:
+            raise web.HTTPBadRequest(text=str(e))
 
-            for k in ss.keys():
-                ss[k]["time"] = to_isoformat(ss[k]["time"])
+        if query is not None:
+            return await self.get_transaction_page(request, query)
+
+        def transform(tx):
+            tx["time"] = to_isoformat(tx["time"])
+            return tx
 
-            return web.json_response(ss)
+        try:
+            return await standard.stream_json(
+                request,
+                request["commerce"].stream_transactions(request["state"]),
+                transform
+            )
         except Exception as e:
             logger.debug("get_all: %s", e)
             return web.HTTPInternalServerError(
                 body=str(e), content_type="text/plain"
             )
 
+    async def get_transaction_page(self, request, query):
+
+        try:
+            ss, next = await request["commerce"].get_transaction_page(
+                request["state"], **query
+            )
+        except KeyError:
+            raise web.HTTPBadRequest(text="Invalid cursor")
+        except Exception as e:
+            logger.debug("get_transaction_page: %s", e)
+            return web.HTTPInternalServerError(
+                body=str(e), content_type="text/plain"
+            )
+
+        for k in ss.keys():
+            if "time" in ss[k]:
+                ss[k]["time"] = to_isoformat(ss[k]["time"])
+
+        return web.json_response({
+            "transactions": ss,
+            "cursor": next,
+        })
+
     async def get_transaction(self, request):
 
         request["auth"].verify_scope("filing-config")
@@ -147,9 +219,15 @@ class CommerceApi():
 
         req = await request.read()
 
-        await request["commerce"].callback(
-            State(request["store"]), req, sig
-        )
+        try:
+            event = request["commerce"].verify_event(req, sig)
+        except RuntimeError as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        logger.info("Webhook: %s %s", event["id"], event["type"])
+
+        # Acknowledged once it's durably queued, processed in the background
+        await request["webhooks"].ingest("stripe", event["id"], event)
 
         return web.json_response({"success": True})
 
@@ -243,10 +321,10 @@ class CommerceApi():
             logger.error("should-be %s", should_be)
             raise web.HTTPUnauthorized()
 
-        await request["crypto"].callback(
-            State(request["store"]).user(uid),
-            req
-        )
+        # IPNs carry no event ID, but a payment only reaches each status once
+        id = str(req["payment_id"]) + ":" + req["payment_status"]
+
+        await request["webhooks"].ingest("nowpayments", id, req, uid=uid)
 
         return web.json_response()
 
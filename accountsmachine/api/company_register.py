@@ -1,13 +1,23 @@
 
 import json
 from aiohttp import web, ClientSession
+import asyncio
 import glob
 import logging
 import base64
+import time
+
+from .. cache import TtlCache
+from .. metrics import dependency
 
 logger = logging.getLogger("api.company-register")
 logger.setLevel(logging.INFO)
 
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__("Companies House rate limit reached")
+
 class CompanyRegisterApi():
 
     def __init__(self, config):
@@ -22,60 +32,112 @@ class CompanyRegisterApi():
             (key + ":").encode("utf-8")
         ).decode("utf-8")
 
-    async def get(self, request):
+        # Company profiles and officers change rarely, an hour is fine.
+        self.cache = TtlCache(
+            size=config.get("companies-cache-size", 1000),
+            ttl=config.get("companies-cache-ttl", 3600),
+        )
 
-        request["auth"].verify_scope("ch-lookup")
+        # Epoch time until which Companies House has told us to back off.
+        self.blocked_until = 0
 
-        user = request["auth"].user
+    # Companies House reports its window in X-Ratelimit-* headers.  When
+    # the remaining allowance hits zero, stop calling until the reset time.
+    def update_rate_limit(self, resp):
 
         try:
+            remain = int(resp.headers["X-Ratelimit-Remain"])
+            reset = int(resp.headers["X-Ratelimit-Reset"])
+        except:
+            remain, reset = None, None
 
-            id = request.match_info['id']
+        if resp.status == 429 or remain == 0:
+            if reset is None:
+                reset = int(time.time()) + 60
+            self.blocked_until = max(self.blocked_until, reset)
+            logger.info("Companies House rate limit reached, until %d", reset)
 
-            logger.info("Lookup %s", id)
+    async def fetch(self, session, path, operation):
 
-            if ".." in id:
-                raise RuntimeError("Invalid id")
+        headers = {
+            "Authorization": "Basic " + self.auth
+        }
 
-            async with ClientSession() as session:
+        with dependency("companies-house", operation):
 
-                url = "https://api.company-information.service.gov.uk/"
+            async with session.post(self.url + path, headers=headers) as resp:
 
-                headers = {
-                    "Authorization": "Basic " + self.auth
-                }
+                self.update_rate_limit(resp)
 
-                async with session.post(
-                        self.url + "/company/" + id,
-                        headers=headers
-                ) as resp:
+                if resp.status == 429:
+                    raise RateLimited(self.blocked_until - time.time())
 
-                    if resp.status != 200:
-                        raise RuntimeError("Company lookup failed")
+                if resp.status != 200:
+                    raise RuntimeError("Company lookup failed")
 
-                    ci = await resp.json()
+                return await resp.json()
 
-                async with session.post(
-                        self.url + "/company/" + id + "/officers",
-                        headers=headers
-                ) as resp:
+    async def lookup(self, id):
 
-                    if resp.status != 200:
-                        raise RuntimeError("Company lookup failed")
+        try:
+            return self.cache.get(id)
+        except KeyError:
+            pass
+
+        if time.time() < self.blocked_until:
+
+            # Better an old answer than none while we're rate-limited
+            try:
+                return self.cache.get_stale(id)
+            except KeyError:
+                raise RateLimited(self.blocked_until - time.time())
 
-                    oi = await resp.json()
+        async with ClientSession() as session:
+
+            ci, oi = await asyncio.gather(
+                self.fetch(session, "/company/" + id, "profile"),
+                self.fetch(session, "/company/" + id + "/officers",
+                           "officers"),
+            )
 
-                logger.debug(ci)
-                logger.debug(oi)
+        logger.debug(ci)
+        logger.debug(oi)
 
-            return web.json_response({
-                "company": ci,
-                "officers": oi,
-            })
+        res = {
+            "company": ci,
+            "officers": oi,
+        }
+
+        self.cache.put(id, res)
+
+        return res
+
+    async def get(self, request):
+
+        request["auth"].verify_scope("ch-lookup")
+
+        user = request["auth"].user
+
+        try:
+
+            id = request.match_info['id']
+
+            logger.info("Lookup %s", id)
+
+            if ".." in id:
+                raise RuntimeError("Invalid id")
+
+            return web.json_response(await self.lookup(id))
+
+        except RateLimited as e:
+            logger.debug("Exception: %s", e)
+            return web.HTTPServiceUnavailable(
+                body=str(e), content_type="text/plain",
+                headers={"Retry-After": str(max(int(e.retry_after), 1))}
+            )
 
         except Exception as e:
             logger.debug("Exception: %s", e)
             return web.HTTPInternalServerError(
                 body=str(e), content_type="text/plain"
             )
-
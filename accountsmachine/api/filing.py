@@ -1,10 +1,13 @@
 
 import json
+import time
+import asyncio
 from aiohttp import web
 import glob
 import logging
 
 from .. state import Filing
+from .. date import to_isoformat
 from . import standard
 
 logger = logging.getLogger("api.filing")
@@ -12,8 +15,9 @@ logger.setLevel(logging.DEBUG)
 
 class FilingApi():
 
-    def __init__(self):
-        pass
+    def __init__(self, config):
+        self.keepalive = config.get("filing-events-keepalive", 15)
+        self.max_duration = config.get("filing-events-max-duration", 900)
 
     async def get_all(self, request):
         h = standard.get_all(self, "filing-config", Filing)
@@ -126,6 +130,136 @@ class FilingApi():
 
         return web.json_response(data)
 
+    # Submission log entries from ?offset= on.  Returns the entries and the
+    # offset to pass next time, so a client following the log only gets
+    # what's new.
+    async def get_log(self, request):
+
+        request["auth"].verify_scope("filing-config")
+        user = request["auth"].user
+        id = request.match_info['id']
+
+        try:
+            offset = int(request.query.get("offset", 0))
+            limit = min(int(request.query.get("limit", 500)), 1000)
+        except Exception as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        f = Filing(request["state"], id)
+
+        entries, offset = await f.get_log(offset, limit)
+
+        for ent in entries:
+            ent["time"] = to_isoformat(ent["time"])
+
+        return web.json_response({
+            "entries": entries,
+            "offset": offset,
+        })
+
+    # Progress of a background submission job
+    async def get_job(self, request):
+
+        request["auth"].verify_scope("filing-config")
+        user = request["auth"].user
+        id = request.match_info['id']
+
+        try:
+            job = await request["jobs"].get(id)
+        except KeyError:
+            return web.HTTPNotFound()
+
+        if job["uid"] != user:
+            return web.HTTPNotFound()
+
+        progress = dict(job["progress"])
+        progress["time"] = to_isoformat(progress["time"])
+
+        return web.json_response({
+            "id": id,
+            "kind": job["kind"],
+            "filing": job["filing"],
+            "state": job["state"],
+            "attempts": job["attempts"],
+            "created": to_isoformat(job["created"]),
+            "progress": progress,
+            "error": job.get("error"),
+        })
+
+    # A filing doesn't leave these states, so the event stream ends there
+    final_states = ("published", "errored")
+
+    # Server-sent events for a filing: state changes, job progress and
+    # submission log lines, from the event bus.  The bus only carries events
+    # from this instance, so while idle the filing state is re-read and sent
+    # if it has changed, which covers jobs running elsewhere.  The stream
+    # closes once the final state has been sent.
+    async def events(self, request):
+
+        request["auth"].verify_scope("filing-config")
+        user = request["auth"].user
+        id = request.match_info['id']
+
+        filing = request["state"].filing(id)
+
+        try:
+            last = (await filing.get()).get("state")
+        except KeyError:
+            return web.HTTPNotFound()
+
+        resp = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        })
+        await resp.prepare(request)
+
+        async def send(event):
+            data = "event: %s\ndata: %s\n\n" % (
+                event["type"], json.dumps(event)
+            )
+            await resp.write(data.encode("utf-8"))
+
+        sub = request["bus"].subscribe((user, id))
+        end = time.monotonic() + self.max_duration
+
+        try:
+
+            await send({"type": "state", "state": last})
+
+            while last not in self.final_states and \
+                  time.monotonic() < end:
+
+                try:
+                    event = await asyncio.wait_for(sub.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    event = None
+
+                if event:
+                    if event["type"] == "state":
+                        last = event["state"]
+                    await send(event)
+                    continue
+
+                state = (await filing.get()).get("state")
+
+                if state != last:
+                    last = state
+                    await send({"type": "state", "state": state})
+                else:
+                    await resp.write(b": keepalive\n\n")
+
+        except ConnectionResetError:
+            # Client went away
+            pass
+        except Exception as e:
+            logger.info("Filing events: %s", e)
+
+        finally:
+            sub.close()
+
+        return resp
+
     async def move_draft(self, request):
 
         request["auth"].verify_scope("filing-config")
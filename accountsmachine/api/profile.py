@@ -0,0 +1,121 @@
+
+import asyncio
+import threading
+import logging
+from aiohttp import web
+
+from .. profiler import Sampler
+
+logger = logging.getLogger("api.profile")
+logger.setLevel(logging.DEBUG)
+
+# On-demand profiling of a live instance, admin scope only.
+#
+#     POST /admin/profile?seconds=10
+#         samples the event loop thread for 10 seconds
+#     POST /admin/profile?route=/vat/calculate/{id}
+#         samples while the next request for that route template runs
+#
+# Optional: interval (seconds between samples), threads=all to sample
+# every thread rather than just the event loop, wait (seconds to wait for
+# a route match).  Returns folded stacks, text/plain.
+#
+# A request profile covers everything the loop did while the request was
+# in flight, so other requests' work is in there too.  Profile a quiet
+# instance for a clean picture.
+class ProfileApi:
+
+    def __init__(self, config):
+
+        self.max_seconds = config.get("profile-max-seconds", 60)
+
+        # One profile at a time
+        self.busy = False
+
+        # route template -> (future, sampler)
+        self.armed = {}
+
+    def get_sampler(self, request):
+
+        interval = float(request.query.get("interval", 0.005))
+        interval = max(interval, 0.001)
+
+        if request.query.get("threads") == "all":
+            threads = None
+        else:
+            threads = set([threading.get_ident()])
+
+        return Sampler(interval, threads)
+
+    async def profile(self, request):
+
+        request["auth"].verify_scope("admin")
+
+        try:
+            sampler = self.get_sampler(request)
+            seconds = float(request.query.get("seconds", 10))
+            wait = float(request.query.get("wait", self.max_seconds))
+            route = request.query.get("route")
+        except Exception as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        if self.busy:
+            return web.HTTPConflict(text="A profile is already running")
+
+        self.busy = True
+
+        try:
+
+            if route:
+                logger.info("Profiling next request for %s", route)
+                fut = asyncio.get_running_loop().create_future()
+                self.armed[route] = (fut, sampler)
+                try:
+                    await asyncio.wait_for(
+                        fut, min(wait, self.max_seconds)
+                    )
+                except asyncio.TimeoutError:
+                    return web.HTTPRequestTimeout(
+                        text="No request for %s arrived" % route
+                    )
+                finally:
+                    self.armed.pop(route, None)
+            else:
+                seconds = min(seconds, self.max_seconds)
+                logger.info("Profiling for %.1fs", seconds)
+                sampler.start()
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    sampler.stop()
+
+        finally:
+            self.busy = False
+
+        logger.info("Profile done, %d samples", sampler.samples)
+
+        return web.Response(text=sampler.folded(), content_type="text/plain")
+
+    @web.middleware
+    async def middleware(self, request, handler):
+
+        if not self.armed:
+            return await handler(request)
+
+        route = request.match_info.route
+        if route.resource is None:
+            return await handler(request)
+
+        armed = self.armed.pop(route.resource.canonical, None)
+        if armed is None:
+            return await handler(request)
+
+        fut, sampler = armed
+
+        sampler.start()
+        try:
+            return await handler(request)
+        finally:
+            sampler.stop()
+            if not fut.done():
+                fut.set_result(None)
@@ -17,6 +17,7 @@ from ixbrl_reporter.taxonomy import Taxonomy
 
 from .. ixbrl_process import IxbrlProcess
 from .. state.books import Books
+from .. tracing import span
 
 logger = logging.getLogger("api.render")
 logger.setLevel(logging.INFO)
@@ -149,11 +150,19 @@ class RendererApi:
 
     def render_accounts_html(self, kind, config):
 
-        obj = self.process_jsonnet(kind, config)
-        return self.process_to_html(obj)
+        with span("render.jsonnet", kind=kind):
+            obj = self.process_jsonnet(kind, config)
+
+        with span("render.ixbrl", kind=kind):
+            return self.process_to_html(obj)
 
     async def render(self, user, renderer, id, kind):
 
+        with span("render", kind=kind):
+            return await self.render_filing(user, renderer, id, kind)
+
+    async def render_filing(self, user, renderer, id, kind):
+
         try:
 
             cfg = await user.filing(id).get()
@@ -194,7 +203,10 @@ class RendererApi:
 
             logger.info("Accounting books kind is %s", info["kind"])
 
-            with await books.create_temp_file(tmp_file) as f:
+            with span("render.books"):
+                books_file = await books.create_temp_file(tmp_file)
+
+            with books_file as f:
                 cfg["report"]["structure"]["accounts_file"] = tmp_file
                 cfg["report"]["structure"]["accounts_kind"] = bkind
                 cfg["report"]["logo"] = logo
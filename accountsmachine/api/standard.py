@@ -2,14 +2,157 @@
 # A load of boiler-plate web handlers
 
 from aiohttp import web
+import json
+import logging
+
+logger = logging.getLogger("api.standard")
+logger.setLevel(logging.DEBUG)
+
+# Flush to the client whenever this much output has built up
+STREAM_CHUNK = 16384
+
+# Streams (id, value) pairs from an async iterator as a JSON object, the
+# same shape json_response would produce from a dict, without holding the
+# whole collection or its serialisation in memory.  Clients sending
+# 'Accept: application/x-ndjson' get one {"id": ..., "value": ...} per line
+# instead.  transform, if given, is applied to each value.
+#
+# The first item is fetched before the response starts, so an early
+# failure still becomes an error status.  A failure part-way through
+# closes the connection.
+async def stream_json(request, items, transform=None):
+
+    ndjson = "application/x-ndjson" in request.headers.get("Accept", "")
+
+    it = items.__aiter__()
+
+    try:
+        first = await it.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    if ndjson:
+        ctype = "application/x-ndjson"
+    else:
+        ctype = "application/json"
+
+    resp = web.StreamResponse(headers={"Content-Type": ctype})
+    await resp.prepare(request)
+
+    buf = []
+    size = 0
+    count = 0
+
+    if not ndjson:
+        buf.append("{")
+
+    async def emit(id, value):
+
+        nonlocal size, count
+
+        if transform:
+            value = transform(value)
+
+        if ndjson:
+            s = json.dumps({"id": id, "value": value}) + "\n"
+        else:
+            s = json.dumps(id) + ":" + json.dumps(value)
+            if count > 0:
+                s = "," + s
+
+        buf.append(s)
+        size += len(s)
+        count += 1
+
+        if size >= STREAM_CHUNK:
+            await resp.write("".join(buf).encode("utf-8"))
+            buf.clear()
+            size = 0
+
+    try:
+
+        if first is not None:
+            await emit(*first)
+
+            async for id, value in it:
+                await emit(id, value)
+
+    except Exception as e:
+        # Headers are gone, so drop the connection rather than end the
+        # body cleanly and have the client take partial output as complete.
+        logger.error("stream_json: %s", e)
+        if request.transport:
+            request.transport.close()
+        return resp
+
+    if not ndjson:
+        buf.append("}")
+
+    await resp.write("".join(buf).encode("utf-8"))
+    await resp.write_eof()
+
+    return resp
+
+# Largest page a client can ask for
+MAX_PAGE = 200
+
+# Page size from the query string.  Raises ValueError unless it's a
+# number from 1 to MAX_PAGE.
+def get_limit(request, default=50):
+
+    try:
+        limit = int(request.query.get("limit", default))
+    except ValueError:
+        raise ValueError("limit must be a number")
+
+    if limit < 1 or limit > MAX_PAGE:
+        raise ValueError("limit must be from 1 to %d" % MAX_PAGE)
+
+    return limit
+
+# Paging parameters, None if there are none, in which case the whole
+# collection is returned as a dict.
+def get_page_query(request):
+
+    if not any(p in request.query for p in ["limit", "cursor", "fields"]):
+        return None
+
+    query = {
+        "limit": get_limit(request),
+        "cursor": request.query.get("cursor"),
+    }
+
+    if "fields" in request.query:
+        query["fields"] = request.query["fields"].split(",")
+
+    return query
 
 def get_all(self, scope, cls):
     async def handler(self, request):
         request["auth"].verify_scope(scope)
 
         try:
-            i = await cls.get_all(request["state"])
-            return web.json_response(i)
+            query = get_page_query(request)
+        except Exception as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        if query is not None:
+            try:
+                items, next = await cls.get_page(request["state"], **query)
+            except KeyError:
+                raise web.HTTPBadRequest(text="Invalid cursor")
+            except Exception as e:
+                logger.debug("get_all: %s", e)
+                return web.HTTPInternalServerError(
+                    body=str(e), content_type="text/plain"
+                )
+            return web.json_response({
+                "items": items,
+                "cursor": next,
+            })
+
+        try:
+            return await stream_json(request, cls.stream(request["state"]))
         except Exception as e:
             return web.HTTPInternalServerError(
                 body=str(e), content_type="text/plain"
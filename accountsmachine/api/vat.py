@@ -172,12 +172,21 @@ class VatApi():
         id = request.match_info['id']
         config = self.get_vat_client_config(request)
 
-        await self.vat.submit(
-                user, request["auth"].email, config, request["state"],
-                self.renderer, id
-        )
+        try:
+            job = await self.vat.submit(
+                    user, request["auth"].email, config, request["state"],
+                    self.renderer, id, request["jobs"]
+            )
+        except AuthNotConfigured as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        return web.json_response({"job": job})
 
-        return web.json_response()
+    # Job queue handler
+    async def run_job(self, state, job):
+        await self.vat.run_submission(
+            state.user(job.uid), self.renderer, job
+        )
 
     def get_vat_client_config(self, request):
 
@@ -34,8 +34,16 @@ class Audit:
 
         return rec
 
+    # Queued on the store's AuditWriter when it's running, otherwise
+    # written directly.
     @staticmethod
     async def write(store, rec, id=None):
         if id == None: id = str(uuid.uuid4())
+
+        writer = getattr(store, "audit", None)
+        if writer and writer.running:
+            writer.put(id, rec)
+            return
+
         await State(store).log(id).put(rec)
 
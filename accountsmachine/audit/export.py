@@ -0,0 +1,158 @@
+
+import io
+import json
+import zlib
+import logging
+from datetime import datetime, timezone
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from .. state import State
+
+logger = logging.getLogger("audit.export")
+logger.setLevel(logging.INFO)
+
+# Audit log export.  Records are read from the log collection a chunk at a
+# time (Logs.scan) and each chunk is encoded and handed on as bytes, so
+# neither the API nor the CLI holds more than one chunk in memory.
+#
+# An exporter takes chunks of (id, record) and returns the bytes to write:
+#
+#     exp = get_exporter("ndjson")
+#     out.write(exp.write(chunk))
+#     ...
+#     out.write(exp.close())
+
+def parse_time(t):
+    t = datetime.fromisoformat(t)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+    return t
+
+def to_json(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError("Not serialisable: %s" % type(obj).__name__)
+
+# gzip-compressed newline-delimited JSON, one {id, record} per line
+class NdjsonExporter:
+
+    content_type = "application/gzip"
+    suffix = ".ndjson.gz"
+
+    def __init__(self):
+        # wbits=31 gives a gzip header and trailer
+        self.comp = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def write(self, chunk):
+        data = "".join(
+            json.dumps({"id": id, "record": rec}, default=to_json) + "\n"
+            for id, rec in chunk
+        )
+        return self.comp.compress(data.encode("utf-8"))
+
+    def close(self):
+        return self.comp.flush()
+
+# Collects what pyarrow writes so it can be handed on chunk by chunk.
+# Parquet is written front to back, the footer goes at the end.
+class Sink(io.RawIOBase):
+
+    def __init__(self):
+        self.bufs = []
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.bufs.append(bytes(b))
+        self.pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.pos
+
+    def take(self):
+        data = b"".join(self.bufs)
+        self.bufs = []
+        return data
+
+# Parquet, one row group per chunk.  Audit records differ in shape by type,
+# so the common fields are columns and the whole record is kept as JSON.
+class ParquetExporter:
+
+    content_type = "application/vnd.apache.parquet"
+    suffix = ".parquet"
+
+    def __init__(self):
+
+        if pyarrow is None:
+            raise RuntimeError("Parquet export needs pyarrow installed")
+
+        self.schema = pyarrow.schema([
+            ("id", pyarrow.string()),
+            ("time", pyarrow.timestamp("us", tz="UTC")),
+            ("type", pyarrow.string()),
+            ("uid", pyarrow.string()),
+            ("email", pyarrow.string()),
+            ("ref", pyarrow.string()),
+            ("record", pyarrow.string()),
+        ])
+
+        self.sink = Sink()
+        self.writer = pyarrow.parquet.ParquetWriter(
+            self.sink, self.schema, compression="zstd"
+        )
+
+    def write(self, chunk):
+
+        cols = {
+            "id": [id for id, rec in chunk],
+            "time": [rec.get("time") for id, rec in chunk],
+            "type": [rec.get("type") for id, rec in chunk],
+            "uid": [rec.get("uid") for id, rec in chunk],
+            "email": [rec.get("email") for id, rec in chunk],
+            "ref": [rec.get("ref") for id, rec in chunk],
+            "record": [
+                json.dumps(rec, default=to_json) for id, rec in chunk
+            ],
+        }
+
+        table = pyarrow.Table.from_pydict(cols, schema=self.schema)
+        self.writer.write_table(table)
+
+        return self.sink.take()
+
+    def close(self):
+        self.writer.close()
+        return self.sink.take()
+
+exporters = {
+    "ndjson": NdjsonExporter,
+    "parquet": ParquetExporter,
+}
+
+def get_exporter(format):
+    if format not in exporters:
+        raise RuntimeError("Unknown export format: %s" % format)
+    return exporters[format]()
+
+# Yields encoded output for the matching records
+async def export(store, exporter, chunk=1000, **query):
+
+    count = 0
+
+    async for recs in State(store).logs().scan(chunk=chunk, **query):
+        count += len(recs)
+        data = exporter.write(recs)
+        if data:
+            yield data
+
+    yield exporter.close()
+
+    logger.info("Exported %d audit records", count)
@@ -0,0 +1,172 @@
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime
+
+from .. state import State
+
+logger = logging.getLogger("audit.writer")
+logger.setLevel(logging.INFO)
+
+# Firestore's limit on writes in one batch
+MAX_BATCH = 500
+
+# Batched audit log writer.  Audit.write() queues the record and returns,
+# and a background task commits the queue in WriteBatches of up to
+# batch_size records, at least every interval seconds.  On shutdown the
+# queue is drained.  Records which can't be committed are appended to a
+# local spool file, and replayed after the next successful commit.
+#
+# The queue is keyed by log ID: transaction records are rewritten under the
+# same ID as the transaction moves on, and only the latest needs writing.
+class AuditWriter:
+
+    def __init__(self, config, store):
+
+        self.store = store
+
+        self.batch_size = min(config.get("audit-batch-size", 100), MAX_BATCH)
+        self.interval = config.get("audit-flush-interval", 1.0)
+        self.spool = config.get("audit-spool", "audit-spool.ndjson")
+
+        self.pending = OrderedDict()
+        self.wake = asyncio.Event()
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None
+
+    async def start(self, app=None):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self, app=None):
+
+        # Wait for the cancel to land, so a batch the task was committing
+        # is back in the queue before the final flush
+        if self.task:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+
+        await self.flush()
+
+    def put(self, id, rec):
+
+        self.pending[id] = rec
+        self.pending.move_to_end(id)
+
+        if len(self.pending) >= self.batch_size:
+            self.wake.set()
+
+    async def run(self):
+
+        while True:
+
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self.wake.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Audit flush: %s", e)
+
+    async def flush(self):
+
+        # Idle: a good time to retry anything spooled earlier, including by
+        # a previous run
+        if not self.pending and os.path.exists(self.spool):
+            await self.replay()
+            return
+
+        committed = False
+
+        while self.pending:
+
+            recs = []
+            while self.pending and len(recs) < self.batch_size:
+                recs.append(self.pending.popitem(last=False))
+
+            try:
+                await self.commit(recs)
+                committed = True
+            except asyncio.CancelledError:
+                # Back on the queue for stop() to drain
+                for id, rec in reversed(recs):
+                    if id not in self.pending:
+                        self.pending[id] = rec
+                        self.pending.move_to_end(id, last=False)
+                raise
+            except Exception as e:
+                logger.error("Audit commit failed, spooling %d: %s",
+                             len(recs), e)
+                self.write_spool(recs)
+                return
+
+        if committed and os.path.exists(self.spool):
+            await self.replay()
+
+    async def commit(self, recs):
+
+        state = State(self.store)
+        batch = self.store.docstore.db.batch()
+
+        for id, rec in recs:
+            batch.set(state.log(id).doc, rec)
+
+        await batch.commit()
+
+    def write_spool(self, recs):
+        with open(self.spool, "a") as f:
+            for id, rec in recs:
+                f.write(json.dumps({"id": id, "record": rec},
+                                   default=encode) + "\n")
+
+    # Moves the spool back into the queue.  Anything queued since is newer,
+    # so it isn't overwritten.  If the commit fails the records go back to
+    # the spool.
+    async def replay(self):
+
+        try:
+            with open(self.spool) as f:
+                lines = f.readlines()
+            os.remove(self.spool)
+        except Exception as e:
+            logger.error("Audit spool read: %s", e)
+            return
+
+        recs = OrderedDict()
+
+        for line in lines:
+            try:
+                ent = json.loads(line, object_hook=decode)
+                recs[ent["id"]] = ent["record"]
+            except Exception as e:
+                logger.error("Audit spool record dropped: %s", e)
+
+        logger.info("Replaying %d spooled audit records", len(recs))
+
+        for id, rec in recs.items():
+            if id not in self.pending:
+                self.pending[id] = rec
+
+        await self.flush()
+
+def encode(obj):
+    if isinstance(obj, datetime):
+        return {"$time": obj.isoformat()}
+    raise TypeError("Not serialisable: %s" % type(obj).__name__)
+
+def decode(obj):
+    if len(obj) == 1 and "$time" in obj:
+        return datetime.fromisoformat(obj["$time"])
+    return obj
@@ -0,0 +1,361 @@
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import random
+import time
+import uuid
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+
+from aiohttp import web
+
+logger = logging.getLogger("bench.fakes")
+logger.setLevel(logging.INFO)
+
+# Response times of the real services, roughly, in seconds.  Each call
+# waits a random time up to twice this, so the mean is about right.
+LATENCY = {
+    "auth": 0.02,
+    "hmrc": 0.15,
+    "stripe": 0.25,
+    "nowpayments": 0.2,
+    "companies-house": 0.1,
+}
+
+# The VAT periods the fake HMRC has open, quarters of last year
+def obligations():
+
+    year = date.today().year - 1
+    obls = []
+
+    for q, month in enumerate([1, 4, 7, 10]):
+
+        start = date(year, month, 1)
+        if month == 10:
+            end = date(year, 12, 31)
+        else:
+            end = date(year, month + 3, 1) - timedelta(days=1)
+        due = end + timedelta(days=38)
+
+        obls.append({
+            "periodKey": "%02dA%d" % (year % 100, q + 1),
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "due": due.isoformat(),
+            "status": "O",
+        })
+
+    return obls
+
+# Stand-ins for the services the API talks to, on one port:
+#
+#     /identitytoolkit.googleapis.com/   Firebase Auth, in emulator mode
+#     /hmrc/                             HMRC MTD VAT and its OAuth
+#     /stripe/                           Stripe payment intents
+#     /nowpayments/                      NOWPayments
+#     /companies/                        Companies House
+#
+# They answer with just enough for the API's happy paths.  Payment
+# providers' webhooks are sent by the scenarios, see stripe_event and
+# nowpayments_ipn.
+class FakeServices:
+
+    def __init__(self, port, latency=None):
+
+        self.port = port
+        self.latency = dict(LATENCY)
+        self.latency.update(latency or {})
+
+        self.calls = Counter()
+
+        # Registered user IDs by email, registration doesn't return them
+        self.users = {}
+
+        # Stripe payment intents by ID
+        self.intents = {}
+
+        self.obligations = obligations()
+
+        self.runner = None
+
+    def url(self, path=""):
+        return "http://127.0.0.1:%d/%s" % (self.port, path)
+
+    async def start(self):
+
+        app = web.Application()
+
+        app.add_routes([
+            web.post("/identitytoolkit.googleapis.com/{tail:.*}",
+                     self.auth),
+
+            web.post("/hmrc/oauth/token", self.hmrc_token),
+            web.get("/hmrc/organisations/vat/{vrn}/obligations",
+                    self.hmrc_obligations),
+            web.get("/hmrc/organisations/vat/{vrn}/liabilities",
+                    self.hmrc_liabilities),
+            web.get("/hmrc/organisations/vat/{vrn}/payments",
+                    self.hmrc_payments),
+            web.post("/hmrc/organisations/vat/{vrn}/returns",
+                     self.hmrc_submit),
+
+            web.post("/stripe/v1/payment_intents", self.stripe_intent),
+
+            web.get("/nowpayments/v1/status", self.np_status),
+            web.get("/nowpayments/v1/currencies", self.np_currencies),
+            web.get("/nowpayments/v1/min-amount", self.np_minimum),
+            web.get("/nowpayments/v1/estimate", self.np_estimate),
+            web.post("/nowpayments/v1/payment", self.np_payment),
+            web.get("/nowpayments/v1/payment/{id}", self.np_payment_status),
+
+            # The API looks companies up with POST
+            web.route("*", "/companies/company/{id}", self.ch_profile),
+            web.route("*", "/companies/company/{id}/officers",
+                      self.ch_officers),
+        ])
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+
+        logger.info("Fake services on port %d", self.port)
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def delay(self, service):
+        self.calls[service] += 1
+        await asyncio.sleep(random.uniform(0, 2 * self.latency[service]))
+
+    # Firebase Auth: user creation, custom claims and lookup.  Tokens are
+    # minted by the scenarios, the emulator protocol doesn't check them.
+    async def auth(self, request):
+
+        await self.delay("auth")
+
+        body = await request.json()
+
+        if request.path.endswith(":lookup"):
+            return web.json_response({
+                "users": [{"localId": uid} for uid in body["localId"]]
+            })
+
+        uid = body.get("localId") or uuid.uuid4().hex
+
+        if "email" in body:
+            self.users[body["email"]] = uid
+
+        return web.json_response({"localId": uid})
+
+    async def hmrc_token(self, request):
+        await self.delay("hmrc")
+        return web.json_response({
+            "access_token": uuid.uuid4().hex,
+            "refresh_token": uuid.uuid4().hex,
+            "token_type": "bearer",
+            "expires_in": 14400,
+        })
+
+    async def hmrc_obligations(self, request):
+
+        await self.delay("hmrc")
+
+        obls = self.obligations
+
+        if "from" in request.query:
+            start = request.query["from"]
+            end = request.query["to"]
+            obls = [
+                o for o in obls if o["end"] >= start and o["start"] <= end
+            ]
+
+        return web.json_response({"obligations": obls})
+
+    async def hmrc_liabilities(self, request):
+        await self.delay("hmrc")
+        return web.json_response({
+            "liabilities": [
+                {
+                    "taxPeriod": {"from": o["start"], "to": o["end"]},
+                    "type": "VAT Return Debit Charge",
+                    "originalAmount": 1000.0,
+                    "outstandingAmount": 0.0,
+                    "due": o["due"],
+                }
+                for o in self.obligations
+            ]
+        })
+
+    async def hmrc_payments(self, request):
+        await self.delay("hmrc")
+        return web.json_response({
+            "payments": [
+                {"amount": 1000.0, "received": o["due"]}
+                for o in self.obligations
+            ]
+        })
+
+    async def hmrc_submit(self, request):
+
+        await self.delay("hmrc")
+
+        rtn = await request.json()
+
+        keys = [o["periodKey"] for o in self.obligations]
+        if rtn.get("periodKey") not in keys:
+            return web.json_response(
+                {"code": "PERIOD_KEY_INVALID", "message": "Invalid period"},
+                status=400
+            )
+
+        return web.json_response({
+            "processingDate": datetime.now(timezone.utc).isoformat(),
+            "formBundleNumber": str(random.randrange(10 ** 12)),
+            "paymentIndicator": "BANK",
+        }, status=201)
+
+    async def stripe_intent(self, request):
+
+        await self.delay("stripe")
+
+        form = await request.post()
+
+        id = "pi_" + uuid.uuid4().hex[:24]
+
+        intent = {
+            "id": id,
+            "object": "payment_intent",
+            "amount": int(form["amount"]),
+            "currency": form.get("currency", "gbp"),
+            "client_secret": id + "_secret_" + uuid.uuid4().hex[:16],
+            "status": "requires_payment_method",
+            "metadata": {
+                "transaction": form["metadata[transaction]"],
+                "uid": form["metadata[uid]"],
+            },
+        }
+
+        self.intents[id] = intent
+
+        return web.json_response(intent)
+
+    async def np_status(self, request):
+        await self.delay("nowpayments")
+        return web.json_response({"message": "OK"})
+
+    async def np_currencies(self, request):
+        await self.delay("nowpayments")
+        return web.json_response({"currencies": ["btc", "eth", "ltc"]})
+
+    async def np_minimum(self, request):
+        await self.delay("nowpayments")
+        return web.json_response({
+            "currency_from": request.query["currency_from"],
+            "min_amount": 0.0001,
+        })
+
+    async def np_estimate(self, request):
+        await self.delay("nowpayments")
+        amount = float(request.query["amount"])
+        return web.json_response({
+            "currency_from": request.query["currency_from"],
+            "amount_from": amount,
+            "currency_to": request.query["currency_to"],
+            "estimated_amount": round(amount / 50000, 8),
+        })
+
+    async def np_payment(self, request):
+
+        await self.delay("nowpayments")
+
+        form = await request.post()
+        amount = float(form["price_amount"])
+
+        return web.json_response({
+            "payment_id": random.randrange(10 ** 9),
+            "payment_status": "waiting",
+            "pay_address": uuid.uuid4().hex,
+            "price_amount": amount,
+            "price_currency": form["price_currency"],
+            "pay_amount": round(amount / 50000, 8),
+            "pay_currency": form["pay_currency"],
+            "order_id": form["order_id"],
+        }, status=201)
+
+    async def np_payment_status(self, request):
+        await self.delay("nowpayments")
+        return web.json_response({
+            "payment_id": int(request.match_info["id"]),
+            "payment_status": "waiting",
+        })
+
+    async def ch_profile(self, request):
+        await self.delay("companies-house")
+        id = request.match_info["id"]
+        return web.json_response({
+            "company_number": id,
+            "company_name": "BENCH %s LIMITED" % id,
+            "company_status": "active",
+            "registered_office_address": {
+                "address_line_1": "1 Bench Street",
+                "locality": "London",
+                "postal_code": "EC1A 1AA",
+            },
+        }, headers={"X-Ratelimit-Remain": "600", "X-Ratelimit-Reset": "0"})
+
+    async def ch_officers(self, request):
+        await self.delay("companies-house")
+        return web.json_response({
+            "items": [
+                {"name": "BENCH, Alex", "officer_role": "director"},
+            ]
+        }, headers={"X-Ratelimit-Remain": "600", "X-Ratelimit-Reset": "0"})
+
+# A Stripe event for an intent, with the Stripe-Signature header that
+# verifies against the webhook key
+def stripe_event(intent, type, key):
+
+    event = {
+        "id": "evt_" + uuid.uuid4().hex[:24],
+        "object": "event",
+        "type": type,
+        "created": int(time.time()),
+        "data": {"object": intent},
+    }
+
+    body = json.dumps(event)
+    t = str(int(time.time()))
+
+    sig = hmac.new(
+        key.encode("utf-8"), (t + "." + body).encode("utf-8"),
+        hashlib.sha256
+    ).hexdigest()
+
+    return body, "t=%s,v1=%s" % (t, sig)
+
+# A NOWPayments IPN body and its x-nowpayments-sig header
+def nowpayments_ipn(payment, status, key):
+
+    ipn = {
+        "payment_id": payment["payment_id"],
+        "payment_status": status,
+        "pay_address": payment["pay_address"],
+        "price_amount": payment["price_amount"],
+        "price_currency": payment["price_currency"],
+        "pay_amount": payment["pay_amount"],
+        "pay_currency": payment["pay_currency"],
+        "order_id": payment["order_id"],
+    }
+
+    params = json.dumps(
+        dict(sorted(ipn.items())), separators=(',', ':')
+    ).encode("utf-8")
+
+    sig = hmac.new(key.encode("utf-8"), params, hashlib.sha512).hexdigest()
+
+    return ipn, sig
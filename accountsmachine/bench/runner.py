@@ -0,0 +1,414 @@
+
+import asyncio
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+
+from . fakes import FakeServices
+from . scenarios import VirtualUser, scenarios, parse_mix
+
+logger = logging.getLogger("bench.runner")
+logger.setLevel(logging.INFO)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Nearest-rank percentile of a sorted list
+def percentile(values, p):
+    if not values:
+        return 0
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[k]
+
+# Latencies and errors by operation
+class Stats:
+
+    def __init__(self):
+        self.times = defaultdict(list)
+        self.errors = Counter()
+        self.samples = {}
+
+    def record(self, op, secs, error=None):
+
+        self.times[op].append(secs)
+
+        if error is not None:
+            self.errors[op] += 1
+            self.samples.setdefault(op, str(error))
+
+    def rows(self, elapsed):
+
+        rows = []
+
+        for op in sorted(self.times):
+
+            times = sorted(self.times[op])
+
+            rows.append({
+                "operation": op,
+                "count": len(times),
+                "errors": self.errors[op],
+                "rate": len(times) / elapsed if elapsed else 0,
+                "p50": percentile(times, 50),
+                "p90": percentile(times, 90),
+                "p99": percentile(times, 99),
+                "max": times[-1],
+            })
+
+        return rows
+
+# Boots the API against local stores and the fake services, runs virtual
+# users through a weighted mix of scenarios, and reports throughput and
+# latency.
+class Bench:
+
+    def __init__(self, users=10, duration=60, iterations=None, mix=None,
+                 store="memory", think=0, latency=None, seed=None,
+                 jsonnet_base="ixbrl-reporter-jsonnet/", config_base="base/",
+                 workdir=None, overrides=None):
+
+        self.users = users
+        self.duration = duration
+        self.iterations = iterations
+        self.mix = parse_mix(mix)
+        self.store = store
+        self.think = think
+        self.latency = latency
+        self.seed = seed
+        # The service runs in the work directory
+        self.jsonnet_base = os.path.abspath(jsonnet_base) + "/"
+        self.config_base = os.path.abspath(config_base) + "/"
+        self.workdir = workdir
+        self.overrides = overrides or {}
+
+        self.setup_stats = Stats()
+        self.stats = Stats()
+
+        self.fakes = None
+        self.proc = None
+        self.config = None
+
+    def service_config(self, port):
+
+        fakes = self.fakes
+
+        config = {
+
+            "port": port,
+
+            "project": "am-bench",
+            "bucket": "am-bench",
+
+            "stripe-public": "pk_test_bench",
+            "stripe-secret": "sk_test_bench",
+            "stripe-webhook-key": "whsec_bench",
+            "stripe-api-base": fakes.url("stripe"),
+
+            "seller-name": "Bench Ltd",
+            "seller-vat-number": "GB123456789",
+            "vat-rate": 20,
+
+            "jsonnet-base": self.jsonnet_base,
+            "config-base": self.config_base,
+
+            "vat-auth-url": fakes.url("hmrc"),
+            "vat-api-url": fakes.url("hmrc"),
+            "vat-client-id": "bench",
+            "vat-client-secret": "bench",
+            "redirect-uri": "http://127.0.0.1:%d/vat/receive-token" % port,
+
+            "companies-service-api-key": "bench",
+            "companies-service-url": fakes.url("companies"),
+
+            "nowpayments-api-key": "bench",
+            "nowpayments-url": fakes.url("nowpayments/"),
+            "nowpayments-ipn-url":
+                "http://127.0.0.1:%d/crypto/callback" % port,
+            "nowpayments-ipn-key": "bench",
+
+            "audience": "am-bench",
+            "algorithms": ["RS256"],
+            "application-id": "am-bench",
+
+            # A failed submission is reported, not retried with backoff
+            "job-max-attempts": 1,
+
+        }
+
+        if self.store == "memory":
+            config["doc-store"] = "memory"
+            config["blob-store"] = "memory"
+        else:
+            config["doc-store"] = "sqlite"
+            config["doc-store-path"] = os.path.join(self.workdir, "docs.sqlite")
+            config["blob-store"] = "directory"
+            config["blob-store-path"] = os.path.join(self.workdir, "blobs")
+
+        config.update(self.overrides)
+
+        return config
+
+    async def start_service(self):
+
+        port = free_port()
+
+        self.config = self.service_config(port)
+
+        cfg = os.path.join(self.workdir, "config.json")
+        with open(cfg, "w") as f:
+            json.dump(self.config, f, indent=4)
+
+        self.log = os.path.join(self.workdir, "service.log")
+
+        env = dict(os.environ)
+
+        # Firebase Auth talks to the fake, and accepts unsigned tokens
+        env["FIREBASE_AUTH_EMULATOR_HOST"] = "127.0.0.1:%d" % self.fakes.port
+
+        top = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__)
+        )))
+        env["PYTHONPATH"] = os.pathsep.join(
+            p for p in [top, env.get("PYTHONPATH")] if p
+        )
+
+        # Anything the service prints, e.g. a traceback at startup, goes
+        # to the log as well
+        self.output = open(self.log, "a")
+
+        self.proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "accountsmachine.bench.service",
+            cfg, self.log, env=env, cwd=self.workdir,
+            stdout=self.output, stderr=self.output,
+        )
+
+        self.base = "http://127.0.0.1:%d" % port
+
+        # Wait for it to listen
+        deadline = time.monotonic() + 60
+
+        while True:
+
+            if self.proc.returncode is not None:
+                raise RuntimeError(
+                    "Service exited with %d, see %s" % (
+                        self.proc.returncode, self.log
+                    )
+                )
+
+            try:
+                r, w = await asyncio.open_connection("127.0.0.1", port)
+                w.close()
+                break
+            except OSError:
+                pass
+
+            if time.monotonic() > deadline:
+                raise RuntimeError("Service didn't start, see %s" % self.log)
+
+            await asyncio.sleep(0.2)
+
+        logger.info("Service on port %d, logging to %s", port, self.log)
+
+    async def stop_service(self):
+
+        if self.proc is None:
+            return
+
+        if self.proc.returncode is None:
+
+            # SIGINT gives aiohttp a clean shutdown, so queues drain
+            self.proc.send_signal(signal.SIGINT)
+
+            try:
+                await asyncio.wait_for(self.proc.wait(), 15)
+            except asyncio.TimeoutError:
+                self.proc.kill()
+                await self.proc.wait()
+
+        self.output.close()
+
+    async def session(self, user, deadline):
+
+        names = list(self.mix)
+        weights = [self.mix[n] for n in names]
+
+        n = 0
+
+        while time.monotonic() < deadline:
+
+            if self.iterations is not None and n >= self.iterations:
+                break
+
+            n += 1
+
+            name = user.rng.choices(names, weights)[0]
+            fn = scenarios[name][0]
+
+            start = time.perf_counter()
+
+            try:
+                await fn(user)
+                self.stats.record("scenario: " + name,
+                                  time.perf_counter() - start)
+            except Exception as e:
+                self.stats.record("scenario: " + name,
+                                  time.perf_counter() - start, e)
+
+            if self.think:
+                await asyncio.sleep(user.rng.uniform(0, 2 * self.think))
+
+    async def run(self):
+
+        if self.workdir is None:
+            self.workdir = tempfile.mkdtemp(prefix="am-bench-")
+        os.makedirs(self.workdir, exist_ok=True)
+
+        rng = random.Random(self.seed)
+
+        self.fakes = FakeServices(free_port(), self.latency)
+        await self.fakes.start()
+
+        try:
+
+            await self.start_service()
+
+            connector = aiohttp.TCPConnector(limit=0)
+
+            async with aiohttp.ClientSession(connector=connector) as session:
+
+                users = [
+                    VirtualUser(
+                        n, session, self.base, self.fakes, self.setup_stats,
+                        self.config, seed=rng.random()
+                    )
+                    for n in range(self.users)
+                ]
+
+                start = time.perf_counter()
+
+                res = await asyncio.gather(
+                    *[u.setup() for u in users], return_exceptions=True
+                )
+
+                self.setup_time = time.perf_counter() - start
+
+                ready = []
+
+                for u, r in zip(users, res):
+                    if isinstance(r, Exception):
+                        logger.info("User %d setup failed: %s", u.n, r)
+                    else:
+                        u.stats = self.stats
+                        ready.append(u)
+
+                if not ready:
+                    raise RuntimeError(
+                        "No users set up, see %s" % self.log
+                    )
+
+                self.ready = len(ready)
+
+                # Calls to the fakes during setup aren't part of the run
+                self.setup_calls = Counter(self.fakes.calls)
+                self.fakes.calls.clear()
+
+                start = time.perf_counter()
+                deadline = time.monotonic() + self.duration
+
+                await asyncio.gather(
+                    *[self.session(u, deadline) for u in ready]
+                )
+
+                self.elapsed = time.perf_counter() - start
+
+        finally:
+            await self.stop_service()
+            await self.fakes.stop()
+
+        return self.report()
+
+    def report(self):
+
+        return {
+            "users": self.users,
+            "ready": self.ready,
+            "store": self.store,
+            "mix": self.mix,
+            "setup-seconds": self.setup_time,
+            "seconds": self.elapsed,
+            "setup": self.setup_stats.rows(self.setup_time),
+            "operations": self.stats.rows(self.elapsed),
+            "errors": dict(
+                list(self.setup_stats.samples.items()) +
+                list(self.stats.samples.items())
+            ),
+            "calls": dict(self.fakes.calls),
+            "log": self.log,
+        }
+
+def format_rows(rows):
+
+    out = []
+
+    out.append("%-40s %7s %6s %8s %8s %8s %8s %8s" % (
+        "operation", "count", "errors", "ops/s", "p50 ms", "p90 ms",
+        "p99 ms", "max ms"
+    ))
+
+    for r in rows:
+        out.append("%-40s %7d %6d %8.1f %8.1f %8.1f %8.1f %8.1f" % (
+            r["operation"][:40], r["count"], r["errors"], r["rate"],
+            1000 * r["p50"], 1000 * r["p90"], 1000 * r["p99"],
+            1000 * r["max"]
+        ))
+
+    return "\n".join(out)
+
+def format_report(rep):
+
+    out = []
+
+    out.append("Setup: %d of %d users in %.1fs" % (
+        rep["ready"], rep["users"], rep["setup-seconds"]
+    ))
+    out.append("")
+    out.append(format_rows(rep["setup"]))
+    out.append("")
+
+    # Requests are the rows named by route, the rest are scenarios and waits
+    ops = rep["operations"]
+    total = sum(r["count"] for r in ops if " /" in r["operation"])
+
+    out.append("Run: %.1fs, %d requests, %.1f requests/s, %s store" % (
+        rep["seconds"], total, total / rep["seconds"], rep["store"]
+    ))
+    out.append("")
+    out.append(format_rows(ops))
+    out.append("")
+
+    out.append("Fake service calls: " + ", ".join(
+        "%s %d" % (k, v) for k, v in sorted(rep["calls"].items())
+    ))
+
+    if rep["errors"]:
+        out.append("")
+        out.append("First error per operation:")
+        for op, e in sorted(rep["errors"].items()):
+            out.append("  %s: %s" % (op, e[:200]))
+
+    out.append("")
+    out.append("Service log: %s" % rep["log"])
+
+    return "\n".join(out)
@@ -0,0 +1,504 @@
+
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+from datetime import date, timedelta
+from urllib.parse import urlencode, urlparse, parse_qs
+
+import aiohttp
+
+from . fakes import stripe_event, nowpayments_ipn
+
+# Scope the API grants on registration
+SCOPE = [
+    "vat", "filing-config", "books", "company", "ch-lookup", "render",
+    "status", "corptax", "accounts", "commerce", "user"
+]
+
+# Client headers the VAT endpoints need for HMRC fraud prevention
+DEVICE = {
+    "X-Client-Version": "bench",
+    "X-Device-TZ": "UTC+00:00",
+    "X-Screen": json.dumps([1920, 1080, 1600, 900, 24, 1]),
+    "User-Agent": "am-bench",
+}
+
+class Failed(Exception):
+    pass
+
+# An unsigned ID token.  The API accepts these when Firebase Auth is in
+# emulator mode, which is how the runner starts it.
+def mint_token(project, uid, email, lifetime=3600):
+
+    def enc(obj):
+        raw = json.dumps(obj).encode("utf-8")
+        return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("utf-8")
+
+    now = int(time.time())
+
+    claims = {
+        "iss": "https://securetoken.google.com/" + project,
+        "aud": project,
+        "sub": uid,
+        "user_id": uid,
+        "iat": now,
+        "auth_time": now,
+        "exp": now + lifetime,
+        "email": email,
+        "email_verified": True,
+        "scope": SCOPE,
+    }
+
+    return enc({"alg": "none", "typ": "JWT"}) + "." + enc(claims) + "."
+
+# A year of CSV books: weekly sales with output VAT, and purchases with
+# input VAT.  Amounts vary per user so calculations aren't all the same.
+def make_books(year, rng):
+
+    rows = ["Date,Transaction ID,Description,Full Account Name,Amount Num."]
+
+    day = date(year, 1, 1)
+    n = 0
+
+    while day.year == year:
+
+        n += 1
+        net = rng.randrange(100, 5000)
+        dt = day.strftime("%d/%m/%y")
+
+        rows.append("%s,s%d,Sales,Income:Sales,-%d.00" % (dt, n, net))
+        rows.append(",,,VAT:Output:Sales,-%.2f" % (net * 0.2))
+        rows.append(",,,Assets:Bank,%.2f" % (net * 1.2))
+
+        net = rng.randrange(50, 1500)
+
+        rows.append("%s,p%d,Supplies,Expenses:VAT Purchases,%d.00" % (
+            dt, n, net
+        ))
+        rows.append(",,,VAT:Input,%.2f" % (net * 0.2))
+        rows.append(",,,Assets:Bank,-%.2f" % (net * 1.2))
+
+        day += timedelta(days=7)
+
+    return ("\n".join(rows) + "\n").encode("utf-8")
+
+# One simulated user of the web app.  Every call is timed and recorded
+# against its route template, so results line up with the service's own
+# metrics.
+class VirtualUser:
+
+    def __init__(self, n, session, base, fakes, stats, config, seed=None):
+
+        self.n = n
+        self.session = session
+        self.base = base
+        self.fakes = fakes
+        self.stats = stats
+        self.config = config
+
+        self.rng = random.Random(seed)
+
+        self.email = "bench-%d-%s@example.com" % (n, uuid.uuid4().hex[:8])
+        self.uid = None
+        self.token = None
+        self.company = "%08d" % self.rng.randrange(10 ** 7, 10 ** 8)
+        self.device = dict(DEVICE)
+        self.device["X-Device-ID"] = str(uuid.uuid4())
+
+    def headers(self, extra=None):
+
+        h = {}
+
+        if self.token:
+            h["Authorization"] = "Bearer " + self.token
+
+        h.update(extra or {})
+
+        return h
+
+    # Makes a request, records its latency as op, and returns the decoded
+    # body.  Any status other than one of ok counts as an error.
+    async def call(self, op, method, path, ok=(200,), headers=None,
+                   json_body=None, data=None, decode=True):
+
+        start = time.perf_counter()
+
+        try:
+
+            async with self.session.request(
+                    method, self.base + path, headers=self.headers(headers),
+                    json=json_body, data=data, allow_redirects=False
+            ) as resp:
+
+                body = await resp.read()
+
+                if resp.status not in ok:
+                    raise Failed("%s: %d %s" % (
+                        op, resp.status, body[:200].decode("utf-8", "replace")
+                    ))
+
+            elapsed = time.perf_counter() - start
+            self.stats.record(op, elapsed)
+
+        except Exception as e:
+            self.stats.record(op, time.perf_counter() - start, e)
+            raise
+
+        if decode and body:
+            return json.loads(body)
+
+        return body
+
+    # Polls until done(body) is true, and records the whole wait as op
+    async def wait(self, op, path, done, timeout=60, interval=0.25):
+
+        start = time.perf_counter()
+
+        while True:
+
+            async with self.session.get(
+                    self.base + path, headers=self.headers()
+            ) as resp:
+                body = await resp.json() if resp.status == 200 else None
+
+            if body is not None and done(body):
+                self.stats.record(op, time.perf_counter() - start)
+                return body
+
+            if time.perf_counter() - start > timeout:
+                e = Failed("%s: timed out" % op)
+                self.stats.record(op, time.perf_counter() - start, e)
+                raise e
+
+            await asyncio.sleep(interval)
+
+    # Registration, company, books and the HMRC link, as a new user of the
+    # app would go through them
+    async def setup(self):
+
+        await self.call(
+            "POST /user-account/register", "POST", "/user-account/register",
+            headers={"X-Application-ID": self.config["application-id"]},
+            json_body={
+                "email": self.email,
+                "phone_number": None,
+                "display_name": "Bench User %d" % self.n,
+                "password": uuid.uuid4().hex,
+            }, decode=False
+        )
+
+        self.uid = self.fakes.users[self.email]
+        self.token = mint_token(self.config["project"], self.uid, self.email)
+
+        vrn = "%09d" % self.rng.randrange(10 ** 9)
+
+        await self.call(
+            "PUT /company/{id}", "PUT", "/company/" + self.company,
+            json_body={
+                "company_name": "BENCH %s LIMITED" % self.company,
+                "company_number": self.company,
+                "vrn": vrn,
+                "vat_registration": "GB" + vrn,
+                "contact_name": "Bench User %d" % self.n,
+                "contact_email": self.email,
+            }
+        )
+
+        await upload_books(self)
+
+        res = await self.call(
+            "GET /vat/authorize/{id}", "GET", "/vat/authorize/" + self.company
+        )
+
+        state = parse_qs(urlparse(res["url"]).query)["state"][0]
+
+        await self.call(
+            "GET /vat/receive-token", "GET",
+            "/vat/receive-token?" + urlencode({
+                "code": uuid.uuid4().hex, "state": state
+            }),
+            ok=(302,), decode=False
+        )
+
+    def period(self):
+        obl = self.rng.choice(self.fakes.obligations)
+        return obl["start"], obl["end"]
+
+    # An order for quantity of kind, priced from the current offer
+    def order(self, offer, kind, quantity=1):
+
+        row = [
+            r for r in offer["offer"][kind]["offer"]
+            if r["quantity"] == quantity
+        ][0]
+
+        subtotal = row["price"]
+        vat = round(subtotal * offer["vat_rate"])
+
+        return {
+            "items": [{
+                "kind": kind,
+                "quantity": quantity,
+                "amount": row["price"],
+                "discount": row["discount"],
+                "description": offer["offer"][kind]["description"],
+            }],
+            "subtotal": subtotal,
+            "vat_rate": offer["vat_rate"],
+            "vat": vat,
+            "total": subtotal + vat,
+        }
+
+async def upload_books(user):
+
+    books = make_books(date.today().year - 1, user.rng)
+
+    form = aiohttp.FormData()
+    form.add_field("books", books, filename="books.csv",
+                   content_type="text/csv")
+    form.add_field("kind", "csv")
+
+    await user.call(
+        "POST /books/{id}/upload", "POST",
+        "/books/%s/upload" % user.company, data=form, decode=False
+    )
+
+# Dashboard and status pages
+async def browse(user):
+
+    start, end = user.period()
+    cid = user.company
+
+    await user.call("GET /user-account/profile", "GET",
+                    "/user-account/profile")
+    await user.call("GET /companies", "GET", "/companies")
+    await user.call("GET /filings", "GET", "/filings")
+    await user.call("GET /commerce/balance", "GET", "/commerce/balance")
+    await user.call("GET /commerce/transactions", "GET",
+                    "/commerce/transactions")
+    await user.call("GET /status/{id}", "GET", "/status/" + cid)
+
+    q = "?start=%s&end=%s" % (start, end)
+
+    await user.call("GET /vat/status/{id}", "GET",
+                    "/vat/status/" + cid + q, headers=user.device)
+    await user.call("GET /vat/liabilities/{id}", "GET",
+                    "/vat/liabilities/" + cid + q, headers=user.device)
+    await user.call("GET /vat/payments/{id}", "GET",
+                    "/vat/payments/" + cid + q, headers=user.device)
+
+# Companies House lookup while setting a company up
+async def company(user):
+
+    num = "%08d" % user.rng.randrange(10 ** 7, 10 ** 8)
+
+    await user.call("GET /company-reg/{id}", "GET", "/company-reg/" + num)
+    await user.call("GET /company/{id}", "GET", "/company/" + user.company)
+
+# Fresh books, then the summary the app shows after upload
+async def books(user):
+
+    await upload_books(user)
+
+    cid = user.company
+
+    await user.call("GET /books/{id}/info", "GET", "/books/%s/info" % cid)
+    await user.call("GET /books/{id}/summary", "GET",
+                    "/books/%s/summary" % cid)
+
+# A VAT return from start to finish: pick an open period, configure the
+# filing, check the calculation, render, and submit.  A filing uses a VAT
+# credit, which are free, so buy one first if there are none.
+async def vat(user):
+
+    cid = user.company
+
+    obls = await user.call(
+        "GET /vat/open-obligations/{id}", "GET",
+        "/vat/open-obligations/" + cid, headers=user.device
+    )
+
+    obl = user.rng.choice(obls)
+
+    fid = str(uuid.uuid4())
+
+    await user.call("PUT /filing/{id}", "PUT", "/filing/" + fid, json_body={
+        "company": cid,
+        "kind": "vat",
+        "label": "VAT %s - %s" % (obl["start"], obl["end"]),
+        "start": obl["start"],
+        "end": obl["end"],
+        "due": obl["due"],
+        "status": "draft",
+        "structure": {"elements": []},
+    })
+
+    res = await user.call("POST /vat/calculate/{id}", "POST",
+                          "/vat/calculate/" + fid)
+
+    if "error" in res:
+        raise Failed("calculate: %s" % res["error"]["message"])
+
+    await user.call("POST /render-html/{id}", "POST", "/render-html/" + fid,
+                    decode=False)
+    await user.call("POST /vat/compute/{id}", "POST", "/vat/compute/" + fid)
+
+    bal = await user.call("GET /commerce/balance", "GET",
+                          "/commerce/balance")
+
+    if bal.get("vat", 0) < 1:
+
+        offer = await user.call("GET /commerce/offer", "GET",
+                                "/commerce/offer")
+
+        await user.call(
+            "POST /commerce/complete-free-order", "POST",
+            "/commerce/complete-free-order",
+            json_body=user.order(offer, "vat")
+        )
+
+    res = await user.call("POST /vat/submit/{id}", "POST",
+                          "/vat/submit/" + fid, headers=user.device)
+
+    job = await user.wait(
+        "job: vat submission", "/job/" + res["job"],
+        lambda j: j["state"] in ("done", "failed")
+    )
+
+    if job["state"] != "done":
+        raise Failed("submission: %s" % job.get("error"))
+
+    # Submission errors are recorded on the filing, the job still completes
+    cfg = await user.call("GET /filing/{id}", "GET", "/filing/" + fid)
+
+    if cfg.get("state") != "published":
+        raise Failed("submission: filing is %s" % cfg.get("state"))
+
+# Paid credits, which are capped per user.  Returns the offer and a kind
+# to buy, or None once the user has bought all they're allowed.
+async def paid_offer(user):
+
+    offer = await user.call("GET /commerce/offer", "GET", "/commerce/offer")
+
+    kinds = [k for k in ("corptax", "accounts") if k in offer["offer"]]
+    if not kinds:
+        return offer, None
+
+    return offer, user.rng.choice(kinds)
+
+def settled(tx):
+    return tx.get("status") in ("complete", "cancelled", "failed")
+
+# Card payment through Stripe.  Some checkouts are abandoned, which leaves
+# the balance alone.
+async def credits(user):
+
+    offer, kind = await paid_offer(user)
+
+    if kind is None:
+        await user.call("GET /commerce/transactions", "GET",
+                        "/commerce/transactions")
+        return
+
+    tid = await user.call(
+        "POST /commerce/create-order", "POST", "/commerce/create-order",
+        json_body=user.order(offer, kind)
+    )
+
+    secret = await user.call(
+        "POST /commerce/create-payment/{id}", "POST",
+        "/commerce/create-payment/" + tid
+    )
+
+    intent = user.fakes.intents[secret.split("_secret_")[0]]
+
+    if user.rng.random() < 0.2:
+        type = "payment_intent.canceled"
+    else:
+        type = "payment_intent.succeeded"
+
+    body, sig = stripe_event(
+        intent, type, user.config["stripe-webhook-key"]
+    )
+
+    await user.call(
+        "POST /commerce/callback", "POST", "/commerce/callback",
+        headers={"stripe-signature": sig, "Content-Type": "application/json"},
+        data=body, decode=False
+    )
+
+    await user.wait(
+        "settle: stripe", "/commerce/transaction/" + tid, settled
+    )
+
+# Crypto payment through NOWPayments, completed by an IPN
+async def crypto(user):
+
+    offer, kind = await paid_offer(user)
+
+    if kind is None:
+        await user.call("GET /crypto/currencies", "GET", "/crypto/currencies")
+        return
+
+    order = user.order(offer, kind)
+
+    await user.call("GET /crypto/currencies", "GET", "/crypto/currencies")
+    await user.call("POST /crypto/minimum", "POST", "/crypto/minimum",
+                    json_body={"currency": "btc"})
+    await user.call("POST /crypto/estimate", "POST", "/crypto/estimate",
+                    json_body={"currency": "btc", "order": order})
+
+    paym = await user.call("POST /crypto/payment", "POST", "/crypto/payment",
+                           json_body={"currency": "btc", "order": order})
+
+    tid = paym["order_id"]
+
+    ipn, sig = nowpayments_ipn(
+        paym, "finished", user.config["nowpayments-ipn-key"]
+    )
+
+    await user.call(
+        "POST /crypto/callback/{user}/{id}", "POST",
+        "/crypto/callback/%s/%s" % (user.uid, tid),
+        headers={"x-nowpayments-sig": sig}, json_body=ipn, decode=False
+    )
+
+    await user.wait(
+        "settle: nowpayments", "/commerce/transaction/" + tid, settled
+    )
+
+# Scenarios by name, with the default weight each has in the mix.  Most
+# sessions only look at things, filings and payments are rarer.
+scenarios = {
+    "browse": (browse, 10),
+    "company": (company, 2),
+    "books": (books, 3),
+    "vat": (vat, 3),
+    "credits": (credits, 1),
+    "crypto": (crypto, 1),
+}
+
+# Parses a mix like "browse=5,vat=1" into name -> weight
+def parse_mix(text):
+
+    if not text:
+        return {k: v[1] for k, v in scenarios.items()}
+
+    mix = {}
+
+    for part in text.split(","):
+
+        name, _, weight = part.partition("=")
+        name = name.strip()
+
+        if name not in scenarios:
+            raise RuntimeError("Unknown scenario '%s', have %s" % (
+                name, ", ".join(scenarios)
+            ))
+
+        mix[name] = float(weight) if weight else 1.0
+
+    return mix
@@ -0,0 +1,26 @@
+
+import logging
+import sys
+
+# Runs the API in its own process for the load test runner, so the
+# service's event loop isn't shared with the load generator.  Log output
+# goes to a file, the runner's terminal is for the report.
+def main():
+
+    cfg, log = sys.argv[1], sys.argv[2]
+
+    logging.basicConfig(
+        filename=log, level=logging.INFO,
+        format="%(asctime)s %(name)s %(levelname)s %(message)s"
+    )
+
+    logging.getLogger("cachecontrol.controller").setLevel(logging.ERROR)
+    logging.getLogger("urllib3.connectionpool").setLevel(logging.ERROR)
+
+    # Imported late so logging is set up first
+    from .. api import Api
+
+    Api(cfg).run()
+
+if __name__ == "__main__":
+    main()
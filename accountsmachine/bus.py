@@ -0,0 +1,78 @@
+
+import asyncio
+import logging
+
+logger = logging.getLogger("bus")
+logger.setLevel(logging.INFO)
+
+# In-process publish/subscribe.  Topics are any hashable value; filing
+# events use (uid, filing id).  Publishing never blocks: a subscriber which
+# falls behind loses its oldest events, not the publisher's time.
+#
+# Only subscribers in this process see an event, so anything consuming
+# these should also be able to catch up from the store.
+
+class Subscription:
+
+    def __init__(self, bus, topic, size):
+        self.bus = bus
+        self.topic = topic
+        self.queue = asyncio.Queue(maxsize=size)
+        self.dropped = 0
+
+    def put(self, event):
+
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+
+        self.queue.put_nowait(event)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+class EventBus:
+
+    def __init__(self, size=100):
+        self.size = size
+        self.subs = {}
+
+    def subscribe(self, topic):
+        sub = Subscription(self, topic, self.size)
+        self.subs.setdefault(topic, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+
+        subs = self.subs.get(sub.topic)
+        if subs is None:
+            return
+
+        subs.discard(sub)
+        if not subs:
+            del self.subs[sub.topic]
+
+    def publish(self, topic, event):
+        for sub in list(self.subs.get(topic, [])):
+            sub.put(event)
+
+# Logging handler publishing each record as a 'log' event
+class BusHandler(logging.Handler):
+
+    def __init__(self, bus, topic):
+        super().__init__()
+        self.bus = bus
+        self.topic = topic
+
+    def emit(self, record):
+        try:
+            self.bus.publish(self.topic, {
+                "type": "log",
+                "level": record.levelname,
+                "message": self.format(record),
+            })
+        except Exception:
+            self.handleError(record)
@@ -0,0 +1,58 @@
+
+from collections import OrderedDict
+import time
+
+# Size-bounded LRU cache with a per-entry TTL.  Expired entries are kept
+# until evicted so that callers can fall back to stale data when the
+# upstream service is unavailable.
+class TtlCache:
+
+    def __init__(self, size=1000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def put(self, key, value, ttl=None):
+
+        if ttl is None: ttl = self.ttl
+
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    # Returns a fresh value, or raises KeyError
+    def get(self, key):
+
+        expiry, value = self.entries[key]
+
+        if expiry < time.monotonic():
+            raise KeyError(key)
+
+        self.entries.move_to_end(key)
+        return value
+
+    # Returns a value regardless of age, or raises KeyError
+    def get_stale(self, key):
+        expiry, value = self.entries[key]
+        return value
+
+    def keys(self):
+        return list(self.entries.keys())
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key):
+        try:
+            self.get(key)
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self):
+        return len(self.entries)
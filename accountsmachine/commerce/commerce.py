@@ -1,21 +1,32 @@
 
 import asyncio
 import aiohttp
+import functools
+import json
 import logging
 import uuid
 from datetime import datetime, timezone
 import math
 import copy
-from firebase_admin import firestore
+from concurrent.futures import ThreadPoolExecutor
 
 from .. admin.referral import Package
 from .. audit.audit import Audit
-from . order import product, purchase_price, verify_order, get_order_delta
+from .. state.store import async_transactional
+from .. metrics import dependency
+from . order import product, verify_order, get_order_delta
+from . order import offer_rows, package_rate
 from . exceptions import InvalidOrder
 
 import stripe
 stripe.api_key = ""
 
+# Moved out of stripe.http_client in later stripe releases
+try:
+    RequestsClient = stripe.RequestsClient
+except AttributeError:
+    RequestsClient = stripe.http_client.RequestsClient
+
 logger = logging.getLogger("api.commerce")
 logger.setLevel(logging.DEBUG)
 
@@ -62,6 +73,10 @@ class Commerce:
         self.stripe_public = config["stripe-public"]
         self.stripe_webhook_key = config["stripe-webhook-key"]
 
+        # Only set to point at a stand-in, e.g. for load tests
+        if "stripe-api-base" in config:
+            stripe.api_base = config["stripe-api-base"]
+
         self.seller_name = config["seller-name"] 
         self.seller_vat_number = config["seller-vat-number"]
 
@@ -70,74 +85,73 @@ class Commerce:
 
         self.values = product
 
-    async def get_offer(self, user):
-
-        balance = await self.get_balance(user)
-        package = await user.currentpackage().get()
-        package = Package.from_dict(package)
-
-        opts = copy.deepcopy(self.values)
-
-        kinds = opts.keys()
+        # The stripe library is synchronous.  Calls run on a small dedicated
+        # pool so they can't stall the event loop or exhaust the default
+        # executor.  The requests client keeps a session per thread, so
+        # connections are reused.
+        stripe.default_http_client = RequestsClient(
+            timeout=config.get("stripe-timeout", 20)
+        )
+        stripe.max_network_retries = config.get("stripe-max-retries", 2)
 
-        for kind in opts:
-            if kind in balance:
-                opts[kind]["permitted"] -= balance[kind]
-                opts[kind]["permitted"] = max(opts[kind]["permitted"], 0)
+        self.stripe_executor = ThreadPoolExecutor(
+            max_workers=config.get("stripe-workers", 8),
+            thread_name_prefix="stripe",
+        )
 
-        # If you already have the max, we can't sell you more.
-        opts = {
-            v: opts[v] for v in opts if opts[v]["permitted"] > 0
-        }
+    async def stop(self, app=None):
+        self.stripe_executor.shutdown(wait=False)
 
-        package_discount = None
+    async def stripe_call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        with dependency("stripe", getattr(fn, "__qualname__", "call")):
+            return await loop.run_in_executor(
+                self.stripe_executor, functools.partial(fn, *args, **kwargs)
+            )
 
-        if package:
-            if package.expiry > datetime.now(timezone.utc):
-                if package.discount:
-                    package_discount = package.discount
+    async def get_offer(self, user):
 
-        for kind in opts:
+        balance, package = await asyncio.gather(
+            self.get_balance(user), user.currentpackage().get()
+        )
+        package = Package.from_dict(package)
 
-            res = opts[kind]
+        offer = {}
 
-            offer = []
-            for v in [0, *range(
-                    res["min_purchase"], res["permitted"] + 1
-            )]:
+        for kind in self.values:
 
-                price = math.floor(
-                    purchase_price(
-                        res["price"], v, res["discount"]
-                    )
-                )
+            res = dict(self.values[kind])
 
-                discount = (res["price"] * v) - price
+            if kind in balance:
+                res["permitted"] -= balance[kind]
+                res["permitted"] = max(res["permitted"], 0)
 
-                if package_discount and getattr(package_discount, kind):
-                    adj = round(price * getattr(package_discount, kind))
-                    discount += adj
-                    price -= adj
+            # If you already have the max, we can't sell you more.
+            if res["permitted"] <= 0:
+                continue
 
-                offer.append({
-                    "price": price, "discount": discount, "quantity": v
-                })
+            rate = package_rate(package, kind)
 
-            res["offer"] = offer
+            res["offer"] = [
+                dict(row) for row in offer_rows(kind, rate)
+                if row["quantity"] <= res["permitted"]
+            ]
 
-            if package_discount and getattr(package_discount, kind):
-                discp = str(int(100 * getattr(package_discount, kind))) + "%"
+            if rate:
+                discp = str(int(100 * rate)) + "%"
                 res["adjustment"] = package.id + " " + discp
 
+            offer[kind] = res
+
         offer = {
-            "offer": opts,
+            "offer": offer,
             "vat_rate": self.vat_rate,
         }
 
         return offer
 
     async def get_balance(self, user):
-        return await user.credits().get()
+        return await user.balance().get()
 
     async def create_tx(self, user, order, uid, email):
 
@@ -185,14 +199,10 @@ class Commerce:
         newtx = await self.create_tx(user, order, uid, email)
         tid = str(uuid.uuid4())
 
-        @firestore.async_transactional
+        @async_transactional
         async def create_order(tx, deltas, newtx):
 
-            bal = {}
-
-            c = user.credits()
-            c.use_transaction(tx)
-            bal = await c.get()
+            bal = await user.balance().get(tx)
 
             for kind in deltas:
 
@@ -205,7 +215,9 @@ class Commerce:
 
             # Transaction gets written out, the new balance does not, as it
             # is not paid for yet.
-            await user.transaction(tid).put(newtx)
+            t = user.transaction(tid)
+            t.use_transaction(tx)
+            await t.put(newtx)
 
             return True, "OK"
 
@@ -225,7 +237,8 @@ class Commerce:
         transaction = await user.transaction(tid).get()
         order = transaction["order"]
 
-        intent = stripe.PaymentIntent.create(
+        intent = await self.stripe_call(
+            stripe.PaymentIntent.create,
             amount=order["total"],
             currency='gbp',
             receipt_email=email,
@@ -250,10 +263,11 @@ class Commerce:
     async def complete_order(self, user, id):
         return
 
-    async def get_transactions(self, user):
+    def stream_transactions(self, user):
+        return user.transactions().stream()
 
-        ss = await user.transactions().list()
-        return ss
+    async def get_transaction_page(self, user, **query):
+        return await user.transactions().page(**query)
 
     async def get_transaction(self, user, tid):
         try:
@@ -266,105 +280,133 @@ class Commerce:
     async def get_payment_key(self, user):
         return self.stripe_public
 
-    async def callback(self, store, req, sig):
+    # Signature check and JSON parse only, no network I/O, so this
+    # stays on the loop.  Returns the event as a plain dict, ready to be
+    # queued.
+    def verify_event(self, req, sig):
 
         try:
-            event = stripe.Webhook.construct_event(
+            stripe.Webhook.construct_event(
                 req, sig, self.stripe_webhook_key
             )
         except:
             raise RuntimeError("Invalid payload")
 
-        logger.info("Stripe event: %s", event["type"])
+        return json.loads(req)
 
-        intent = event["data"]["object"]
-        tid = intent["metadata"]["transaction"]
-        uid = intent["metadata"]["uid"]
+    # Webhook queue handler for Stripe events
+    async def process_event(self, store, rec):
+        await self.callback(store, rec["payload"])
 
-        user = store.user(uid)
+    # Statuses an order doesn't leave.  Stripe can deliver events out of
+    # order, and the webhook queue retries them, so a late event mustn't
+    # move an order back.
+    final_status = ("complete", "cancelled")
 
-        # Fetch transaction outside of the transaction
-        ordtxdoc = user.transaction(tid)
-        ordtx = await ordtxdoc.get()
+    # Updates the order's status, unless it's already final
+    async def set_status(self, user, tid, status, payment_status):
 
-        if event["type"] == "payment_intent.created":
+        @async_transactional
+        async def update_order(tx):
 
-            ordtx["payment_status"] = "created"
-            ordtx["status"] = "created"
-            await ordtxdoc.put(ordtx)
+            t = user.transaction(tid)
+            t.use_transaction(tx)
+            ordtx = await t.get()
 
-            rec = Audit.transaction_record(ordtx)
-            await Audit.write(user.store, rec, id=tid)
+            if ordtx["status"] in self.final_status:
+                return None
 
-            return
-            
-        if event["type"] == "payment_intent.canceled":
+            ordtx["status"] = status
+            ordtx["payment_status"] = payment_status
+            await t.put(ordtx)
 
-            ordtx["payment_status"] = "cancelled"
-            ordtx["status"] = "cancelled"
-            await ordtxdoc.put(ordtx)
+            return ordtx
 
-            rec = Audit.transaction_record(ordtx)
-            await Audit.write(user.store, rec, id=tid)
+        tx = user.create_transaction()
+        ordtx = await update_order(tx)
 
+        if ordtx is None:
+            logger.info("Transaction %s is final, %s ignored", tid, status)
             return
-            
-        if event["type"] == "payment_intent.payment_failed":
 
-            ordtx["payment_status"] = "failed"
-            ordtx["status"] = "failed"
-            await ordtxdoc.put(ordtx)
+        rec = Audit.transaction_record(ordtx)
+        await Audit.write(user.store, rec, id=tid)
+
+    async def callback(self, store, event):
+
+        logger.info("Stripe event: %s", event["type"])
 
-            rec = Audit.transaction_record(ordtx)
-            await Audit.write(user.store, rec, id=tid)
+        intent = event["data"]["object"]
+        tid = intent["metadata"]["transaction"]
+        uid = intent["metadata"]["uid"]
 
+        user = store.user(uid)
+
+        if event["type"] == "payment_intent.created":
+            await self.set_status(user, tid, "created", "created")
             return
-            
-        if event["type"] == "payment_intent.processing":
 
-            ordtx["payment_status"] = "processing"
-            ordtx["status"] = "pending"
-            await ordtxdoc.put(ordtx)
+        if event["type"] == "payment_intent.canceled":
+            await self.set_status(user, tid, "cancelled", "cancelled")
+            return
 
-            rec = Audit.transaction_record(ordtx)
-            await Audit.write(user.store, rec, id=tid)
+        if event["type"] == "payment_intent.payment_failed":
+            await self.set_status(user, tid, "failed", "failed")
+            return
 
+        if event["type"] == "payment_intent.processing":
+            await self.set_status(user, tid, "pending", "processing")
             return
 
         if event["type"] != "payment_intent.succeeded":
             raise RuntimeError("Received unexpected Stripe event %s" %
                                event["type"])
 
-        ordtx["status"] = "complete"
-        ordtx["payment_status"] = "complete"
-        ordtx["complete"] = True
+        # Crediting is a shard increment, so no balance read is needed and
+        # this doesn't contend with other balance changes.  The status is
+        # checked in the transaction, so a redelivery can't credit twice.
+        @async_transactional
+        async def update_order(tx):
 
-        # This works out the balance change from the order
-        deltas = get_order_delta(ordtx["order"])
+            t = user.transaction(tid)
+            t.use_transaction(tx)
+            ordtx = await t.get()
 
-        # FIXME: Get 409 Too much contention when doing this transactionally
-        # FIXME: Get 409 error, this SHOULD be done in the transaction
-        cdoc = user.credits()
-#        cdoc.use_transaction(tx)
-        bal = await cdoc.get()
+            # Already credited, this is a redelivery
+            if ordtx["status"] == "complete":
+                return None
 
-        for kind in deltas:
-            if kind not in bal:
-                bal[kind] = 0
-            bal[kind] += deltas[kind]
+            ordtx["status"] = "complete"
+            ordtx["payment_status"] = "complete"
+            ordtx["complete"] = True
 
-        @firestore.async_transactional
-        async def update_order(tx):
+            # This works out the balance change from the order
+            deltas = get_order_delta(ordtx["order"])
 
-            await user.transaction(tid).put(ordtx)
-            await user.credits().put(bal)
+            await t.put(ordtx)
+            await user.balance().adjust(deltas, tx)
+
+            return ordtx
 
         tx = user.create_transaction()
-        await update_order(tx)
+        ordtx = await update_order(tx)
+
+        if ordtx is None:
+            logger.info("Transaction %s already complete", tid)
+            return
 
         rec = Audit.transaction_record(ordtx)
         await Audit.write(user.store, rec, id=tid)
 
+        await self.summarise(user)
+
+    async def summarise(self, user):
+        try:
+            await user.balance().summarise()
+        except Exception as e:
+            # Harmless, the next one will pick it up
+            logger.info("Balance summarise failed: %s", e)
+
     async def complete_free_order(self, user, order, uid, email):
 
         # Need to verify everything from the client side.  Can't trust
@@ -390,16 +432,10 @@ class Commerce:
         newtx["payment"] = "free"
         newtx["payment_processor"] = "Free transaction"
 
-        @firestore.async_transactional
+        @async_transactional
         async def create_order(tx, deltas, newtx):
 
-            bal = {}
-
-            c = user.credits()
-            # FIXME: Get 409 Too much contention when doing this transactionally
-            # FIXME: Get 409 error, this SHOULD be done in the transaction
-#            c.use_transaction(tx)
-            bal = await c.get()
+            bal = await user.balance().get(tx)
 
             for kind in deltas:
 
@@ -410,13 +446,11 @@ class Commerce:
                 if bal[kind] + deltas[kind] > permitted:
                     return False, "That would exceed your maximum permitted"
 
-                bal[kind] += deltas[kind]
-
-
-            # Transaction gets written out, and then new balance
-            # is not paid for yet.
-            await user.transaction(tid).put(newtx)
-            await user.credits().put(bal)
+            # Transaction gets written out, and the balance credited
+            t = user.transaction(tid)
+            t.use_transaction(tx)
+            await t.put(newtx)
+            await user.balance().adjust(deltas, tx)
 
             return True, "OK"
 
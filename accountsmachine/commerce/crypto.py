@@ -13,6 +13,9 @@ from firebase_admin import firestore
 
 from .. admin.referral import Package
 from .. audit.audit import Audit
+from .. cache import TtlCache
+from .. metrics import dependency, timed
+from .. state.store import async_transactional
 
 from . order import product, purchase_price, verify_order, get_order_delta
 from . exceptions import InvalidOrder
@@ -36,7 +39,101 @@ class Crypto:
 
         self.values = product
 
+        # Currency list and per-currency minimums rarely change.  Minimums
+        # have their own cache, keyed by a currency from the request, so
+        # they can't push the currency list out.
+        self.cache_ttl = config.get("nowpayments-cache-ttl", 3600)
+        self.cache = TtlCache(size=10, ttl=self.cache_ttl)
+        self.minimums = TtlCache(
+            size=config.get("nowpayments-cache-size", 500),
+            ttl=self.cache_ttl,
+        )
+        self.refresher = None
+
+        # Short-lived, quotes track the exchange rate
+        self.estimates = TtlCache(
+            size=config.get("nowpayments-estimate-cache-size", 1000),
+            ttl=config.get("nowpayments-estimate-ttl", 10),
+        )
+        self.estimating = {}
+
+    # Background refresh of the currency list and minimums.  Request paths
+    # read from the cache, so the checkout page doesn't wait on NOWPayments.
+    async def start(self, app=None):
+        self.refresher = asyncio.create_task(self.refresh_loop())
+
+    async def stop(self, app=None):
+        if self.refresher:
+            self.refresher.cancel()
+            self.refresher = None
+
+    async def refresh_loop(self):
+
+        while True:
+
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.info("NOWPayments cache refresh failed: %s", e)
+
+            # Refresh well before entries expire
+            await asyncio.sleep(self.cache_ttl / 2)
+
+    async def refresh(self):
+
+        self.cache.put("currencies", await self.fetch_currencies())
+
+        # Only refresh minimums somebody has asked for
+        for cur in self.minimums.keys():
+            try:
+                self.minimums.put(cur, await self.fetch_minimum(cur))
+            except Exception as e:
+                logger.info("Minimum refresh failed for %s: %s", cur, e)
+
+    # Fresh cache entry if there is one, otherwise fetch.  If the fetch
+    # fails with anything other than a rejected request, an expired entry is
+    # better than an error.
+    async def cached(self, cache, key, fetch):
+
+        try:
+            return cache.get(key)
+        except KeyError:
+            pass
+
+        try:
+            value = await fetch()
+        except InvalidOrder:
+            raise
+        except Exception as e:
+            try:
+                value = cache.get_stale(key)
+            except KeyError:
+                raise e
+            logger.info("Using stale %s: %s", key, e)
+            return value
+
+        cache.put(key, value)
+        return value
+
     async def get_currencies(self, user):
+        return await self.cached(
+            self.cache, "currencies", self.fetch_currencies
+        )
+
+    # Only currencies NOWPayments lists are looked up and cached
+    async def get_minimum(self, user, currency):
+
+        ci = await self.get_currencies(user)
+
+        if currency.lower() not in [c.lower() for c in ci["currencies"]]:
+            raise InvalidOrder("Currency %s is not supported" % currency)
+
+        return await self.cached(
+            self.minimums, currency, lambda: self.fetch_minimum(currency)
+        )
+
+    @timed("nowpayments", "currencies")
+    async def fetch_currencies(self):
 
         async with aiohttp.ClientSession() as session:
 
@@ -55,7 +152,8 @@ class Crypto:
 
             return ci
 
-    async def get_minimum(self, user, currency):
+    @timed("nowpayments", "min-amount")
+    async def fetch_minimum(self, currency):
 
         async with aiohttp.ClientSession() as session:
 
@@ -92,6 +190,37 @@ class Crypto:
         # Convert pence to pounds
         amount = order["total"] / 100
 
+        return await self.estimate(amount, currency)
+
+    # Quotes are requested as the user types, so identical concurrent
+    # requests share one upstream call, and results are reused briefly.
+    async def estimate(self, amount, currency):
+
+        key = (amount, currency)
+
+        try:
+            return self.estimates.get(key)
+        except KeyError:
+            pass
+
+        if key not in self.estimating:
+
+            task = asyncio.create_task(self.fetch_estimate(amount, currency))
+
+            def done(t):
+                self.estimating.pop(key, None)
+                if not t.cancelled() and t.exception() is None:
+                    self.estimates.put(key, t.result())
+
+            task.add_done_callback(done)
+            self.estimating[key] = task
+
+        # Shielded so one caller going away doesn't cancel it for the rest
+        return await asyncio.shield(self.estimating[key])
+
+    @timed("nowpayments", "estimate")
+    async def fetch_estimate(self, amount, currency):
+
         async with aiohttp.ClientSession() as session:
 
             url = self.nowpayments_url + "v1/estimate?%s" % urlencode({
@@ -188,27 +317,30 @@ class Crypto:
                 "x-api-key": self.nowpayments_key,
             }
 
-            async with session.post(url, data=data, headers=headers) as resp:
+            with dependency("nowpayments", "payment"):
 
-                res = await resp.json()
+                async with session.post(url, data=data, headers=headers) as resp:
 
-                print(resp.status)
+                    res = await resp.json()
 
-                if resp.status == 400:
-                    if "code" in res:
-                        if res["code"] == "INVALID_REQUEST_PARAMS":
-                            raise InvalidOrder(res["message"])
-                        if res["code"] == "AMOUNT_MINIMAL_ERROR":
+                    print(resp.status)
+
+                    if resp.status == 400:
+                        if "code" in res:
+                            if res["code"] == "INVALID_REQUEST_PARAMS":
+                                raise InvalidOrder(res["message"])
+                            if res["code"] == "AMOUNT_MINIMAL_ERROR":
+                                raise InvalidOrder(res["message"])
+                        if "message" in res:
                             raise InvalidOrder(res["message"])
-                    if "message" in res:
-                        raise InvalidOrder(res["message"])
 
-                if resp.status != 201:
-                    print(json.dumps(res, indent=4))
-                    raise RuntimeError("Order creation failed")
+                    if resp.status != 201:
+                        print(json.dumps(res, indent=4))
+                        raise RuntimeError("Order creation failed")
 
             return res
 
+    @timed("nowpayments", "payment-status")
     async def get_payment_status(self, user, id):
 
         async with aiohttp.ClientSession() as session:
@@ -233,38 +365,55 @@ class Crypto:
 
         return res
 
+    # Webhook queue handler for NOWPayments IPNs
+    async def process_event(self, state, rec):
+        await self.callback(state.user(rec["uid"]), rec["payload"])
+
     async def callback(self, user, paym):
 
         tid = paym["order_id"]
-        tx = await user.transaction(tid).get()
 
-        tx["payment_amount"] = paym["pay_amount"]
-        tx["payment_status"] = paym["payment_status"]
+        # The status check, the transaction update and the credit happen
+        # together, so a redelivered IPN can't credit the balance twice.
+        @async_transactional
+        async def update_order(tx):
+
+            t = user.transaction(tid)
+            t.use_transaction(tx)
+            ordtx = await t.get()
+
+            ordtx["payment_amount"] = paym["pay_amount"]
+            ordtx["payment_status"] = paym["payment_status"]
+
+            if ordtx["status"] == "created":
+                ordtx["status"] = "pending"
+                ordtx["payment_id"] = str(paym["payment_id"])
+
+            credited = False
 
-        # Complete the transaction if appropriate
-        if tx["status"] == "created":
-            tx["status"] = "pending"
-            tx["payment_id"] = str(paym["payment_id"])
+            if ordtx["status"] != "complete":
 
-        if tx["status"] != "complete" and paym["payment_status"] == "finished":
+                if paym["payment_status"] == "finished":
+                    ordtx["status"] = "complete"
+                    deltas = get_order_delta(ordtx["order"])
+                    await user.balance().adjust(deltas, tx)
+                    credited = True
 
-            tx["status"] = "complete"
-            deltas = get_order_delta(tx["order"])
-            
-            cdoc = user.credits()
-            bal = await cdoc.get()
+                elif paym["payment_status"] == "failed":
+                    ordtx["status"] = "failed"
 
-            for kind in deltas:
-                if kind not in bal:
-                    bal[kind] = 0
-                bal[kind] += deltas[kind]
+            await t.put(ordtx)
 
-            await cdoc.put(bal)
+            return ordtx, credited
 
-        if tx["status"] != "failed" and paym["payment_status"] == "failed":
-            tx["status"] = "failed"
+        tx = user.create_transaction()
+        ordtx, credited = await update_order(tx)
 
-        await user.transaction(tid).put(tx)
+        if credited:
+            try:
+                await user.balance().summarise()
+            except Exception as e:
+                logger.info("Balance summarise failed: %s", e)
 
-        rec = Audit.transaction_record(tx)
+        rec = Audit.transaction_record(ordtx)
         await Audit.write(user.store, rec, id=tid)
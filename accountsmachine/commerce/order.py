@@ -1,7 +1,10 @@
 
 from datetime import datetime, timezone
+import functools
 import math
 
+from . exceptions import InvalidOrder
+
 product = {
     "vat": {
         "description": "VAT return",
@@ -31,14 +34,72 @@ product = {
 def purchase_price(base, units, discount=0.98):
     return base * units * (discount ** (units - 1))
 
-# Validate order for internal integrity
-def verify_order(order, package, vat_rate):
+# Price and volume discount for a quantity, before any package discount
+def base_price(kind, units):
+
+    resource = product[kind]
+
+    price = math.floor(
+        purchase_price(resource["price"], units, resource["discount"])
+    )
+
+    discount = (resource["price"] * units) - price
+
+    return price, discount
+
+# Precomputed at import, quantities 0 up to the permitted maximum
+price_table = {
+    kind: {
+        units: base_price(kind, units)
+        for units in range(0, product[kind]["permitted"] + 1)
+    }
+    for kind in product
+}
+
+# Price and total discount for a quantity, with a package discount rate
+# (0 for none) applied.
+def item_price(kind, units, rate=0):
+
+    try:
+        price, discount = price_table[kind][units]
+    except KeyError:
+        price, discount = base_price(kind, units)
+
+    if rate:
+        adj = round(price * rate)
+        price -= adj
+        discount += adj
+
+    return price, discount
+
+# The purchasable rows for a product at a package discount rate.  There
+# are only a handful of distinct rates in use, so each is computed once.
+@functools.lru_cache(maxsize=256)
+def offer_rows(kind, rate=0):
+
+    res = product[kind]
+
+    rows = []
+    for units in [0, *range(res["min_purchase"], res["permitted"] + 1)]:
+        price, discount = item_price(kind, units, rate)
+        rows.append({
+            "price": price, "discount": discount, "quantity": units
+        })
+
+    return tuple(rows)
+
+# Package discount rate for a product, 0 if none or expired
+def package_rate(package, kind):
 
-    pkg_discount = None
     if package:
         if package.expiry > datetime.now(timezone.utc):
             if package.discount:
-                pkg_discount = package.discount
+                return getattr(package.discount, kind) or 0
+
+    return 0
+
+# Validate order for internal integrity
+def verify_order(order, package, vat_rate):
 
     subtotal = 0
 
@@ -52,22 +113,7 @@ def verify_order(order, package, vat_rate):
         if kind not in product:
             raise InvalidOrder("We don't sell you one of those.")
 
-        resource = product[kind]
-
-        price = math.floor(
-            purchase_price(
-                resource["price"], count, resource["discount"]
-            )
-        )
-
-        discount = (resource["price"] * count) - price
-
-        adj = 0
-        if pkg_discount:
-            if getattr(pkg_discount, kind):
-                adj = round(getattr(pkg_discount, kind) * price)
-                price -= adj
-                discount += adj
+        price, discount = item_price(kind, count, package_rate(package, kind))
 
         if amount != price:
             raise InvalidOrder("Wrong price")
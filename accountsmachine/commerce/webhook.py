@@ -0,0 +1,209 @@
+
+import asyncio
+import logging
+import random
+from datetime import datetime, timezone, timedelta
+
+from google.api_core.exceptions import Conflict
+
+from .. state import State
+from .. state.store import async_transactional
+
+logger = logging.getLogger("commerce.webhook")
+logger.setLevel(logging.DEBUG)
+
+# Ingest-then-process for payment provider webhooks.
+#
+# The API handler verifies the signature, then ingest() writes the event to
+# the 'webhooks' collection keyed by the provider's event ID and returns, so
+# the provider gets its 2xx after a single write.  Workers pick events up
+# from an in-memory queue, and a sweeper re-queues anything left pending
+# (failed attempts, events ingested by an instance that went away).
+#
+# Record:
+# {
+#     provider: "stripe", uid: "...", payload: { ... },
+#     state: "pending" | "processing" | "done" | "failed",
+#     attempts: 0, received: <time>, next_attempt: <time>,
+#     lease: <time>, error: "..."
+# }
+#
+# The event ID is the idempotency key: a duplicate delivery finds the
+# record already exists and is acknowledged without further work.
+
+class WebhookQueue:
+
+    def __init__(self, config, store):
+
+        self.store = store
+        self.state = State(store)
+
+        self.workers = config.get("webhook-workers", 4)
+        self.max_attempts = config.get("webhook-max-attempts", 8)
+        self.sweep_interval = config.get("webhook-sweep-interval", 30)
+        self.lease = config.get("webhook-lease", 120)
+
+        self.handlers = {}
+        self.queue = asyncio.Queue()
+        self.tasks = []
+
+    # handler is a coroutine function taking (state, record)
+    def register(self, provider, handler):
+        self.handlers[provider] = handler
+
+    async def start(self, app=None):
+        self.tasks = [
+            asyncio.create_task(self.worker())
+            for i in range(self.workers)
+        ]
+        self.tasks.append(asyncio.create_task(self.sweeper()))
+
+    async def stop(self, app=None):
+        # Anything unprocessed is still in the store, the sweeper on this or
+        # another instance will get to it.
+        for t in self.tasks:
+            t.cancel()
+        self.tasks = []
+
+    async def ingest(self, provider, id, payload, uid=None):
+
+        key = provider + ":" + id
+        now = datetime.now(timezone.utc)
+
+        rec = {
+            "provider": provider,
+            "uid": uid,
+            "payload": payload,
+            "state": "pending",
+            "attempts": 0,
+            "received": now,
+            "next_attempt": now,
+        }
+
+        try:
+            await self.state.webhook(key).create(rec)
+        except Conflict:
+            logger.info("Duplicate webhook %s ignored", key)
+            return
+
+        self.queue.put_nowait(key)
+
+    async def worker(self):
+
+        while True:
+
+            key = await self.queue.get()
+
+            try:
+                await self.process(key)
+            except Exception as e:
+                logger.error("Webhook %s: %s", key, e)
+            finally:
+                self.queue.task_done()
+
+    async def sweeper(self):
+
+        while True:
+
+            await asyncio.sleep(self.sweep_interval)
+
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.info("Webhook sweep failed: %s", e)
+
+    async def sweep(self):
+
+        now = datetime.now(timezone.utc)
+
+        recs = self.state.webhooks().stream(
+            filters=[("state", "in", ["pending", "processing"])],
+            fields=["state", "next_attempt", "lease"],
+        )
+
+        async for id, rec in recs:
+
+            if rec["state"] == "pending" and rec["next_attempt"] <= now:
+                self.queue.put_nowait(id)
+
+            # Lease ran out: the processing instance died or hung
+            if rec["state"] == "processing" and rec["lease"] <= now:
+                self.queue.put_nowait(id)
+
+    # Takes a lease on the record so that only one worker, on any instance,
+    # processes it at a time.
+    async def claim(self, key):
+
+        ref = self.state.webhook(key).doc
+
+        @async_transactional
+        async def claim(tx):
+
+            snap = await ref.get(transaction=tx)
+            if not snap.exists:
+                return None
+
+            rec = snap.to_dict()
+            now = datetime.now(timezone.utc)
+
+            if rec["state"] == "pending":
+                if rec["next_attempt"] > now:
+                    return None
+            elif rec["state"] == "processing":
+                if rec["lease"] > now:
+                    return None
+            else:
+                return None
+
+            tx.update(ref, {
+                "state": "processing",
+                "lease": now + timedelta(seconds=self.lease),
+            })
+
+            return rec
+
+        tx = self.store.docstore.db.transaction()
+        return await claim(tx)
+
+    def backoff(self, attempts):
+        delay = min(3600, 5 * (2 ** attempts))
+        return random.uniform(delay / 2, delay)
+
+    async def process(self, key):
+
+        rec = await self.claim(key)
+        if rec is None:
+            return
+
+        webhook = self.state.webhook(key)
+        attempts = rec["attempts"] + 1
+
+        try:
+            handler = self.handlers[rec["provider"]]
+            await handler(self.state, rec)
+        except Exception as e:
+
+            if attempts >= self.max_attempts:
+                logger.error("Webhook %s failed, giving up: %s", key, e)
+                state = "failed"
+            else:
+                logger.info("Webhook %s failed, attempt %d: %s",
+                            key, attempts, e)
+                state = "pending"
+
+            delay = timedelta(seconds=self.backoff(attempts))
+
+            await webhook.doc.update({
+                "state": state,
+                "attempts": attempts,
+                "error": str(e),
+                "next_attempt": datetime.now(timezone.utc) + delay,
+            })
+
+            return
+
+        await webhook.doc.update({
+            "state": "done",
+            "attempts": attempts,
+            "completed": datetime.now(timezone.utc),
+        })
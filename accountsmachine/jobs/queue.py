@@ -0,0 +1,407 @@
+
+import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime, timezone, timedelta
+
+from .. state import State
+from .. state.store import async_transactional
+from .. bus import BusHandler
+from .. tracing import span, inject, extract
+from . scheduler import Scheduler
+
+logger = logging.getLogger("jobs.queue")
+logger.setLevel(logging.DEBUG)
+
+# Durable background jobs, used for filing submissions.
+#
+# submit() writes the job to the 'jobs' collection and queues it locally.
+# A fixed pool of workers runs jobs, each under a lease which a heartbeat
+# extends while the job runs.  If the instance goes away, the lease runs
+# out and the sweeper on any instance picks the job up again.  Jobs are
+# resumed from the start, so handlers must be safe to re-run; progress()
+# records how far a job got so a handler can skip work already done.
+#
+# The worker count caps how many jobs run at once, and the Scheduler picks
+# which job runs next: earliest deadline first, with at most job-per-user
+# running for any one user.
+#
+# Record:
+# {
+#     kind: "vat", uid: "...", filing: "...", params: { ... },
+#     deadline: <time or null>,
+#     state: "pending" | "running" | "done" | "failed",
+#     attempts: 0, created: <time>, next_attempt: <time>,
+#     owner: "<instance>", lease: <time>,
+#     progress: { step: "...", message: "...", time: <time> },
+#     trace: { traceparent: "..." }, error: "..."
+# }
+
+# Raised by a handler for a failure which retrying won't fix.  The job
+# goes straight to 'failed'.
+class JobFailed(Exception):
+    pass
+
+# Handed to job handlers.  Progress, filing state changes and log lines
+# are also published on the event bus under (uid, filing) for anything
+# following the filing live.
+class RunningJob:
+
+    def __init__(self, queue, id, rec):
+        self.queue = queue
+        self.id = id
+        self.rec = rec
+
+        # Set when another instance has taken the job over
+        self.lost = False
+
+    @property
+    def uid(self):
+        return self.rec["uid"]
+
+    @property
+    def filing(self):
+        return self.rec["filing"]
+
+    @property
+    def params(self):
+        return self.rec.get("params", {})
+
+    # Last recorded step, from this or an earlier attempt
+    @property
+    def step(self):
+        return self.rec.get("progress", {}).get("step")
+
+    # True if the queue won't retry this attempt if it fails
+    @property
+    def final(self):
+        return self.rec["attempts"] >= self.queue.max_attempts
+
+    @property
+    def topic(self):
+        return (self.uid, self.filing)
+
+    def publish(self, type, **data):
+        if self.queue.bus:
+            self.queue.bus.publish(self.topic, {
+                "type": type, "job": self.id, **data
+            })
+
+    async def progress(self, step, message=None):
+
+        prog = {
+            "step": step,
+            "message": message,
+            "time": datetime.now(timezone.utc),
+        }
+
+        self.rec["progress"] = prog
+        await self.queue.state.job(self.id).doc.update({"progress": prog})
+
+        self.publish("progress", step=step, message=message)
+
+    def filing_state(self, state):
+        self.publish("state", state=state)
+
+    # For a job's own logger, publishes each line
+    def log_handler(self):
+        return BusHandler(self.queue.bus, self.topic)
+
+class JobQueue:
+
+    def __init__(self, config, store, bus=None):
+
+        self.store = store
+        self.state = State(store)
+        self.bus = bus
+
+        self.workers = config.get("job-workers", 4)
+        self.max_attempts = config.get("job-max-attempts", 3)
+        self.sweep_interval = config.get("job-sweep-interval", 30)
+        self.lease = config.get("job-lease", 60)
+
+        # Identifies this instance as the lease holder
+        self.owner = str(uuid.uuid4())
+
+        self.handlers = {}
+        self.scheduler = Scheduler(config.get("job-per-user", 1))
+        self.tasks = []
+        self.running = {}
+
+    # handler is a coroutine function taking (state, job)
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    async def start(self, app=None):
+        self.tasks = [
+            asyncio.create_task(self.worker())
+            for i in range(self.workers)
+        ]
+        self.tasks.append(asyncio.create_task(self.sweeper()))
+
+    async def stop(self, app=None):
+
+        for t in self.tasks:
+            t.cancel()
+        self.tasks = []
+
+        # Hand interrupted jobs back rather than wait for the lease to run
+        # out.  If this doesn't get done, the lease takes care of it.
+        for id, job in list(self.running.items()):
+            try:
+                await self.update_owned(id, job.rec["attempts"], {
+                    "state": "pending",
+                    "next_attempt": datetime.now(timezone.utc),
+                })
+            except Exception as e:
+                logger.info("Job %s release failed: %s", id, e)
+
+        self.running = {}
+
+    # Returns the job ID.  deadline is when the filing is due, if known.
+    async def submit(self, kind, uid, filing, params=None, deadline=None):
+
+        id = str(uuid.uuid4())
+        now = datetime.now(timezone.utc)
+
+        await self.state.job(id).create({
+            "kind": kind,
+            "uid": uid,
+            "filing": filing,
+            "params": params or {},
+            "deadline": deadline,
+            "state": "pending",
+            "attempts": 0,
+            "created": now,
+            "next_attempt": now,
+            "progress": {
+                "step": "queued", "message": None, "time": now,
+            },
+            # The job's span continues the submitting request's trace
+            "trace": inject(),
+        })
+
+        self.scheduler.put(id, uid, deadline)
+
+        return id
+
+    async def get(self, id):
+        return await self.state.job(id).get()
+
+    async def worker(self):
+
+        while True:
+
+            id = await self.scheduler.get()
+
+            try:
+                await self.process(id)
+            except Exception as e:
+                logger.error("Job %s: %s", id, e)
+            finally:
+                self.scheduler.done(id)
+
+    async def sweeper(self):
+
+        while True:
+
+            # First sweep straight away, to resume jobs orphaned by an
+            # instance which went away
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.info("Job sweep failed: %s", e)
+
+            await asyncio.sleep(self.sweep_interval)
+
+    async def sweep(self):
+
+        now = datetime.now(timezone.utc)
+
+        recs = self.state.jobs().stream(
+            filters=[("state", "in", ["pending", "running"])],
+            fields=["state", "next_attempt", "lease", "uid", "deadline"],
+        )
+
+        async for id, rec in recs:
+
+            if id in self.running:
+                continue
+
+            deadline = rec.get("deadline")
+
+            if rec["state"] == "pending" and rec["next_attempt"] <= now:
+                self.scheduler.put(id, rec["uid"], deadline)
+
+            if rec["state"] == "running" and rec["lease"] <= now:
+                logger.info("Job %s lease expired, resuming", id)
+                self.scheduler.put(id, rec["uid"], deadline)
+
+    # Takes the lease so that only one worker, on any instance, runs the job
+    async def claim(self, id):
+
+        ref = self.state.job(id).doc
+
+        @async_transactional
+        async def claim(tx):
+
+            snap = await ref.get(transaction=tx)
+            if not snap.exists:
+                return None
+
+            rec = snap.to_dict()
+            now = datetime.now(timezone.utc)
+
+            if rec["state"] == "pending":
+                if rec["next_attempt"] > now:
+                    return None
+            elif rec["state"] == "running":
+                if rec["lease"] > now:
+                    return None
+            else:
+                return None
+
+            rec["attempts"] += 1
+
+            tx.update(ref, {
+                "state": "running",
+                "owner": self.owner,
+                "attempts": rec["attempts"],
+                "lease": now + timedelta(seconds=self.lease),
+            })
+
+            return rec
+
+        tx = self.store.docstore.db.transaction()
+        return await claim(tx)
+
+    # Updates a job while this attempt holds the lease.  If the lease ran
+    # out and the job has been claimed again, nothing is written and this
+    # returns False.
+    async def update_owned(self, id, attempts, data):
+
+        ref = self.state.job(id).doc
+
+        @async_transactional
+        async def update(tx):
+
+            snap = await ref.get(transaction=tx)
+            if not snap.exists:
+                return False
+
+            rec = snap.to_dict()
+
+            if rec["state"] != "running":
+                return False
+
+            if rec.get("owner") != self.owner or rec["attempts"] != attempts:
+                return False
+
+            tx.update(ref, data)
+
+            return True
+
+        tx = self.store.docstore.db.transaction()
+        return await update(tx)
+
+    # Extends the lease while the job runs.  If the job has been taken over,
+    # the handler is stopped so the job doesn't run in two places.
+    async def heartbeat(self, job, work):
+
+        while True:
+
+            await asyncio.sleep(self.lease / 3)
+
+            try:
+                owned = await self.update_owned(job.id, job.rec["attempts"], {
+                    "lease": datetime.now(timezone.utc) +
+                    timedelta(seconds=self.lease),
+                })
+            except Exception as e:
+                logger.info("Job %s heartbeat failed: %s", job.id, e)
+                continue
+
+            if not owned:
+                logger.error("Job %s lease lost, stopping", job.id)
+                job.lost = True
+                work.cancel()
+                return
+
+    def backoff(self, attempts):
+        delay = min(600, 10 * (2 ** attempts))
+        return random.uniform(delay / 2, delay)
+
+    async def process(self, id):
+
+        if id in self.running:
+            return
+
+        rec = await self.claim(id)
+        if rec is None:
+            return
+
+        job = RunningJob(self, id, rec)
+        attempts = rec["attempts"]
+
+        self.running[id] = job
+
+        try:
+            handler = self.handlers[rec["kind"]]
+            with span("job " + rec["kind"], context=extract(rec.get("trace")),
+                      job=id, attempt=attempts):
+                work = asyncio.create_task(handler(self.state, job))
+                beat = asyncio.create_task(self.heartbeat(job, work))
+                try:
+                    await work
+                finally:
+                    beat.cancel()
+        except asyncio.CancelledError:
+
+            if not job.lost:
+                raise
+
+            # The instance which has the job now records how it ends
+            return
+
+        except Exception as e:
+
+            final = rec["attempts"] >= self.max_attempts
+
+            if final or isinstance(e, JobFailed):
+                logger.error("Job %s failed, giving up: %s", id, e)
+                state = "failed"
+            else:
+                logger.info("Job %s failed, attempt %d: %s",
+                            id, rec["attempts"], e)
+                state = "pending"
+
+            delay = timedelta(seconds=self.backoff(attempts))
+
+            owned = await self.update_owned(id, attempts, {
+                "state": state,
+                "error": str(e),
+                "next_attempt": datetime.now(timezone.utc) + delay,
+            })
+
+            if not owned:
+                logger.info("Job %s lease lost, not recording %s", id, state)
+                return
+
+            job.publish("job", state=state, error=str(e))
+
+            return
+
+        finally:
+            self.running.pop(id, None)
+
+        owned = await self.update_owned(id, attempts, {
+            "state": "done",
+            "completed": datetime.now(timezone.utc),
+        })
+
+        if not owned:
+            logger.info("Job %s lease lost, not recording done", id)
+            return
+
+        job.publish("job", state="done")
@@ -0,0 +1,118 @@
+
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger("jobs.scheduler")
+logger.setLevel(logging.INFO)
+
+# Jobs without a deadline go after all those with one
+NO_DEADLINE = datetime.max.replace(tzinfo=timezone.utc)
+
+# Picks the next job for the worker pool.  The pool size is the global
+# concurrency cap; on top of that each user may have at most per_user jobs
+# running, so one user's burst can't take every worker.  Among users with
+# room, the job with the earliest deadline goes first, ties going to the
+# user with fewest jobs running, then the user served least recently.
+class Scheduler:
+
+    def __init__(self, per_user=1):
+
+        self.per_user = per_user
+
+        # uid -> heap of (deadline, seq, id)
+        self.waiting = {}
+        self.queued = set()
+
+        # uid -> number running, id -> uid
+        self.running = {}
+        self.owners = {}
+
+        # uid -> dispatch sequence number of last job started
+        self.served = {}
+
+        self.seq = itertools.count()
+        self.wake = asyncio.Event()
+
+    def put(self, id, uid, deadline=None):
+
+        if id in self.queued or id in self.owners:
+            return
+
+        if deadline is None: deadline = NO_DEADLINE
+
+        heapq.heappush(
+            self.waiting.setdefault(uid, []), (deadline, next(self.seq), id)
+        )
+        self.queued.add(id)
+
+        self.wake.set()
+
+    def pick(self):
+
+        best = None
+
+        for uid, heap in self.waiting.items():
+
+            running = self.running.get(uid, 0)
+            if running >= self.per_user:
+                continue
+
+            deadline = heap[0][0]
+            key = (deadline, running, self.served.get(uid, -1), heap[0][1])
+
+            if best is None or key < best[0]:
+                best = (key, uid)
+
+        if best is None:
+            return None
+
+        uid = best[1]
+        heap = self.waiting[uid]
+
+        deadline, seq, id = heapq.heappop(heap)
+        if not heap:
+            del self.waiting[uid]
+
+        self.queued.discard(id)
+        self.running[uid] = self.running.get(uid, 0) + 1
+        self.owners[id] = uid
+        self.served[uid] = next(self.seq)
+
+        return id
+
+    # Waits for a job which can run now, and counts it as running
+    async def get(self):
+
+        while True:
+
+            id = self.pick()
+            if id is not None:
+                return id
+
+            # Nothing between pick() and here yields, so no wake-up is lost
+            self.wake.clear()
+            await self.wake.wait()
+
+    def done(self, id):
+
+        uid = self.owners.pop(id, None)
+        if uid is None:
+            return
+
+        self.running[uid] -= 1
+        if self.running[uid] == 0:
+            del self.running[uid]
+            if uid not in self.waiting:
+                self.served.pop(uid, None)
+
+        self.wake.set()
+
+    def metrics(self):
+        return {
+            "waiting": len(self.queued),
+            "running": len(self.owners),
+            "users-waiting": len(self.waiting),
+        }
@@ -0,0 +1,196 @@
+
+import time
+import secrets
+import logging
+import functools
+from contextlib import contextmanager
+
+from aiohttp import web
+from prometheus_client import (
+    Counter, Histogram, Gauge, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+)
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+
+from . tracing import span
+
+logger = logging.getLogger("metrics")
+logger.setLevel(logging.INFO)
+
+# Prometheus metrics.  Requests are labelled by route template
+# (/books/{id}/summary), not path, to keep the label set bounded.
+
+# Wide enough for renders and HMRC submissions
+buckets = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+    60.0,
+)
+
+requests_total = Counter(
+    "am_http_requests_total", "HTTP requests",
+    ["method", "route", "status"],
+)
+
+request_duration = Histogram(
+    "am_http_request_duration_seconds", "HTTP request latency",
+    ["method", "route"], buckets=buckets,
+)
+
+requests_in_flight = Gauge(
+    "am_http_requests_in_flight", "HTTP requests being handled",
+    ["method", "route"],
+)
+
+dependency_duration = Histogram(
+    "am_dependency_duration_seconds", "Latency of calls to other services",
+    ["dependency", "operation", "outcome"], buckets=buckets,
+)
+
+# Times a call to another service, and traces it as a span, e.g.
+#
+#     with dependency("gcs", "get"):
+#         ...
+@contextmanager
+def dependency(name, operation):
+
+    start = time.perf_counter()
+    outcome = "ok"
+
+    try:
+        with span(name + " " + operation, **{"peer.service": name}):
+            yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        dependency_duration.labels(name, operation, outcome).observe(
+            time.perf_counter() - start
+        )
+
+# The same for a whole coroutine function
+def timed(name, operation):
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def call(*args, **kwargs):
+            with dependency(name, operation):
+                return await fn(*args, **kwargs)
+        return call
+    return wrap
+
+def route_of(request):
+    route = request.match_info.route
+    if route.resource is None:
+        return "unmatched"
+    return route.resource.canonical
+
+# Exports the HMRC rate limiter's counters at scrape time
+class LimiterCollector:
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def collect(self):
+
+        m = self.limiter.metrics()
+
+        queued = GaugeMetricFamily(
+            "am_hmrc_limiter_queued", "HMRC requests waiting for a token"
+        )
+        queued.add_metric([], m["queued"])
+        yield queued
+
+        tokens = GaugeMetricFamily(
+            "am_hmrc_limiter_tokens", "HMRC rate limiter tokens available"
+        )
+        tokens.add_metric([], m["tokens"])
+        yield tokens
+
+        for name in ["requests", "retries", "throttled", "failures"]:
+            c = CounterMetricFamily(
+                "am_hmrc_" + name, "HMRC " + name, labels=["lane"]
+            )
+            for lane, v in m["lanes"].items():
+                c.add_metric([lane], v[name])
+            yield c
+
+        wait = CounterMetricFamily(
+            "am_hmrc_limiter_wait_seconds",
+            "Time spent waiting for HMRC rate limiter tokens",
+            labels=["lane"],
+        )
+        for lane, v in m["lanes"].items():
+            wait.add_metric([lane], v["wait-total"])
+        yield wait
+
+# Gauges from a function returning {name: value}, read at scrape time
+class GaugeCollector:
+
+    def __init__(self, prefix, description, fn):
+        self.prefix = prefix
+        self.description = description
+        self.fn = fn
+
+    def collect(self):
+        for name, value in self.fn().items():
+            g = GaugeMetricFamily(
+                self.prefix + "_" + name.replace("-", "_"),
+                self.description + ": " + name,
+            )
+            g.add_metric([], value)
+            yield g
+
+class Metrics:
+
+    def __init__(self, config):
+        # Scrapes need Authorization: Bearer <metrics-token>.  With no
+        # metrics-token configured, /metrics isn't served.
+        self.token = config.get("metrics-token")
+
+        if not self.token:
+            logger.info("No metrics-token, /metrics is disabled")
+
+    # Register a collector, an object with a collect() method yielding
+    # metric families
+    def register(self, collector):
+        REGISTRY.register(collector)
+
+    @web.middleware
+    async def middleware(self, request, handler):
+
+        if request.path == "/metrics":
+            return await handler(request)
+
+        method = request.method
+        route = route_of(request)
+
+        start = time.perf_counter()
+        requests_in_flight.labels(method, route).inc()
+
+        status = 500
+
+        try:
+            resp = await handler(request)
+            status = resp.status
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            requests_in_flight.labels(method, route).dec()
+            request_duration.labels(method, route).observe(
+                time.perf_counter() - start
+            )
+            requests_total.labels(method, route, str(status)).inc()
+
+    async def get(self, request):
+
+        if not self.token:
+            return web.HTTPNotFound()
+
+        auth = request.headers.get("Authorization", "")
+        if not secrets.compare_digest(auth, "Bearer " + self.token):
+            return web.HTTPUnauthorized()
+
+        return web.Response(
+            body=generate_latest(REGISTRY),
+            headers={"Content-Type": CONTENT_TYPE_LATEST},
+        )
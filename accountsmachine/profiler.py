@@ -0,0 +1,80 @@
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Sampling profiler.  A thread reads the stacks of the threads being
+# profiled every interval seconds and counts each distinct stack.  The
+# result is in folded form, one stack per line, root first:
+#
+#     main (am-svc:20);run (api.py:310);render (render.py:160) 42
+#
+# which flamegraph.pl, speedscope and similar take directly.  Sampling
+# costs a little per sample and nothing in between, so it's safe to run
+# against live traffic.
+class Sampler:
+
+    def __init__(self, interval=0.005, threads=None):
+
+        # Thread IDs to sample, None for all but the sampler itself
+        self.threads = threads
+        self.interval = interval
+
+        self.counts = Counter()
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(
+            target=self.run, name="profiler", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+
+        me = threading.get_ident()
+
+        while self.running:
+
+            for tid, frame in sys._current_frames().items():
+
+                if tid == me:
+                    continue
+
+                if self.threads is not None and tid not in self.threads:
+                    continue
+
+                self.counts[self.fold(frame)] += 1
+
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def fold(self, frame):
+
+        stack = []
+
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno
+            ))
+            frame = frame.f_back
+
+        return ";".join(reversed(stack))
+
+    def folded(self):
+        return "".join(
+            "%s %d\n" % (stack, count)
+            for stack, count in self.counts.most_common()
+        )
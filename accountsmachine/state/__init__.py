@@ -4,4 +4,6 @@ from . store import *
 from . books import *
 from . company import *
 from . filing import *
+from . balance import *
+from . ledger import *
 
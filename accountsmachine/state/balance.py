@@ -0,0 +1,123 @@
+
+import logging
+import random
+
+from firebase_admin import firestore
+
+from . store import async_transactional
+
+logger = logging.getLogger("state.balance")
+logger.setLevel(logging.INFO)
+
+# Number of counter shards per user.  Changing this strands any value held
+# in the shards above the new count, so summarise first.
+SHARDS = 4
+
+# A user's credit balance is the credits/balance document plus a set of
+# counter shards, credits/shard-N.  Changes are applied as atomic
+# increments to a random shard, so they need no read and two writers
+# rarely touch the same document.  summarise() folds the shards back into
+# the balance document in a transaction.
+#
+# Balance and shards hold the same shape:
+# {
+#     vat: 4, corptax: 1, accounts: 1,
+# }
+class CreditBalance:
+
+    def __init__(self, user):
+        self.user = user
+        self.store = user.store
+
+    def balance_ref(self):
+        return self.user.credits().doc
+
+    def shard_refs(self):
+        return [
+            self.user.credit_shard(i).doc for i in range(SHARDS)
+        ]
+
+    # Reads the balance and all shards in one round-trip.  Raises KeyError
+    # if the user has no balance at all.
+    async def get(self, tx=None):
+
+        refs = [self.balance_ref(), *self.shard_refs()]
+
+        bal = {}
+        found = False
+
+        db = self.store.docstore.db
+        async for snap in db.get_all(refs, transaction=tx):
+
+            if not snap.exists:
+                continue
+
+            found = True
+
+            for kind, value in snap.to_dict().items():
+                bal[kind] = bal.get(kind, 0) + value
+
+        if not found:
+            raise KeyError()
+
+        return bal
+
+    # Applies {kind: delta} to a random shard.  tx may be a transaction or
+    # a write batch, in which case the write is queued on it.
+    async def adjust(self, deltas, tx=None):
+
+        inc = {
+            kind: firestore.Increment(delta)
+            for kind, delta in deltas.items()
+            if delta != 0
+        }
+
+        if not inc:
+            return
+
+        shard = self.shard_refs()[random.randrange(SHARDS)]
+
+        if tx:
+            tx.set(shard, inc, merge=True)
+        else:
+            await shard.set(inc, merge=True)
+
+    # Replaces the balance outright, clearing the shards
+    async def put(self, bal):
+
+        batch = self.store.docstore.db.batch()
+
+        batch.set(self.balance_ref(), bal)
+        for ref in self.shard_refs():
+            batch.delete(ref)
+
+        await batch.commit()
+
+    async def delete(self):
+
+        batch = self.store.docstore.db.batch()
+
+        batch.delete(self.balance_ref())
+        for ref in self.shard_refs():
+            batch.delete(ref)
+
+        await batch.commit()
+
+    # Folds the shards into the balance document.  Nothing depends on this
+    # for correctness, it keeps credits/balance close to the true value.
+    async def summarise(self):
+
+        @async_transactional
+        async def fold(tx):
+
+            try:
+                bal = await self.get(tx)
+            except KeyError:
+                return
+
+            tx.set(self.balance_ref(), bal)
+            for ref in self.shard_refs():
+                tx.delete(ref)
+
+        tx = self.store.docstore.db.transaction()
+        await fold(tx)
@@ -1,5 +1,6 @@
 
 from datetime import datetime, date, timezone
+import asyncio
 import logging
 import os
 
@@ -79,21 +80,28 @@ class Books:
     async def put_mapping(self, data):
         await self.company.books_mapping().put(data)
 
+    # Yields (cid, info) for companies with books.  Info documents are
+    # fetched a batch at a time, concurrently.
     @staticmethod
-    async def get_all_info(user):
+    async def stream_all_info(user, batch=10):
 
-        cmps = await user.companies().list()
-
-        ret = {}
-
-        for cmp in cmps:
+        async def get(cid):
             try:
-                b = await user.company(cmp).books().get()
-                ret[cmp] = b
+                return cid, await user.company(cid).books().get()
             except:
-                pass
+                return cid, None
+
+        cids = await user.companies().ids()
+
+        for i in range(0, len(cids), batch):
+
+            res = await asyncio.gather(*[
+                get(cid) for cid in cids[i:i + batch]
+            ])
 
-        return ret
+            for cid, info in res:
+                if info is not None:
+                    yield cid, info
 
     async def validate(self, blob, kind):
 
@@ -22,18 +22,27 @@ class Company:
     async def get_all(user):
         return await user.companies().list()
 
+    @staticmethod
+    def stream(user):
+        return user.companies().stream()
+
+    @staticmethod
+    async def get_page(user, **query):
+        return await user.companies().page(**query)
+
     async def delete(self):
 
         filings = self.user.filings()
-        
-        for fid in await filings.list():
 
-            filing = await filings.filing(fid).get()
+        fids = [
+            fid async for fid, filing in filings.stream(
+                filters=[("company", "==", self.cid)], fields=["company"]
+            )
+        ]
 
-            if "company" in filing and filing["company"] == self.cid:
+        for fid in fids:
+            await Filing(self.user, fid).delete()
 
-                await Filing(self.user, fid).delete()
-                
 
         try:
             await self.user.company(self.cid).delete()
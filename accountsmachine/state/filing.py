@@ -17,8 +17,12 @@ class Filing():
         await self.user.filing(self.fid).put(data)
 
     @staticmethod
-    async def get_all(user):
-        return await user.filings().list()
+    def stream(user):
+        return user.filings().stream()
+
+    @staticmethod
+    async def get_page(user, **query):
+        return await user.filings().page(**query)
 
     async def delete(self):
         await self.user.filing(self.fid).delete()
@@ -45,8 +49,26 @@ class Filing():
     async def get_data(self):
         return await self.user.filing(self.fid).data().get()
 
+    # The status report.  Submissions which write a log have it built
+    # from the log entries.
     async def get_status(self):
-        return await self.user.filing(self.fid).status().get()
+
+        try:
+            return await self.user.filing(self.fid).status().get()
+        except KeyError:
+            pass
+
+        entries, offset = await self.get_log(limit=10000)
+
+        if not entries:
+            raise KeyError()
+
+        return {
+            "report": "".join(ent["message"] + "\n" for ent in entries)
+        }
+
+    async def get_log(self, offset=0, limit=500):
+        return await self.user.filing(self.fid).log().read(offset, limit)
 
     async def set_state(self, state):
 
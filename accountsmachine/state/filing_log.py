@@ -0,0 +1,98 @@
+
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger("state.filing_log")
+logger.setLevel(logging.INFO)
+
+# Logging handler writing to a filing's submission log (FilingLog).
+# Entries are numbered as they're logged and written in batches, once
+# batch_size have built up or interval seconds after the first unwritten
+# one, so a reader following the log sees progress during a submission.
+# Batches are written one after another: a reader following the log
+# carries on from the last entry it saw, so a batch landing late would be
+# skipped.  close() writes anything left.
+#
+# Must be used from the event loop thread.
+class FilingLogHandler(logging.Handler):
+
+    def __init__(self, filing, batch_size=20, interval=1.0, attempts=3):
+        super().__init__()
+        self.log = filing.log()
+        self.batch_size = batch_size
+        self.interval = interval
+        self.attempts = attempts
+        self.seq = 0
+        self.pending = []
+        self.timer = None
+        self.tasks = set()
+        self.last = None
+
+    def emit(self, record):
+
+        try:
+            self.pending.append({
+                "seq": self.seq,
+                "time": datetime.fromtimestamp(record.created, timezone.utc),
+                "level": record.levelname,
+                "message": self.format(record),
+            })
+        except Exception:
+            self.handleError(record)
+            return
+
+        self.seq += 1
+
+        if len(self.pending) >= self.batch_size:
+            self.schedule()
+        elif self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(self.interval, self.schedule)
+
+    def schedule(self):
+
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.pending:
+            return
+
+        entries, self.pending = self.pending, []
+
+        task = asyncio.create_task(self.write(entries, self.last))
+        self.last = task
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # Waits for the previous batch, so batches land in order.  A failed
+    # write is retried before the next batch goes, as a gap would be
+    # skipped by a reader following the log.
+    async def write(self, entries, prev):
+
+        if prev:
+            await prev
+
+        for attempt in range(self.attempts):
+
+            batch = self.log.store.docstore.db.batch()
+            for ent in entries:
+                batch.set(self.log.entry_ref(ent["seq"]), ent)
+
+            try:
+                await batch.commit()
+                return
+            except Exception as e:
+                logger.error("Filing log write failed: %s", e)
+
+            await asyncio.sleep(0.5 * (attempt + 1))
+
+        logger.error("Filing log entries %d-%d lost",
+                     entries[0]["seq"], entries[-1]["seq"])
+
+    async def close(self):
+        self.schedule()
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        super().close()
@@ -0,0 +1,183 @@
+
+import logging
+import uuid
+
+from firebase_admin import firestore
+
+from . balance import CreditBalance
+from . store import async_transactional
+
+logger = logging.getLogger("state.ledger")
+logger.setLevel(logging.INFO)
+
+# Ledger mode for credit balances.  Every credit movement is an immutable
+# entry in users/{uid}/ledger, and credits/snapshot holds the balance
+# folded up to some point.  The balance is the snapshot plus the entries
+# after it, and summarise() moves the snapshot forward once the tail gets
+# long, so reads touch a bounded number of documents.
+#
+# Entry, either a change or an absolute setting:
+# {
+#     time: <server timestamp>,
+#     deltas: { vat: -1 },
+# }
+# {
+#     time: <server timestamp>,
+#     set: { vat: 6, corptax: 1, accounts: 1 },
+# }
+#
+# Snapshot:
+# {
+#     balance: { vat: 5, corptax: 1, accounts: 1 },
+#     as_of: <time of last folded entry>,
+#     as_of_ids: [ ids of folded entries with time == as_of ],
+#     entries: 12,
+# }
+#
+# Server timestamps can collide, hence as_of_ids: the tail is entries at
+# or after as_of, less those already folded.
+#
+# A user with no snapshot takes their opening balance from the sharded
+# balance, so switching an existing deployment to ledger mode needs no
+# migration.
+
+def fold(bal, entry):
+
+    if "set" in entry:
+        return dict(entry["set"])
+
+    for kind, delta in entry["deltas"].items():
+        bal[kind] = bal.get(kind, 0) + delta
+
+    return bal
+
+class CreditLedger:
+
+    def __init__(self, user):
+        self.user = user
+        self.store = user.store
+        self.interval = user.store.snapshot_interval
+
+    def snapshot_ref(self):
+        return self.user.doc.collection("credits").document("snapshot")
+
+    def ledger(self):
+        return self.user.doc.collection("ledger")
+
+    # Returns the opening balance (or None), the list of tail entries in
+    # time order and the snapshot itself.
+    async def read(self, tx=None):
+
+        snap = await self.snapshot_ref().get(transaction=tx)
+
+        if snap.exists:
+            snapshot = snap.to_dict()
+            opening = dict(snapshot["balance"])
+            done = set(snapshot["as_of_ids"])
+            qry = self.ledger().where("time", ">=", snapshot["as_of"])
+        else:
+            snapshot = None
+            try:
+                opening = await CreditBalance(self.user).get(tx)
+            except KeyError:
+                opening = None
+            done = set()
+            qry = self.ledger()
+
+        qry = qry.order_by("time")
+
+        tail = [
+            (doc.id, doc.to_dict())
+            for doc in await qry.get(transaction=tx)
+            if doc.id not in done
+        ]
+
+        return opening, tail, snapshot
+
+    async def get(self, tx=None):
+
+        opening, tail, snapshot = await self.read(tx)
+
+        if opening is None and not tail:
+            raise KeyError()
+
+        bal = opening or {}
+        for id, entry in tail:
+            bal = fold(bal, entry)
+
+        return bal
+
+    async def append(self, entry, tx=None):
+
+        entry["time"] = firestore.SERVER_TIMESTAMP
+        ref = self.ledger().document(str(uuid.uuid4()))
+
+        if tx:
+            tx.create(ref, entry)
+            return
+
+        await ref.create(entry)
+
+    # tx may be a transaction or a write batch
+    async def adjust(self, deltas, tx=None):
+
+        deltas = {
+            kind: delta for kind, delta in deltas.items() if delta != 0
+        }
+
+        if not deltas:
+            return
+
+        await self.append({"deltas": deltas}, tx)
+
+    async def put(self, bal):
+        await self.append({"set": dict(bal)})
+
+    async def delete(self):
+
+        async for doc in self.ledger().stream():
+            await doc.reference.delete()
+
+        await self.snapshot_ref().delete()
+
+        # Anything left from before ledger mode
+        await CreditBalance(self.user).delete()
+
+    # Entries in time order, for audit replay
+    async def history(self):
+        async for doc in self.ledger().order_by("time").stream():
+            yield doc.id, doc.to_dict()
+
+    # Moves the snapshot forward once enough entries have built up
+    async def summarise(self):
+
+        @async_transactional
+        async def snapshot(tx):
+
+            opening, tail, snap = await self.read(tx)
+
+            if len(tail) < self.interval:
+                return
+
+            bal = opening or {}
+            for id, entry in tail:
+                bal = fold(bal, entry)
+
+            as_of = tail[-1][1]["time"]
+            ids = [id for id, entry in tail if entry["time"] == as_of]
+            count = len(tail)
+
+            if snap:
+                count += snap["entries"]
+                if snap["as_of"] == as_of:
+                    ids = snap["as_of_ids"] + ids
+
+            tx.set(self.snapshot_ref(), {
+                "balance": bal,
+                "as_of": as_of,
+                "as_of_ids": ids,
+                "entries": count,
+            })
+
+        tx = self.store.docstore.db.transaction()
+        await snapshot(tx)
@@ -0,0 +1,593 @@
+
+import base64
+import functools
+import json
+import logging
+import operator
+import sqlite3
+import uuid
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import Conflict, NotFound, Aborted
+from firebase_admin import firestore
+
+logger = logging.getLogger("state.local")
+logger.setLevel(logging.INFO)
+
+# Local stand-ins for the Firestore AsyncClient, for running the service
+# with no cloud project: load tests, benchmarks, CI.  They implement the
+# part of the client API this code base uses - documents, collections,
+# queries with where/order_by/select/start_after/limit, write batches,
+# transactions, get_all, Increment, SERVER_TIMESTAMP, DELETE_FIELD and
+# collection listeners - with the same results.
+#
+# Transactions are optimistic: a transaction remembers the version of
+# every document it read, and its commit fails and is retried if any of
+# them changed meanwhile.  Commits are applied without yielding to the
+# event loop, so a commit is atomic.  Phantom reads (a query which would
+# now return another document) aren't detected.
+#
+# State is per-process.  SqliteClient writes through to a file so that
+# data survives a restart, but two processes on one file don't see each
+# other's writes.
+
+MAX_ATTEMPTS = 5
+
+def clone(v):
+    # Not deepcopy: sentinels like SERVER_TIMESTAMP are compared by
+    # identity
+    if isinstance(v, dict):
+        return {k: clone(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [clone(x) for x in v]
+    return v
+
+def get_field(data, path):
+    for part in path.split("."):
+        if not isinstance(data, dict) or part not in data:
+            raise KeyError(path)
+        data = data[part]
+    return data
+
+# Resolves sentinels in a value being written, old being the value it
+# replaces
+def resolve(v, old=None):
+
+    if v is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+
+    if isinstance(v, firestore.Increment):
+        if isinstance(old, (int, float)) and not isinstance(old, bool):
+            return old + v.value
+        return v.value
+
+    if isinstance(v, dict):
+        return {
+            k: resolve(x) for k, x in v.items()
+            if x is not firestore.DELETE_FIELD
+        }
+
+    return clone(v)
+
+# set(..., merge=True): maps are merged, everything else replaced
+def merge(old, new):
+
+    out = clone(old)
+
+    for k, v in new.items():
+        if v is firestore.DELETE_FIELD:
+            out.pop(k, None)
+        elif isinstance(v, dict) and isinstance(out.get(k), dict):
+            out[k] = merge(out[k], v)
+        else:
+            out[k] = resolve(v, out.get(k))
+
+    return out
+
+# update(): keys are field paths
+def update(old, fields):
+
+    out = clone(old)
+
+    for path, v in fields.items():
+
+        parts = path.split(".")
+        data = out
+        for part in parts[:-1]:
+            if not isinstance(data.get(part), dict):
+                data[part] = {}
+            data = data[part]
+
+        if v is firestore.DELETE_FIELD:
+            data.pop(parts[-1], None)
+        else:
+            data[parts[-1]] = resolve(v, data.get(parts[-1]))
+
+    return out
+
+def project(data, fields):
+    out = {}
+    for path in fields:
+        try:
+            v = get_field(data, path)
+        except KeyError:
+            continue
+        parts = path.split(".")
+        d = out
+        for part in parts[:-1]:
+            d = d.setdefault(part, {})
+        d[parts[-1]] = clone(v)
+    return out
+
+# Firestore orders values of different types by type first
+def order_key(v):
+    if v is None: return (0, 0)
+    if isinstance(v, bool): return (1, v)
+    if isinstance(v, (int, float)): return (2, v)
+    if isinstance(v, datetime): return (3, v)
+    if isinstance(v, str): return (4, v)
+    if isinstance(v, bytes): return (5, v)
+    return (6, json.dumps(v, sort_keys=True, default=str))
+
+ops = {
+    "==": operator.eq, "!=": operator.ne,
+    "<": operator.lt, "<=": operator.le,
+    ">": operator.gt, ">=": operator.ge,
+}
+
+def has_field(data, field):
+    try:
+        get_field(data, field)
+        return True
+    except KeyError:
+        return False
+
+def matches(data, field, op, value):
+
+    # A filter never matches a document without the field
+    try:
+        v = get_field(data, field)
+    except KeyError:
+        return False
+
+    if op == "in":
+        return any(order_key(v) == order_key(x) for x in value)
+    if op == "not-in":
+        return all(order_key(v) != order_key(x) for x in value)
+    if op == "array_contains":
+        return isinstance(v, list) and value in v
+    if op == "array_contains_any":
+        return isinstance(v, list) and any(x in v for x in value)
+
+    if op not in ops:
+        raise ValueError("Unsupported operator: %s" % op)
+
+    a, b = order_key(v), order_key(value)
+
+    # Range filters only match values of the same type
+    if op not in ("==", "!=") and a[0] != b[0]:
+        return False
+
+    return ops[op](a, b)
+
+class DocumentSnapshot:
+
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return clone(self.data)
+
+    def get(self, field):
+        return clone(get_field(self.data, field))
+
+class DocumentReference:
+
+    def __init__(self, client, coll, id):
+        self.client = client
+        self.coll = coll
+        self.id = id
+        self.path = coll + "/" + id
+
+    @property
+    def parent(self):
+        return CollectionReference(self.client, self.coll)
+
+    def collection(self, name):
+        return CollectionReference(self.client, self.path + "/" + name)
+
+    async def get(self, transaction=None):
+        if transaction:
+            return transaction.read(self)
+        return self.client.read(self)
+
+    async def set(self, data, merge=False):
+        await self.client.batch().set(self, data, merge).commit()
+
+    async def create(self, data):
+        await self.client.batch().create(self, data).commit()
+
+    async def update(self, data):
+        await self.client.batch().update(self, data).commit()
+
+    async def delete(self):
+        await self.client.batch().delete(self).commit()
+
+class Query:
+
+    def __init__(self, client, coll, filters=(), orders=(), fields=None,
+                 cursor=None, count=None):
+        self.client = client
+        self.coll = coll
+        self.filters = filters
+        self.orders = orders
+        self.fields = fields
+        self.cursor = cursor
+        self.count = count
+
+    def copy(self, **kwargs):
+        args = {
+            "filters": self.filters, "orders": self.orders,
+            "fields": self.fields, "cursor": self.cursor,
+            "count": self.count,
+        }
+        args.update(kwargs)
+        return Query(self.client, self.coll, **args)
+
+    def where(self, field, op, value):
+        return self.copy(filters=self.filters + ((field, op, value),))
+
+    def order_by(self, field, direction=firestore.Query.ASCENDING):
+        return self.copy(orders=self.orders + ((field, direction),))
+
+    def select(self, fields):
+        return self.copy(fields=list(fields))
+
+    # Only document snapshots are supported as cursors
+    def start_after(self, snapshot):
+        return self.copy(cursor=(snapshot.id, snapshot.data))
+
+    def limit(self, count):
+        return self.copy(count=count)
+
+    def compare(self, a, b):
+
+        for field, direction in self.orders:
+
+            x = order_key(get_field(a[1], field))
+            y = order_key(get_field(b[1], field))
+
+            if x != y:
+                r = -1 if x < y else 1
+                if direction == firestore.Query.DESCENDING:
+                    r = -r
+                return r
+
+        return (a[0] > b[0]) - (a[0] < b[0])
+
+    def run(self, transaction=None):
+
+        docs = self.client.colls.get(self.coll, {}).items()
+
+        for field, op, value in self.filters:
+            docs = [d for d in docs if matches(d[1], field, op, value)]
+
+        # Ordering on a field leaves out documents without it
+        for field, direction in self.orders:
+            docs = [d for d in docs if has_field(d[1], field)]
+
+        docs = sorted(docs, key=functools.cmp_to_key(self.compare))
+
+        if self.cursor:
+            docs = [d for d in docs if self.compare(d, self.cursor) > 0]
+
+        if self.count is not None:
+            docs = docs[:self.count]
+
+        snaps = []
+
+        for id, data in docs:
+
+            ref = DocumentReference(self.client, self.coll, id)
+
+            if transaction:
+                transaction.watch(ref)
+
+            if self.fields is not None:
+                data = project(data, self.fields)
+            else:
+                data = clone(data)
+
+            snaps.append(DocumentSnapshot(ref, data))
+
+        return snaps
+
+    async def get(self, transaction=None):
+        return self.run(transaction)
+
+    async def stream(self, transaction=None):
+        for snap in self.run(transaction):
+            yield snap
+
+class CollectionReference(Query):
+
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.path = path
+        self.id = path.split("/")[-1]
+
+    def document(self, id=None):
+        if id is None:
+            id = uuid.uuid4().hex[:20]
+        return DocumentReference(self.client, self.path, id)
+
+    # Like Firestore, includes IDs which have subcollections but no
+    # document
+    async def list_documents(self):
+
+        ids = set(self.client.colls.get(self.path, {}))
+
+        prefix = self.path + "/"
+        for coll, docs in self.client.colls.items():
+            if docs and coll.startswith(prefix):
+                ids.add(coll[len(prefix):].split("/")[0])
+
+        for id in sorted(ids):
+            yield self.document(id)
+
+    # Calls back with the collection's documents now and after every
+    # change, like the sync client's on_snapshot
+    def on_snapshot(self, callback):
+        return self.client.listen(self.path, callback)
+
+class Watch:
+
+    def __init__(self, client, coll, callback):
+        self.client = client
+        self.coll = coll
+        self.callback = callback
+
+    def unsubscribe(self):
+        listeners = self.client.listeners.get(self.coll, [])
+        if self in listeners:
+            listeners.remove(self)
+
+class WriteBatch:
+
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append(("set", ref, clone(data), merge))
+        return self
+
+    def create(self, ref, data):
+        self.writes.append(("create", ref, clone(data), False))
+        return self
+
+    def update(self, ref, data):
+        self.writes.append(("update", ref, clone(data), False))
+        return self
+
+    def delete(self, ref):
+        self.writes.append(("delete", ref, None, False))
+        return self
+
+    async def commit(self):
+        writes, self.writes = self.writes, []
+        self.client.apply(writes)
+
+class Transaction(WriteBatch):
+
+    def __init__(self, client, max_attempts=MAX_ATTEMPTS):
+        super().__init__(client)
+        self.max_attempts = max_attempts
+        self.reads = {}
+
+    # Remembers the version of a document read in the transaction
+    def watch(self, ref):
+        self.reads.setdefault(ref.path, self.client.version(ref.path))
+
+    def read(self, ref):
+        self.watch(ref)
+        return self.client.read(ref)
+
+    def commit_if_unchanged(self):
+
+        for path, version in self.reads.items():
+            if self.client.version(path) != version:
+                return False
+
+        writes, self.writes = self.writes, []
+        self.client.apply(writes)
+        return True
+
+    # What firestore.async_transactional does for a Firestore transaction
+    async def run(self, fn, *args, **kwargs):
+
+        for attempt in range(self.max_attempts):
+
+            self.writes = []
+            self.reads = {}
+
+            result = await fn(self, *args, **kwargs)
+
+            if self.commit_if_unchanged():
+                return result
+
+            logger.debug("Transaction contention, retrying")
+
+        raise Aborted("Transaction failed after %d attempts" %
+                      self.max_attempts)
+
+class MemoryClient:
+
+    def __init__(self):
+
+        # Collection path -> {document ID: data}
+        self.colls = {}
+
+        # Document path -> sequence number of its last write
+        self.versions = {}
+        self.seq = 0
+
+        # Collection path -> [Watch]
+        self.listeners = {}
+
+    def collection(self, path):
+        return CollectionReference(self, path)
+
+    def document(self, path):
+        coll, id = path.rsplit("/", 1)
+        return DocumentReference(self, coll, id)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self, max_attempts=MAX_ATTEMPTS):
+        return Transaction(self, max_attempts)
+
+    async def get_all(self, refs, transaction=None):
+        for ref in refs:
+            if transaction:
+                yield transaction.read(ref)
+            else:
+                yield self.read(ref)
+
+    def read(self, ref):
+        data = self.colls.get(ref.coll, {}).get(ref.id)
+        return DocumentSnapshot(ref, clone(data))
+
+    def version(self, path):
+        return self.versions.get(path, 0)
+
+    # Applies a list of writes all or nothing
+    def apply(self, writes):
+
+        changes = {}
+
+        for op, ref, data, merge_fields in writes:
+
+            if ref.path in changes:
+                old = changes[ref.path][1]
+            else:
+                old = self.colls.get(ref.coll, {}).get(ref.id)
+
+            if op == "create":
+                if old is not None:
+                    raise Conflict("Document already exists: %s" % ref.path)
+                new = resolve(data)
+            elif op == "set":
+                if merge_fields and old is not None:
+                    new = merge(old, data)
+                else:
+                    new = resolve(data)
+            elif op == "update":
+                if old is None:
+                    raise NotFound("No document to update: %s" % ref.path)
+                new = update(old, data)
+            else:
+                new = None
+
+            changes[ref.path] = (ref, new)
+
+        for ref, data in changes.values():
+
+            coll = self.colls.setdefault(ref.coll, {})
+
+            if data is None:
+                coll.pop(ref.id, None)
+            else:
+                coll[ref.id] = data
+
+            self.seq += 1
+            self.versions[ref.path] = self.seq
+
+        self.persist(changes.values())
+
+        for coll in set(ref.coll for ref, data in changes.values()):
+            for w in list(self.listeners.get(coll, [])):
+                self.notify(w)
+
+    # Writes committed changes somewhere durable
+    def persist(self, changes):
+        pass
+
+    def listen(self, coll, callback):
+        w = Watch(self, coll, callback)
+        self.listeners.setdefault(coll, []).append(w)
+        self.notify(w)
+        return w
+
+    def notify(self, w):
+
+        docs = [
+            DocumentSnapshot(DocumentReference(self, w.coll, id), clone(data))
+            for id, data in sorted(self.colls.get(w.coll, {}).items())
+        ]
+
+        try:
+            w.callback(docs, [], datetime.now(timezone.utc))
+        except Exception as e:
+            logger.error("Listener on %s failed: %s", w.coll, e)
+
+def encode(obj):
+    if isinstance(obj, datetime):
+        return {"$time": obj.isoformat()}
+    if isinstance(obj, bytes):
+        return {"$bytes": base64.b64encode(obj).decode("utf-8")}
+    raise TypeError("Not serialisable: %s" % type(obj).__name__)
+
+def decode(obj):
+    if len(obj) == 1 and "$time" in obj:
+        return datetime.fromisoformat(obj["$time"])
+    if len(obj) == 1 and "$bytes" in obj:
+        return base64.b64decode(obj["$bytes"])
+    return obj
+
+# MemoryClient, with every commit written through to an SQLite file.  The
+# file is read in full at startup, queries run from memory.
+class SqliteClient(MemoryClient):
+
+    def __init__(self, path):
+
+        super().__init__()
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            "coll TEXT, id TEXT, data TEXT, PRIMARY KEY (coll, id))"
+        )
+
+        count = 0
+        for coll, id, data in self.conn.execute(
+                "SELECT coll, id, data FROM docs"
+        ):
+            self.colls.setdefault(coll, {})[id] = json.loads(
+                data, object_hook=decode
+            )
+            count += 1
+
+        logger.info("Loaded %d documents from %s", count, path)
+
+    def persist(self, changes):
+
+        with self.conn:
+            for ref, data in changes:
+                if data is None:
+                    self.conn.execute(
+                        "DELETE FROM docs WHERE coll = ? AND id = ?",
+                        (ref.coll, ref.id)
+                    )
+                else:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO docs VALUES (?, ?, ?)",
+                        (ref.coll, ref.id, json.dumps(data, default=encode))
+                    )
+
+    def close(self):
+        self.conn.close()
@@ -2,6 +2,13 @@
 import base64
 import logging
 
+from firebase_admin import firestore
+
+from .. metrics import dependency
+
+from . balance import CreditBalance
+from . ledger import CreditLedger
+
 logger = logging.getLogger("state.state")
 logger.setLevel(logging.INFO)
 
@@ -13,25 +20,97 @@ class DocObject:
         self.store = store
         self.tx = tx
     async def get(self):
-        ref = await self.doc.get(transaction=self.tx)
+        with dependency("firestore", "get"):
+            ref = await self.doc.get(transaction=self.tx)
         if not ref.exists:
             raise KeyError()
         return ref.to_dict()
     async def put(self, obj):
-        await self.doc.set(obj)
+        # Inside a transaction, writes must go through it.  Writing around
+        # a transaction that holds a read lock on the same document is what
+        # produces 409 contention errors.
+        if self.tx:
+            self.tx.set(self.doc, obj)
+            return
+        with dependency("firestore", "set"):
+            await self.doc.set(obj)
+    async def create(self, obj):
+        # Fails with google.api_core.exceptions.Conflict if it exists
+        with dependency("firestore", "create"):
+            await self.doc.create(obj)
 #    async def update(self, obj):
 #        await self.doc.set(obj)
     async def delete(self):
-        await self.doc.delete()
+        with dependency("firestore", "delete"):
+            await self.doc.delete()
     def create_transaction(self):
         return self.store.docstore.db.transaction()
     def use_transaction(self, tx):
         self.tx = tx
 
 class CollObject:
-    async def list(self):
-        all = await self.coll.get()
-        return {v.id: v.to_dict() for v in all}
+
+    # filters is a list of (field, op, value).  With no order_by, documents
+    # come back in ID order.
+    def query(self, filters=None, order_by=None, descending=False,
+              fields=None):
+
+        qry = self.coll
+
+        for field, op, value in filters or []:
+            qry = qry.where(field, op, value)
+
+        if order_by:
+            if descending:
+                qry = qry.order_by(
+                    order_by, direction=firestore.Query.DESCENDING
+                )
+            else:
+                qry = qry.order_by(order_by)
+
+        if fields:
+            qry = qry.select(fields)
+
+        return qry
+
+    async def list(self, **query):
+        with dependency("firestore", "list"):
+            return {
+                doc.id: doc.to_dict()
+                async for doc in self.query(**query).stream()
+            }
+
+    # Yields (id, data) pairs without materialising the collection
+    async def stream(self, **query):
+        async for doc in self.query(**query).stream():
+            yield doc.id, doc.to_dict()
+
+    # Document IDs only, no document data is read
+    async def ids(self):
+        return [ref.id async for ref in self.coll.list_documents()]
+
+    # One page of results.  cursor is the ID of the last document on the
+    # previous page.  Returns the page and the cursor for the next one,
+    # None at the end.
+    async def page(self, limit=50, cursor=None, **query):
+
+        qry = self.query(**query)
+
+        if cursor:
+            last = await self.coll.document(cursor).get()
+            if not last.exists:
+                raise KeyError(cursor)
+            qry = qry.start_after(last)
+
+        with dependency("firestore", "page"):
+            docs = [doc async for doc in qry.limit(limit).stream()]
+
+        if len(docs) == limit:
+            next = docs[-1].id
+        else:
+            next = None
+
+        return {doc.id: doc.to_dict() for doc in docs}, next
         
 class User(DocObject):
     def __init__(self, store, uid):
@@ -54,6 +133,14 @@ class User(DocObject):
     def credits(self, id=None):
         return Credits(self, self.store, self.doc, id)
 
+    def credit_shard(self, n):
+        return CreditShard(self, self.store, self.doc, n)
+
+    def balance(self):
+        if self.store.credit_mode == "ledger":
+            return CreditLedger(self)
+        return CreditBalance(self)
+
     def transactions(self):
         return Transactions(self, self.store, self.doc)
 
@@ -75,8 +162,7 @@ class User(DocObject):
 
         # Delete companies
         try:
-            ids = await self.companies().list()
-            ids = ids.keys()
+            ids = await self.companies().ids()
 
             for id in ids:
                 try:
@@ -88,8 +174,7 @@ class User(DocObject):
 
         # Delete filings
         try:
-            ids = await self.filings().list()
-            ids = ids.keys()
+            ids = await self.filings().ids()
 
             for id in ids:
                 try:
@@ -101,8 +186,7 @@ class User(DocObject):
 
         # Delete transactions
         try:
-            ids = await self.transactions().list()
-            ids = ids.keys()
+            ids = await self.transactions().ids()
 
             for id in ids:
                 try:
@@ -119,8 +203,7 @@ class User(DocObject):
 
         # Delete packages
         try:
-            ids = await self.packages().list()
-            ids = ids.keys()
+            ids = await self.packages().ids()
 
             for id in ids:
                 try:
@@ -134,7 +217,7 @@ class User(DocObject):
 
         try:
             logger.info("Deleting credits")
-            await self.credits().delete()
+            await self.balance().delete()
         except: pass
 
         logger.info("Deleting user object")
@@ -150,6 +233,12 @@ class Credits(DocObject):
         else:
             self.doc = self.store.docstore.db.collection("users").document(id)
 
+class CreditShard(DocObject):
+    def __init__(self, user, store, doc, n):
+        super().__init__(store)
+        self.user = user
+        self.doc = doc.collection("credits").document("shard-%d" % n)
+
 class Companies(CollObject):
     def __init__(self, user, store, userdoc):
         self.user = user
@@ -253,6 +342,9 @@ class Filing(DocObject):
     def status(self):
         return FilingStatus(self.store, self.doc)
 
+    def log(self):
+        return FilingLog(self.store, self.doc)
+
     def data(self):
         return FilingData(self.store, self.doc)
 
@@ -278,6 +370,9 @@ class Filing(DocObject):
         try:
             await self.status().delete()
         except: pass
+        try:
+            await self.log().delete()
+        except: pass
         try:
             await self.data().delete()
         except: pass
@@ -296,6 +391,40 @@ class FilingStatus(DocObject):
         super().__init__(store)
         self.doc = doc.collection("output").document("status")
 
+# Submission log, one document per entry keyed by sequence number:
+# { seq: 0, time: <time>, level: "INFO", message: "..." }
+class FilingLog(CollObject):
+    def __init__(self, store, doc):
+        self.store = store
+        self.coll = doc.collection("log")
+
+    def entry_ref(self, seq):
+        return self.coll.document("%08d" % seq)
+
+    # Entries from offset on, and the offset to read from next time
+    async def read(self, offset=0, limit=500):
+
+        qry = self.query(
+            filters=[("seq", ">=", offset)], order_by="seq"
+        ).limit(limit)
+
+        entries = [doc.to_dict() async for doc in qry.stream()]
+
+        if entries:
+            offset = entries[-1]["seq"] + 1
+
+        return entries, offset
+
+    async def delete(self):
+
+        refs = [ref async for ref in self.coll.list_documents()]
+
+        for i in range(0, len(refs), 500):
+            batch = self.store.docstore.db.batch()
+            for ref in refs[i:i + 500]:
+                batch.delete(ref)
+            await batch.commit()
+
 class FilingData(DocObject):
     def __init__(self, store, doc):
         super().__init__(store)
@@ -310,6 +439,31 @@ class Transactions(CollObject):
     def transaction(self, tid):
         return Transaction(self.user, self.store, self.doc, tid)
 
+    # One page of transactions, most recent first.  Equality filters
+    # combined with the time ordering need the composite indexes in
+    # pulumi/index.ts.
+    async def page(self, limit=50, cursor=None, type=None, status=None,
+                   kind=None, start=None, end=None, fields=None):
+
+        filters = [
+            (field, "==", value)
+            for field, value in [
+                    ("type", type), ("status", status), ("kind", kind)
+            ]
+            if value is not None
+        ]
+
+        if start is not None:
+            filters.append(("time", ">=", start))
+
+        if end is not None:
+            filters.append(("time", "<", end))
+
+        return await super().page(
+            limit=limit, cursor=cursor, filters=filters, order_by="time",
+            descending=True, fields=fields,
+        )
+
 class Transaction(DocObject):
     def __init__(self, user, store, userdoc, tid):
         super().__init__(store)
@@ -438,6 +592,85 @@ class Log(DocObject):
         self.id = id
         self.doc = store.collection("log").document(id)
 
+class Logs(CollObject):
+    def __init__(self, store):
+        self.store = store
+        self.coll = store.collection("log")
+
+    # Yields lists of (id, record) in time order, chunk records at a time.
+    # Each chunk is a separate query starting after the last document of
+    # the previous one, so memory use is bounded by the chunk size however
+    # much matches.  Equality on type/uid with the time range needs the
+    # composite indexes on the log collection.
+    async def scan(self, start=None, end=None, type=None, uid=None,
+                   chunk=1000):
+
+        filters = []
+        if type: filters.append(("type", "==", type))
+        if uid: filters.append(("uid", "==", uid))
+        if start: filters.append(("time", ">=", start))
+        if end: filters.append(("time", "<", end))
+
+        qry = self.query(filters=filters, order_by="time")
+        last = None
+
+        while True:
+
+            q = qry
+            if last: q = q.start_after(last)
+
+            docs = [doc async for doc in q.limit(chunk).stream()]
+
+            if docs:
+                yield [(doc.id, doc.to_dict()) for doc in docs]
+
+            if len(docs) < chunk:
+                break
+
+            last = docs[-1]
+
+# Referral offers, keyed by referral code
+class ReferralOffers(CollObject):
+    def __init__(self, store):
+        self.store = store
+        self.coll = store.collection("referrals")
+    def offer(self, id):
+        return ReferralOffer(self.store, id)
+
+class ReferralOffer(DocObject):
+    def __init__(self, store, id):
+        super().__init__(store)
+        self.id = id
+        self.doc = store.collection("referrals").document(id)
+
+# Received payment provider webhooks, keyed by provider event ID
+class Webhooks(CollObject):
+    def __init__(self, store):
+        self.store = store
+        self.coll = store.collection("webhooks")
+    def webhook(self, id):
+        return Webhook(self.store, id)
+
+class Webhook(DocObject):
+    def __init__(self, store, id):
+        super().__init__(store)
+        self.id = id
+        self.doc = store.collection("webhooks").document(id)
+
+# Background jobs, filing submissions
+class Jobs(CollObject):
+    def __init__(self, store):
+        self.store = store
+        self.coll = store.collection("jobs")
+    def job(self, id):
+        return Job(self.store, id)
+
+class Job(DocObject):
+    def __init__(self, store, id):
+        super().__init__(store)
+        self.id = id
+        self.doc = store.collection("jobs").document(id)
+
 class State:
     def __init__(self, store):
         self.store = store
@@ -448,3 +681,24 @@ class State:
     def log(self, id):
         return Log(self.store, id)
 
+    def logs(self):
+        return Logs(self.store)
+
+    def referral_offers(self):
+        return ReferralOffers(self.store)
+
+    def referral_offer(self, id):
+        return ReferralOffer(self.store, id)
+
+    def jobs(self):
+        return Jobs(self.store)
+
+    def job(self, id):
+        return Job(self.store, id)
+
+    def webhooks(self):
+        return Webhooks(self.store)
+
+    def webhook(self, id):
+        return Webhook(self.store, id)
+
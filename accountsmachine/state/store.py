@@ -1,13 +1,32 @@
 
 import json
 import logging
+import os
+from urllib.parse import quote
 
 from google.cloud import storage
+from google.api_core.exceptions import NotFound
 from firebase_admin import firestore
 
+from .. metrics import dependency
+from . local import MemoryClient, SqliteClient, Transaction
+
 logger = logging.getLogger("store")
 logger.setLevel(logging.DEBUG)
 
+# Use in place of firestore.async_transactional, so the function runs with
+# the semantics of whichever backend the transaction came from
+def async_transactional(fn):
+
+    remote = firestore.async_transactional(fn)
+
+    async def call(tx, *args, **kwargs):
+        if isinstance(tx, Transaction):
+            return await tx.run(fn, *args, **kwargs)
+        return await remote(tx, *args, **kwargs)
+
+    return call
+
 class DocCollection:
     def __init__(self, db, collection):
         self.db = db
@@ -30,9 +49,35 @@ class DocCollection:
             for doc in docs
         }
 
+# The 'doc-store' config key picks the backend:
+#     "firestore"   the default
+#     "memory"      in-process, gone on restart
+#     "sqlite"      in-process, written through to doc-store-path
 class DocStore:
     def __init__(self, config):
 
+        kind = config.get("doc-store", "firestore")
+        self.local = kind != "firestore"
+
+        # The listener client is made from these when first needed
+        self.project = config.get("project")
+        self.key = config.get("service-account-key")
+        self.watch_db = None
+
+        if kind == "memory":
+            logger.info("Using in-memory document store")
+            self.db = MemoryClient()
+            return
+
+        if kind == "sqlite":
+            path = config.get("doc-store-path", "docs.sqlite")
+            logger.info("Using SQLite document store %s", path)
+            self.db = SqliteClient(path)
+            return
+
+        if kind != "firestore":
+            raise RuntimeError("Unknown doc-store: %s" % kind)
+
         logger.debug("Opening firestore...")
 
         if "service-account-key" in config:
@@ -52,6 +97,24 @@ class DocStore:
     def collection(self, coll):
         return DocCollection(self.db, coll)
 
+    # A client with on_snapshot listeners.  The Firestore async client has
+    # none, so that's a sync client on the same project and credentials,
+    # which calls back on its own thread.
+    def listener(self):
+
+        if self.local:
+            return self.db
+
+        if self.watch_db is None:
+            if self.key:
+                self.watch_db = firestore.Client.from_service_account_json(
+                    self.key, project=self.project,
+                )
+            else:
+                self.watch_db = firestore.Client(project=self.project)
+
+        return self.watch_db
+
     async def get(self, coll, id, tx=None):
         logger.debug("get %s %s" % (coll, id))
         return await self.collection(coll).get(id, tx)
@@ -90,26 +153,97 @@ class BlobStore:
     async def get(self, id):
         logger.debug("get %s" % (id))
         blob = self.bucket.blob(id)
-        return json.loads(blob.download_as_string())
+        with dependency("gcs", "get"):
+            return json.loads(blob.download_as_string())
 
     async def put(self, id, data):
         logger.debug("put %s" % (id))
         blob = self.bucket.blob(id)
         strm = json.dumps(data).encode("utf-8")
-        blob.upload_from_string(strm)
+        with dependency("gcs", "put"):
+            blob.upload_from_string(strm)
 
     async def delete(self, id):
         logger.debug("delete %s" % (id))
         blob = self.bucket.blob(id)
-        blob.delete()
+        with dependency("gcs", "delete"):
+            blob.delete()
+
+# Blobs kept in memory, JSON encoded as they would be in GCS
+class MemoryBlobStore:
+    def __init__(self):
+        logger.info("Using in-memory blob store")
+        self.blobs = {}
+
+    async def get(self, id):
+        if id not in self.blobs:
+            raise NotFound("No such blob: %s" % id)
+        return json.loads(self.blobs[id])
+
+    async def put(self, id, data):
+        self.blobs[id] = json.dumps(data).encode("utf-8")
+
+    async def delete(self, id):
+        if self.blobs.pop(id, None) is None:
+            raise NotFound("No such blob: %s" % id)
+
+# One file per blob in a local directory
+class DirectoryBlobStore:
+    def __init__(self, path):
+        logger.info("Using blob directory %s", path)
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+
+    def file(self, id):
+        # IDs contain user-chosen parts, quoting keeps them in the directory
+        return os.path.join(self.path, quote(id, safe=""))
+
+    async def get(self, id):
+        try:
+            with open(self.file(id), "rb") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            raise NotFound("No such blob: %s" % id)
+
+    async def put(self, id, data):
+        tmp = self.file(id) + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(data).encode("utf-8"))
+        os.replace(tmp, self.file(id))
+
+    async def delete(self, id):
+        try:
+            os.remove(self.file(id))
+        except FileNotFoundError:
+            raise NotFound("No such blob: %s" % id)
 
 class Store:
     def __init__(self, config):
 
         logger.debug("Opening stores...")
         self.docstore = DocStore(config)
-        self.blobstore = BlobStore(config)
+
+        # 'blob-store' is "gcs" (default), "memory" or "directory"
+        kind = config.get("blob-store", "gcs")
+        if kind == "memory":
+            self.blobstore = MemoryBlobStore()
+        elif kind == "directory":
+            self.blobstore = DirectoryBlobStore(
+                config.get("blob-store-path", "blobs")
+            )
+        elif kind == "gcs":
+            self.blobstore = BlobStore(config)
+        else:
+            raise RuntimeError("Unknown blob-store: %s" % kind)
         logger.debug("Opened")
 
+        # Credit balances: "sharded" counters, or an append-only "ledger"
+        # snapshotted every snapshot_interval entries.
+        self.credit_mode = config.get("credit-mode", "sharded")
+        self.snapshot_interval = config.get("credit-snapshot-interval", 20)
+
+        # AuditWriter, set up by the API server
+        self.audit = None
+
     def collection(self, id):
         return self.docstore.db.collection(id)
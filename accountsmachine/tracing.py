@@ -0,0 +1,145 @@
+
+import logging
+import functools
+from contextlib import contextmanager
+
+from aiohttp import web
+
+try:
+    from opentelemetry import trace, propagate
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import (
+        BatchSpanProcessor, SimpleSpanProcessor, ConsoleSpanExporter
+    )
+except ImportError:
+    trace = None
+
+logger = logging.getLogger("tracing")
+logger.setLevel(logging.INFO)
+
+# OpenTelemetry tracing, off unless the 'tracing' config key selects an
+# exporter:
+#
+#     "tracing": "otlp"      OTLP/gRPC to tracing-endpoint, default is the
+#                            standard OTEL_EXPORTER_OTLP_ENDPOINT handling
+#     "tracing": "console"   spans printed to stdout
+#     "tracing": "file"      spans appended to tracing-file as JSON
+#
+# Context lives in contextvars, so tasks started with create_task carry
+# the span they were started under.  Jobs, which can run on another
+# instance, carry it in their record (inject/extract).
+#
+# Without the opentelemetry packages everything here is a no-op.
+
+tracer = None
+
+def setup(config):
+
+    global tracer
+
+    kind = config.get("tracing")
+    if not kind:
+        return
+
+    if trace is None:
+        logger.error("Tracing configured, but opentelemetry not installed")
+        return
+
+    provider = TracerProvider(resource=Resource.create({
+        "service.name": config.get("tracing-service-name", "accounts-svc"),
+    }))
+
+    if kind == "otlp":
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
+            OTLPSpanExporter
+        )
+        if "tracing-endpoint" in config:
+            exporter = OTLPSpanExporter(endpoint=config["tracing-endpoint"])
+        else:
+            exporter = OTLPSpanExporter()
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+    elif kind == "console":
+        provider.add_span_processor(SimpleSpanProcessor(ConsoleSpanExporter()))
+    elif kind == "file":
+        out = open(config.get("tracing-file", "spans.json"), "a")
+        provider.add_span_processor(BatchSpanProcessor(
+            ConsoleSpanExporter(out=out)
+        ))
+    else:
+        raise RuntimeError("Unknown tracing exporter: %s" % kind)
+
+    trace.set_tracer_provider(provider)
+    tracer = trace.get_tracer("accountsmachine")
+
+    logger.info("Tracing to %s", kind)
+
+async def shutdown(app=None):
+    if tracer:
+        trace.get_tracer_provider().shutdown()
+
+@contextmanager
+def span(name, context=None, **attributes):
+
+    if tracer is None:
+        yield None
+        return
+
+    with tracer.start_as_current_span(
+            name, context=context, attributes=attributes
+    ) as s:
+        yield s
+
+# Wraps a coroutine function in a span
+def traced(name):
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def call(*args, **kwargs):
+            with span(name):
+                return await fn(*args, **kwargs)
+        return call
+    return wrap
+
+# Current trace context as a dict, to store with work done elsewhere
+def inject():
+    carrier = {}
+    if tracer:
+        propagate.inject(carrier)
+    return carrier
+
+def extract(carrier):
+    if tracer is None or not carrier:
+        return None
+    return propagate.extract(carrier)
+
+# Server span for each request, continuing a trace from traceparent
+@web.middleware
+async def middleware(request, handler):
+
+    if tracer is None:
+        return await handler(request)
+
+    route = request.match_info.route
+    if route.resource is None:
+        name = "unmatched"
+    else:
+        name = route.resource.canonical
+
+    with tracer.start_as_current_span(
+            request.method + " " + name,
+            context=propagate.extract(request.headers),
+            kind=trace.SpanKind.SERVER,
+            attributes={
+                "http.method": request.method,
+                "http.route": name,
+            },
+    ) as s:
+
+        try:
+            resp = await handler(request)
+        except web.HTTPException as e:
+            s.set_attribute("http.status_code", e.status)
+            raise
+
+        s.set_attribute("http.status_code", resp.status)
+        return resp
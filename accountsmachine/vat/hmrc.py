@@ -10,6 +10,8 @@ logger.setLevel(logging.DEBUG)
 import gnucash_uk_vat.hmrc as hmrc
 import gnucash_uk_vat.auth as auth
 
+from . limiter import READ, SUBMIT
+
 from importlib import metadata
 try:
     version = metadata.version("accounts-svc")
@@ -174,10 +176,17 @@ class AuthEndpoint(auth.Auth):
 
 class Hmrc:
 
-    def __init__(self, config, auth, vrn):
+    def __init__(self, config, auth, vrn, limiter=None):
         self.config = config
         self.auth = auth
         self.vrn = vrn
+        self.limiter = limiter
+
+    # All HMRC traffic goes through the shared rate limiter, if there is one
+    async def call(self, lane, coro_fn):
+        if self.limiter is None:
+            return await coro_fn()
+        return await self.limiter.call(lane, coro_fn)
 
     async def get_vat_client(self):
 
@@ -200,7 +209,7 @@ class Hmrc:
         else:
             old_token = ""
 
-        await auth.maybe_refresh(h)
+        await self.call(READ, lambda: auth.maybe_refresh(h))
 
         if  auth.auth["access_token"] != old_token:
 
@@ -215,7 +224,9 @@ class Hmrc:
     async def get_vat_payments_workaround(self, cli, start, end):
 
         try:
-            return await cli.get_vat_payments(self.vrn, start, end)
+            return await self.call(
+                READ, lambda: cli.get_vat_payments(self.vrn, start, end)
+            )
         except:
             # Works around a broken sandbox
             return []
@@ -223,7 +234,9 @@ class Hmrc:
     async def get_vat_liabilities_workaround(self, cli, start, end):
 
         try:
-            return await cli.get_vat_liabilities(self.vrn, start, end)
+            return await self.call(
+                READ, lambda: cli.get_vat_liabilities(self.vrn, start, end)
+            )
         except:
 
             # Works around a broken sandbox
@@ -233,7 +246,9 @@ class Hmrc:
 
         # Try the normal service
         try:
-            obls = await cli.get_obligations(self.vrn, start, end)
+            obls = await self.call(
+                READ, lambda: cli.get_obligations(self.vrn, start, end)
+            )
 
             obls = [
                 v for v in obls
@@ -252,7 +267,9 @@ class Hmrc:
 
         # But the sandbox is broken?  So get open obligations are report
         # those.
-        obls = await cli.get_open_obligations(self.vrn)
+        obls = await self.call(
+            READ, lambda: cli.get_open_obligations(self.vrn)
+        )
         
         obls = [
             v for v in obls
@@ -278,30 +295,40 @@ class Hmrc:
 
         cli = await self.get_vat_client()
 
-        return await cli.get_vat_liabilities(self.vrn, start, end)
+        return await self.call(
+            READ, lambda: cli.get_vat_liabilities(self.vrn, start, end)
+        )
 
     async def get_obligations(self, start, end):
 
         cli = await self.get_vat_client()
 
-        return await cli.get_obligations(self.vrn, start, end)
+        return await self.call(
+            READ, lambda: cli.get_obligations(self.vrn, start, end)
+        )
 
     async def get_open_obligations(self):
 
         cli = await self.get_vat_client()
 
-        obls = await cli.get_open_obligations(self.vrn)
+        obls = await self.call(
+            READ, lambda: cli.get_open_obligations(self.vrn)
+        )
         return obls
 
     async def get_payments(self, start, end):
 
         cli = await self.get_vat_client()
 
-        return await cli.get_vat_payments(self.vrn, start, end)
+        return await self.call(
+            READ, lambda: cli.get_vat_payments(self.vrn, start, end)
+        )
 
     async def submit_vat_return(self, rtn):
 
         cli = await self.get_vat_client()
 
-        await cli.submit_vat_return(self.vrn, rtn)
+        await self.call(
+            SUBMIT, lambda: cli.submit_vat_return(self.vrn, rtn)
+        )
 
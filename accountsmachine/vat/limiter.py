@@ -0,0 +1,229 @@
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import re
+import time
+
+import aiohttp
+
+from .. metrics import dependency
+
+logger = logging.getLogger("vat.limiter")
+logger.setLevel(logging.DEBUG)
+
+# Priority lanes, lower number is served first.  Submissions beat reads,
+# a deadline-day submission shouldn't queue behind dashboard loads.
+SUBMIT = 0
+READ = 1
+
+lane_names = {
+    SUBMIT: "submit",
+    READ: "read",
+}
+
+# gnucash_uk_vat raises RuntimeError carrying either HMRC's message or
+# "HTTP error NNN", so the HTTP status has to be recovered from the text.
+http_error = re.compile(r"HTTP error (\d+)")
+
+throttle_phrases = [
+    "throttled", "exceeded your quota", "rate limit", "too many requests",
+]
+
+server_phrases = [
+    "internal server error", "service unavailable", "bad gateway",
+    "gateway timeout",
+]
+
+def is_throttled(e):
+
+    if getattr(e, "status", None) == 429:
+        return True
+
+    msg = str(e)
+
+    m = http_error.search(msg)
+    if m and int(m.group(1)) == 429:
+        return True
+
+    msg = msg.lower()
+    return any(p in msg for p in throttle_phrases)
+
+def is_transient(e):
+
+    if is_throttled(e):
+        return True
+
+    if isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+        return True
+
+    status = getattr(e, "status", None)
+    if status and status >= 500:
+        return True
+
+    msg = str(e)
+
+    m = http_error.search(msg)
+    if m and int(m.group(1)) >= 500:
+        return True
+
+    msg = msg.lower()
+    return any(p in msg for p in server_phrases)
+
+class LaneMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "failures": self.failures,
+            "wait-total": self.wait_total,
+            "wait-max": self.wait_max,
+            "wait-mean": (
+                self.wait_total / self.requests if self.requests else 0.0
+            ),
+        }
+
+# Process-wide token bucket for HMRC traffic.  Callers queue in a heap
+# ordered by (lane, arrival) and a single dispatcher task hands out tokens
+# as the bucket refills.
+class RateLimiter:
+
+    def __init__(self, config):
+
+        # HMRC's default application rate limit is 3 requests/second.
+        self.rate = float(config.get("hmrc-rate-limit", 3))
+        self.burst = float(config.get("hmrc-rate-burst", self.rate))
+        self.max_retries = int(config.get("hmrc-max-retries", 4))
+        self.backoff_base = float(config.get("hmrc-backoff-base", 0.5))
+        self.backoff_max = float(config.get("hmrc-backoff-max", 30))
+
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+        self.waiters = []
+        self.seq = itertools.count()
+        self.dispatcher = None
+
+        self.lanes = {
+            lane: LaneMetrics() for lane in lane_names
+        }
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    async def dispatch(self):
+
+        while self.waiters:
+
+            self.refill()
+
+            if self.tokens >= 1:
+                lane, seq, fut = heapq.heappop(self.waiters)
+                if fut.done():
+                    # Caller was cancelled while queued
+                    continue
+                self.tokens -= 1
+                fut.set_result(None)
+                continue
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def acquire(self, lane=READ):
+
+        start = time.monotonic()
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (lane, next(self.seq), fut))
+
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+
+        await fut
+
+        wait = time.monotonic() - start
+
+        m = self.lanes[lane]
+        m.requests += 1
+        m.wait_total += wait
+        m.wait_max = max(m.wait_max, wait)
+
+        if wait > 1:
+            logger.debug("HMRC %s request queued for %.2fs",
+                         lane_names[lane], wait)
+
+    def penalise(self):
+        # HMRC told us to slow down, so everyone waits for the bucket to
+        # refill rather than piling more requests in.
+        self.refill()
+        self.tokens = min(self.tokens, 0)
+
+    def backoff(self, attempt):
+        # Full jitter: uniform over [0, base * 2^attempt], capped.
+        cap = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(0, cap)
+
+    # Runs coro_fn() under the limiter.  coro_fn must build a fresh
+    # coroutine on every call, since failed attempts are re-run.
+    # Submissions are only retried on throttling: a 5xx on a POST may have
+    # been processed, and HMRC is the authority on whether it was.
+    async def call(self, lane, coro_fn):
+
+        m = self.lanes[lane]
+        attempt = 0
+
+        while True:
+
+            await self.acquire(lane)
+
+            try:
+                with dependency("hmrc", lane_names[lane]):
+                    return await coro_fn()
+            except Exception as e:
+
+                throttled = is_throttled(e)
+
+                if throttled:
+                    m.throttled += 1
+                    self.penalise()
+
+                if lane == SUBMIT:
+                    retry = throttled
+                else:
+                    retry = is_transient(e)
+
+                if not retry or attempt >= self.max_retries:
+                    m.failures += 1
+                    raise e
+
+                delay = self.backoff(attempt)
+                attempt += 1
+                m.retries += 1
+
+                logger.info("HMRC %s request failed (%s), retry %d in %.2fs",
+                            lane_names[lane], e, attempt, delay)
+
+                await asyncio.sleep(delay)
+
+    def metrics(self):
+        return {
+            "queued": len(self.waiters),
+            "tokens": self.tokens,
+            "lanes": {
+                lane_names[lane]: m.to_dict()
+                for lane, m in self.lanes.items()
+            }
+        }
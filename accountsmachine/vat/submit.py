@@ -1,15 +1,18 @@
 
-from datetime import datetime, timezone
-from io import StringIO
+from datetime import date, datetime, timezone
 import asyncio
 import uuid
 import json
 import logging
 
-from firebase_admin import firestore
 import gnucash_uk_vat.model as model
 
 from .. ixbrl_process import IxbrlProcess
+from .. jobs.queue import JobFailed
+from .. state.filing_log import FilingLogHandler
+from .. state.store import async_transactional
+from .. tracing import span
+from . limiter import is_transient
 
 from .. audit.audit import Audit
 
@@ -40,31 +43,128 @@ class VatSubmission:
             await self.user.filing(id).status().delete()
         except: pass
 
-    async def set_pending(self, id, cfg):
+        try:
+            await self.user.filing(id).log().delete()
+        except: pass
+
+    async def set_state(self, id, cfg, state, job=None):
 
-        cfg["state"] = "pending"
+        cfg["state"] = state
         await self.user.filing(id).put(cfg)
 
-    async def background_submit(self, id):
+        if job: job.filing_state(state)
 
-        log_stream = StringIO()
-        sthislog = logging.StreamHandler(log_stream)
-        thislog = logging.getLoggerClass()("vat")
-        thislog.addHandler(sthislog)
+    # True if HMRC shows the filing's period as fulfilled, i.e. an earlier
+    # attempt's return was accepted even though it wasn't recorded
+    async def already_filed(self, cfg):
+
+        obls = await self.cli.get_obligations(
+            date.fromisoformat(cfg["start"]), date.fromisoformat(cfg["end"])
+        )
+
+        for o in obls:
+            if str(o.due) == cfg["due"] and o.status == "F":
+                return True
+
+        return False
+
+    # Gives back the credit charged under tid, if it was charged and hasn't
+    # been given back already
+    async def refund(self, tid):
+
+        @async_transactional
+        async def update_order(tx):
+
+            t = self.user.transaction(tid)
+            t.use_transaction(tx)
+
+            try:
+                ordtx = await t.get()
+            except KeyError:
+                return None
+
+            if ordtx.get("status") != "complete":
+                return None
+
+            ordtx["status"] = "cancelled"
+            ordtx["complete"] = False
+            ordtx["order"] = {
+                "items": [
+                    {
+                        "kind": "vat",
+                        "description": "VAT filing, resulted in error",
+                        "quantity": 0,
+                    }
+                ]
+            }
+
+            await self.user.balance().adjust({"vat": 1}, tx)
+            await t.put(ordtx)
+
+            return ordtx
+
+        tx = self.user.create_transaction()
+        ordtx = await update_order(tx)
+
+        if ordtx:
+            rec = Audit.transaction_record(ordtx)
+            await Audit.write(self.user.store, rec, id=tid)
+
+    async def errored(self, id, job=None):
+        cfg = await self.user.filing(id).get()
+        await self.set_state(id, cfg, "errored", job)
+
+    # job is the RunningJob when run from the job queue.  A resumed job
+    # uses the job ID as the billing transaction ID, so a charge made by an
+    # earlier attempt isn't made again.  Transient failures are raised for
+    # the queue to retry, others error the filing, refund the credit and
+    # raise JobFailed.
+    async def background_submit(self, id, job=None):
+
+        if job and job.step == "submitted":
+            # An earlier attempt got as far as HMRC accepting the return
+            logger.info("VAT filing %s already submitted", id)
+            cfg = await self.user.filing(id).get()
+            await self.set_state(id, cfg, "published", job)
+            return
+
+        if job and job.step == "submitting":
+
+            # An earlier attempt stopped while submitting, HMRC may have
+            # the return.  If this check fails, it's retried rather than
+            # risk filing twice or refunding a filing that was made.
+            cfg = await self.user.filing(id).get()
+
+            if await self.already_filed(cfg):
+                logger.info("VAT filing %s was accepted by HMRC", id)
+                await job.progress("submitted")
+                await self.set_state(id, cfg, "published", job)
+                return
 
         await self.clear_filing_history(id)
 
+        # Submission log, written to the filing's log as it goes
+        filing_log = FilingLogHandler(self.user.filing(id))
+        thislog = logging.getLoggerClass()("vat")
+        thislog.addHandler(filing_log)
+        if job: thislog.addHandler(job.log_handler())
+
+        # Set before anything can fail, so a charge made by an earlier
+        # attempt is refunded if this one fails
+        if job:
+            tid = job.id
+        else:
+            tid = None
+
         try:
 
             try:
 
-                tid = None
-
                 logger.debug("Submission of VAT config %s", id)
 
                 cfg = await self.user.filing(id).get()
 
-                await self.set_pending(id, cfg)
+                await self.set_state(id, cfg, "pending", job)
 
                 try:
                     company_number = cfg["company"]
@@ -85,13 +185,16 @@ class VatSubmission:
                         "VAT due date %s not found in obligations" % cfg["due"]
                     )
 
+                if job: await job.progress("rendering")
+
                 # Process VAT data to HTML report and VAT record
                 html = await self.renderer.render(
                     self.user, self.renderer, id, "vat"
                 )
 
-                i = IxbrlProcess()
-                vat = i.process(html)
+                with span("ixbrl.process"):
+                    i = IxbrlProcess()
+                    vat = i.process(html)
 
                 ordtx = {
                     "time": datetime.now(timezone.utc),
@@ -114,28 +217,40 @@ class VatSubmission:
                     }
                 }
 
-                tid = str(uuid.uuid4())
+                if job:
+                    await job.progress("charging")
+                else:
+                    tid = str(uuid.uuid4())
 
-                @firestore.async_transactional
+                @async_transactional
                 async def update_order(tx, ordtx):
 
+                    t = self.user.transaction(tid)
+                    t.use_transaction(tx)
+
+                    # Charged already, by an earlier attempt at this job
+                    try:
+                        prev = await t.get()
+                        if prev.get("status") == "complete":
+                            ordtx["status"] = "complete"
+                            ordtx["complete"] = True
+                            return True, "OK"
+                    except KeyError:
+                        pass
+
                     # Fetches current balance
-                    v = self.user.credits()
-#                    v.use_transaction(tx)
-                    bal = await v.get()
+                    bal = await self.user.balance().get(tx)
 
                     if "vat" not in bal: bal["vat"] = 0
 
                     if bal["vat"] < 1:
                         return False, "No VAT credits available"
 
-                    bal["vat"] -= 1
-
                     ordtx["status"] = "complete"
                     ordtx["complete"] = True
 
-                    await self.user.credits().put(bal)
-                    await self.user.transaction(tid).put(ordtx)
+                    await self.user.balance().adjust({"vat": -1}, tx)
+                    await t.put(ordtx)
 
                     return True, "OK"
 
@@ -145,6 +260,11 @@ class VatSubmission:
                 if not ok:
                     raise RuntimeError(msg)
 
+                try:
+                    await self.user.balance().summarise()
+                except Exception as e:
+                    logger.info("Balance summarise failed: %s", e)
+
                 rec = Audit.transaction_record(ordtx)
                 await Audit.write(self.user.store, rec, id=tid)
 
@@ -171,102 +291,66 @@ class VatSubmission:
                     thislog.info("  %s: %s", k, v)
 
                 thislog.info("Submitting VAT return...")
+                if job: await job.progress("submitting")
 
                 await self.cli.submit_vat_return(rtn)
                 thislog.info("Success.")
 
-                await self.user.filing(id).status().put({
-                    "report": log_stream.getvalue()
-                })
+                if job: await job.progress("submitted")
 
             except Exception as e:
 
-
-                # FIXME!!! Things don't reverse correcrly.
+                # Worth another go.  The filing stays pending, and a charge
+                # already made is reused by the next attempt.
+                if job and not job.final and is_transient(e):
+                    thislog.info("Submission failed, will retry: %s", e)
+                    raise
 
                 # It all went wrong.
                 logger.debug("background_submit: Exception: %s", e)
                 thislog.error("background_submit: Exception: %s", e)
 
-                l = log_stream.getvalue()
-
-                # Put the log in a filing status.
-                await self.user.filing(id).status().put({
-                    "report": l
-                })
-
                 # The filed report is empty.
                 await self.user.filing(id).put_report("".encode("utf-8"))
 
-                # Here we're reversing the charged credit as a transaction.
-
-                @firestore.async_transactional
-                async def update_order(tx, ordtx):
-
-                    # Get current config
-                    filcfg = self.user.filing(id)
-#                    filcfg.use_transaction(tx)
-                    cfg = await filcfg.get()
-
-                    v = self.user.credits()
-#                    v.use_transaction(tx)
-                    bal = await v.get()
-
-                    # Fetches current balance
-
-                    bal["vat"] += 1
-
-
-                    await self.user.credits().put(bal)
-                    await self.user.transaction(tid).put(ordtx)
-
                 if tid:
-
-                    ordtx["status"] = "cancelled"
-                    ordtx["complete"] = False
-                    ordtx["order"] = {
-                        "items": [
-                            {
-                                "kind": "vat",
-                                "description": "VAT filing, resulted in error",
-                                "quantity": 0,
-                            }
-                        ]
-                    }
-
-                    tx = self.user.create_transaction()
-                    await update_order(tx, ordtx)
-
-                    rec = Audit.transaction_record(ordtx)
-                    await Audit.write(self.user.store, rec, id=tid)
+                    await self.refund(tid)
 
                 # Change filing state to errored
-                cfg["state"] = "errored"
-                await self.user.filing(id).put(cfg)
+                await self.errored(id, job)
 
-                return
+                raise JobFailed(str(e))
 
             cfg = await self.user.filing(id).get()
-            cfg["state"] = "published"
-            await self.user.filing(id).put(cfg)
+            await self.set_state(id, cfg, "published", job)
+
+        except JobFailed:
+            # Already in the filing log
+            raise
 
         except Exception as e:
 
             logger.debug("background_submit: Exception: %s", e)
 
-            try:
-                await self.user.filing(id).status().put({
-                    "report": str(e)
-                })
-            except: pass
+            # The status report is built from the filing log, so the error
+            # goes there rather than replacing the report.  A transient
+            # error being retried is already logged.
+            if not (job and not job.final and is_transient(e)):
+                thislog.error("background_submit: Exception: %s", e)
+
+            raise
 
-    async def submit(self, id):
+        finally:
+            await filing_log.close()
+
+    # Queues the submission, returns the job ID
+    async def submit(self, id, jobs, params):
 
         rec = await self.user.filing(id).get()
 
         # Quick credit check before committing to background task
         try:
-            balance = (await self.user.credits().get())["vat"]
+            balance = (await self.user.balance().get())["vat"]
         except Exception as e:
             logger.debug(e)
             balance = 0
@@ -274,7 +358,12 @@ class VatSubmission:
         if balance < 1:
             raise RuntimeError("No VAT credits available")
 
-        asyncio.create_task(
-            self.background_submit(id)
-        )
+        # Obligations due soonest are scheduled first
+        try:
+            due = datetime.fromisoformat(rec["due"])
+            deadline = due.replace(tzinfo=timezone.utc)
+        except Exception:
+            deadline = None
+
+        return await jobs.submit("vat", self.uid, id, params, deadline)
 
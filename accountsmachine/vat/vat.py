@@ -12,8 +12,11 @@ from .. ixbrl_process import IxbrlProcess
 from .. state import State
 from .. state.books import Books
 
+from .. jobs.queue import JobFailed
 from . submit import VatSubmission
 from . hmrc import Hmrc, AuthNotConfigured
+from . limiter import RateLimiter, is_transient
+from .. tracing import span
 
 class AccountsError(Exception):
     def __init__(self, account):
@@ -30,6 +33,9 @@ class Vat:
         self.redirect_uri = config["redirect-uri"]
         self.store = store
 
+        # Shared by every Hmrc client in this process
+        self.limiter = RateLimiter(config)
+
     async def calculate(self, user, renderer, id):
 
         try:
@@ -124,8 +130,9 @@ class Vat:
             html = ""
             logger.error(e)
 
-        i = IxbrlProcess()
-        vat = i.process(html)
+        with span("ixbrl.process"):
+            i = IxbrlProcess()
+            vat = i.process(html)
 
         return vat
 
@@ -133,7 +140,7 @@ class Vat:
         auth = user.company(cid).vat_auth()
         cmp = await user.company(cid).get()
         vrn = cmp["vrn"]
-        return Hmrc(config, auth, vrn)
+        return Hmrc(config, auth, vrn, self.limiter)
 
     async def get_status(self, config, user, cid, start, end):
 
@@ -148,7 +155,7 @@ class Vat:
 
     async def get_liabilities(self, config, user, cid, start, end):
         cli = await self.get_hmrc_client(config, user, cid)
-        l = await cli.get_vat_liabilities(start, end)
+        l = await cli.get_liabilities(start, end)
         return [v.to_dict() for v in l]
 
     async def get_obligations(self, config, user, cid, start, end):
@@ -166,15 +173,54 @@ class Vat:
         l = await cli.get_payments(start, end)
         return [v.to_dict() for v in l]
 
-    async def submit(self, uid, email, config, user, renderer, id):
+    # Queues the submission on the job queue, returns the job ID
+    async def submit(self, uid, email, config, user, renderer, id, jobs):
 
         cfg = await user.filing(id).get()
-        cid = cfg["company"]
 
-        cli = await self.get_hmrc_client(config, user, cid)
+        # Fails here, rather than in the background, if the company isn't
+        # linked to HMRC
+        cli = await self.get_hmrc_client(config, user, cfg["company"])
+        await cli.get_vat_client()
+
+        # Application credentials aren't stored with the job
+        config = {
+            k: v for k, v in config.items()
+            if not k.startswith("application.")
+        }
+
+        vs = VatSubmission(None, uid, email, user, renderer)
+        return await vs.submit(id, jobs, {
+            "email": email,
+            "config": config,
+        })
+
+    # Runs a queued submission
+    async def run_submission(self, user, renderer, job):
+
+        config = dict(job.params["config"])
+        config["application.client-id"] = self.client_id
+        config["application.client-secret"] = self.client_secret
+
+        vs = VatSubmission(None, job.uid, job.params["email"], user, renderer)
+
+        # HMRC auth may have been removed since the job was queued
+        try:
+            cfg = await user.filing(job.filing).get()
+            vs.cli = await self.get_hmrc_client(config, user, cfg["company"])
+            await vs.cli.get_vat_client()
+        except Exception as e:
+            if is_transient(e) and not job.final:
+                raise
+            logger.error("VAT submission %s setup: %s", job.filing, e)
+            try:
+                await vs.errored(job.filing, job)
+            except Exception as f:
+                logger.info("Couldn't set filing state: %s", f)
+            raise JobFailed(str(e))
 
-        vs = VatSubmission(cli, uid, email, user, renderer)
-        await vs.submit(id)
+        with span("vat.submission", filing=job.filing):
+            await vs.background_submit(job.filing, job)
 
     async def get_auth_ref(self, uid, user, cid):
 
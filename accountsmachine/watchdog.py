@@ -0,0 +1,173 @@
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from prometheus_client import Counter, Histogram, Gauge
+
+logger = logging.getLogger("watchdog")
+logger.setLevel(logging.INFO)
+
+loop_lag = Histogram(
+    "am_event_loop_lag_seconds", "Event loop scheduling lag",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+
+loop_lag_max = Gauge(
+    "am_event_loop_lag_max_seconds", "Recent worst event loop lag, decaying"
+)
+
+loop_stalls = Counter(
+    "am_event_loop_stalls_total", "Event loop stalls over the threshold"
+)
+
+# Opt-in ("loop-watchdog": true) detector for code blocking the event loop.
+#
+# A task on the loop wakes every interval and records the lag between when
+# it asked to wake and when it did.  A thread watches for that task going
+# quiet: once the loop hasn't ticked for threshold seconds it samples the
+# loop thread's stack, and again every threshold seconds while the stall
+# lasts, up to max-samples.  The samples are logged together when the loop
+# comes back, so the log shows what was running, not just that something
+# was.
+class LoopWatchdog:
+
+    def __init__(self, config):
+
+        self.enabled = config.get("loop-watchdog", False)
+        self.interval = config.get("loop-watchdog-interval", 0.1)
+        self.threshold = config.get("loop-watchdog-threshold", 0.25)
+        self.max_samples = config.get("loop-watchdog-max-samples", 5)
+
+        self.task = None
+        self.thread = None
+        self.running = False
+
+        self.last_tick = time.monotonic()
+        self.loop_thread = None
+
+        # Written by the watchdog thread, read on the loop
+        self.samples = []
+        self.lock = threading.Lock()
+
+    async def start(self, app=None):
+
+        if not self.enabled:
+            return
+
+        self.loop_thread = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.running = True
+
+        self.task = asyncio.create_task(self.ticker())
+
+        self.thread = threading.Thread(
+            target=self.watch, name="loop-watchdog", daemon=True
+        )
+        self.thread.start()
+
+        logger.info("Loop watchdog running, threshold %.3fs", self.threshold)
+
+    async def stop(self, app=None):
+
+        self.running = False
+
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def ticker(self):
+
+        worst = 0.0
+
+        while True:
+
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+
+            lag = max(0.0, now - start - self.interval)
+            loop_lag.observe(lag)
+
+            worst = max(worst, lag)
+            loop_lag_max.set(worst)
+
+            self.last_tick = now
+
+            with self.lock:
+                samples, self.samples = self.samples, []
+
+            if samples:
+                loop_stalls.inc()
+                self.report(lag, samples)
+
+            # Decay so the gauge tracks recent behaviour
+            worst *= 0.99
+
+    def report(self, lag, samples):
+
+        lines = [
+            "Event loop blocked for %.3fs, %d stack sample(s):" % (
+                lag, len(samples)
+            )
+        ]
+
+        prev = None
+
+        for when, stack in samples:
+            lines.append("--- after %.3fs:" % when)
+            if stack == prev:
+                lines.append("  (same as previous)")
+            else:
+                lines.append(stack.rstrip())
+            prev = stack
+
+        logger.warning("\n".join(lines))
+
+    # Frames below the callback asyncio was running are the same every
+    # time, leave them out
+    def format(self, frame):
+
+        stack = traceback.extract_stack(frame)
+
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i].filename.endswith("asyncio/events.py"):
+                stack = stack[i + 1:]
+                break
+
+        return "".join(traceback.format_list(stack))
+
+    def watch(self):
+
+        last_sample = None
+
+        while self.running:
+
+            time.sleep(self.threshold / 2)
+
+            stalled = time.monotonic() - self.last_tick - self.interval
+
+            if stalled < self.threshold:
+                last_sample = None
+                continue
+
+            if last_sample is not None:
+                if stalled - last_sample < self.threshold:
+                    continue
+
+            with self.lock:
+                if len(self.samples) >= self.max_samples:
+                    continue
+
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+
+            stack = self.format(frame)
+            last_sample = stalled
+
+            with self.lock:
+                self.samples.append((stalled, stack))
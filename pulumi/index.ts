@@ -534,6 +534,49 @@ const availabilitySlo = new gcp.monitoring.Slo(
     }
 );
 
+// Composite indexes for the paged, filtered transaction list.  Firestore
+// merges these for queries combining several equality filters.
+
+for (const field of ["type", "status", "kind"]) {
+
+    new gcp.firestore.Index(
+	"transactions-" + field + "-time-index",
+	{
+	    collection: "transactions",
+	    database: "(default)",
+	    fields: [
+		{ fieldPath: field, order: "ASCENDING" },
+		{ fieldPath: "time", order: "DESCENDING" },
+	    ],
+	},
+	{
+	    provider: provider,
+	}
+    );
+
+}
+
+// Audit log export filters on type and/or uid over a time range
+
+for (const fields of [["type"], ["uid"], ["uid", "type"]]) {
+
+    new gcp.firestore.Index(
+	"log-" + fields.join("-") + "-time-index",
+	{
+	    collection: "log",
+	    database: "(default)",
+	    fields: [
+		...fields.map(f => ({ fieldPath: f, order: "ASCENDING" })),
+		{ fieldPath: "time", order: "ASCENDING" },
+	    ],
+	},
+	{
+	    provider: provider,
+	}
+    );
+
+}
+
 // Stage uses data stored on production, so on prod deploy, need to grant access
 // to stage's user service user.  This assumes that staging is already deployed.
 
@@ -40,9 +40,19 @@ setuptools.setup(
         'piecash',
         'ixbrl-parse',
         'rdflib',
-        'pyOpenSSL'
+        'pyOpenSSL',
+        'prometheus_client',
     ],
+    extras_require={
+        'parquet': ['pyarrow'],
+        'tracing': [
+            'opentelemetry-sdk',
+            'opentelemetry-exporter-otlp-proto-grpc',
+        ],
+    },
     scripts=[
-        "scripts/am-svc"
+        "scripts/am-svc",
+        "scripts/am-audit-export",
+        "scripts/am-bench",
     ]
 )
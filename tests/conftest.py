@@ -0,0 +1,20 @@
+
+import os
+
+import pytest
+
+from accountsmachine.state.store import Store
+
+# A store on each of the local backends
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+
+    if request.param == "memory":
+        return Store({"doc-store": "memory", "blob-store": "memory"})
+
+    return Store({
+        "doc-store": "sqlite",
+        "doc-store-path": os.path.join(tmp_path, "docs.sqlite"),
+        "blob-store": "directory",
+        "blob-store-path": os.path.join(tmp_path, "blobs"),
+    })
@@ -0,0 +1,55 @@
+
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+from accountsmachine.admin.user import RequestAuth
+from accountsmachine.api.audit import AuditApi
+from accountsmachine.api.profile import ProfileApi
+
+# An app with the admin routes, every request authenticated with scope
+def admin_app(scope):
+
+    @web.middleware
+    async def auth(request, handler):
+        request["auth"] = RequestAuth("user1", scope, None)
+        return await handler(request)
+
+    app = web.Application(middlewares=[auth])
+    app.add_routes([
+        web.get("/audit/export", AuditApi({}).export),
+        web.post("/admin/profile", ProfileApi({}).profile),
+    ])
+
+    return app
+
+async def request(scope, method, path):
+    async with TestClient(TestServer(admin_app(scope))) as cli:
+        resp = await cli.request(method, path)
+        return resp.status, await resp.json()
+
+def test_verify_scope():
+
+    auth = RequestAuth("user1", ["user", "filing-config"], None)
+
+    auth.verify_scope("user")
+
+    try:
+        auth.verify_scope("admin")
+    except web.HTTPForbidden:
+        pass
+    else:
+        assert False, "admin scope allowed"
+
+def test_non_admin_forbidden():
+
+    scope = ["user", "filing-config", "books", "company", "vat"]
+
+    for method, path in [
+            ("GET", "/audit/export"),
+            ("POST", "/admin/profile"),
+    ]:
+        status, body = asyncio.run(request(scope, method, path))
+        assert status == 403, path
+        assert body["code"] == "no-permission"
@@ -0,0 +1,132 @@
+
+import asyncio
+
+import pytest
+
+from accountsmachine.state import State
+from accountsmachine.state.balance import SHARDS
+from accountsmachine.state.store import async_transactional
+
+def shards(store, user):
+
+    async def read():
+        out = []
+        for i in range(SHARDS):
+            snap = await user.credit_shard(i).doc.get()
+            if snap.exists:
+                out.append(snap.to_dict())
+        return out
+
+    return read()
+
+def test_no_balance(store):
+
+    user = State(store).user("user1")
+
+    with pytest.raises(KeyError):
+        asyncio.run(user.balance().get())
+
+def test_adjust(store):
+
+    user = State(store).user("user1")
+
+    async def run():
+
+        await user.balance().put({"vat": 2, "corptax": 1})
+
+        await user.balance().adjust({"vat": 3})
+        await user.balance().adjust({"vat": -1, "accounts": 1})
+
+        # Zero deltas don't write
+        await user.balance().adjust({"corptax": 0})
+
+        return await user.balance().get()
+
+    assert asyncio.run(run()) == {"vat": 4, "corptax": 1, "accounts": 1}
+
+def test_adjust_in_transaction(store):
+
+    user = State(store).user("user1")
+
+    @async_transactional
+    async def order(tx, fail):
+
+        t = user.transaction("tx1")
+        t.use_transaction(tx)
+        await t.put({"status": "complete"})
+
+        await user.balance().adjust({"vat": 5}, tx)
+
+        if fail:
+            raise RuntimeError("Failed")
+
+    async def run():
+
+        await user.balance().put({"vat": 0})
+
+        # Nothing is written if the transaction fails
+        with pytest.raises(RuntimeError):
+            await order(user.create_transaction(), True)
+
+        assert (await user.balance().get()) == {"vat": 0}
+
+        await order(user.create_transaction(), False)
+
+        return await user.balance().get()
+
+    assert asyncio.run(run()) == {"vat": 5}
+
+def test_summarise(store):
+
+    user = State(store).user("user1")
+
+    async def run():
+
+        await user.balance().put({"vat": 1})
+
+        for i in range(10):
+            await user.balance().adjust({"vat": 1, "corptax": 2})
+
+        before = await user.balance().get()
+
+        await user.balance().summarise()
+
+        after = await user.balance().get()
+        left = await shards(store, user)
+        folded = (await user.credits().doc.get()).to_dict()
+
+        return before, after, left, folded
+
+    before, after, left, folded = asyncio.run(run())
+
+    assert before == {"vat": 11, "corptax": 20}
+    assert after == before
+    assert left == []
+    assert folded == before
+
+def test_summarise_concurrent(store):
+
+    user = State(store).user("user1")
+
+    async def adjust(n):
+        for i in range(n):
+            await user.balance().adjust({"vat": 1})
+            await asyncio.sleep(0)
+
+    async def summarise(n):
+        for i in range(n):
+            await user.balance().summarise()
+            await asyncio.sleep(0)
+
+    async def run():
+
+        await user.balance().put({"vat": 0})
+
+        await asyncio.gather(adjust(50), adjust(50), summarise(20))
+
+        await user.balance().summarise()
+
+        return await user.balance().get(), await shards(store, user)
+
+    # Increments made during a summarise aren't lost
+    assert asyncio.run(run()) == ({"vat": 100}, [])
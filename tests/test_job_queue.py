@@ -0,0 +1,207 @@
+
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+from accountsmachine.jobs.queue import JobQueue, JobFailed
+
+CONFIG = {"job-lease": 0.3, "job-max-attempts": 2}
+
+def queue(store, handler=None):
+    q = JobQueue(CONFIG, store)
+    if handler:
+        q.register("test", handler)
+    return q
+
+def now():
+    return datetime.now(timezone.utc)
+
+async def expire_lease(q, id):
+    await q.state.job(id).doc.update({"lease": now() - timedelta(seconds=1)})
+
+def test_claim(store):
+
+    async def run():
+
+        a, b = queue(store), queue(store)
+        id = await a.submit("test", "user1", "filing1")
+
+        rec = await a.claim(id)
+        assert rec["attempts"] == 1
+
+        # Held by a, lease still good
+        assert await b.claim(id) is None
+
+        # Lease runs out, b can take it over
+        await expire_lease(a, id)
+        rec = await b.claim(id)
+        assert rec["attempts"] == 2
+
+        rec = await a.get(id)
+        assert rec["state"] == "running"
+        assert rec["owner"] == b.owner
+
+    asyncio.run(run())
+
+def test_claim_waits_for_next_attempt(store):
+
+    async def run():
+
+        q = queue(store)
+        id = await q.submit("test", "user1", "filing1")
+
+        await q.state.job(id).doc.update({
+            "next_attempt": now() + timedelta(seconds=60),
+        })
+        assert await q.claim(id) is None
+
+        # Finished jobs aren't claimed
+        await q.state.job(id).doc.update({"state": "done"})
+        assert await q.claim(id) is None
+
+    asyncio.run(run())
+
+def test_done(store):
+
+    ran = []
+
+    async def handler(state, job):
+        ran.append(job.id)
+        await job.progress("working")
+
+    async def run():
+        q = queue(store, handler)
+        id = await q.submit("test", "user1", "filing1")
+        await q.process(id)
+        return id, await q.get(id)
+
+    id, rec = asyncio.run(run())
+
+    assert ran == [id]
+    assert rec["state"] == "done"
+    assert rec["progress"]["step"] == "working"
+
+def test_retry_then_fail(store):
+
+    async def handler(state, job):
+        raise RuntimeError("Broken")
+
+    async def run():
+
+        q = queue(store, handler)
+        id = await q.submit("test", "user1", "filing1")
+
+        await q.process(id)
+        first = await q.get(id)
+
+        # Retry is after a backoff
+        assert await q.claim(id) is None
+        await q.state.job(id).doc.update({"next_attempt": now()})
+
+        await q.process(id)
+        second = await q.get(id)
+
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert first["state"] == "pending"
+    assert first["attempts"] == 1
+    assert first["error"] == "Broken"
+
+    assert second["state"] == "failed"
+    assert second["attempts"] == 2
+
+def test_job_failed(store):
+
+    async def handler(state, job):
+        raise JobFailed("No good")
+
+    async def run():
+        q = queue(store, handler)
+        id = await q.submit("test", "user1", "filing1")
+        await q.process(id)
+        return await q.get(id)
+
+    rec = asyncio.run(run())
+
+    # Not retried
+    assert rec["state"] == "failed"
+    assert rec["attempts"] == 1
+
+def test_heartbeat_extends_lease(store):
+
+    async def handler(state, job):
+        await asyncio.sleep(1)
+
+    async def run():
+        q = queue(store, handler)
+        id = await q.submit("test", "user1", "filing1")
+        await q.process(id)
+        return await q.get(id)
+
+    # Ran for longer than the lease without losing it
+    rec = asyncio.run(run())
+    assert rec["state"] == "done"
+    assert rec["attempts"] == 1
+
+def test_lease_lost(store):
+
+    started = asyncio.Event()
+    cancelled = []
+
+    async def handler(state, job):
+        started.set()
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(job.id)
+            raise
+
+    async def run():
+
+        a, b = queue(store, handler), queue(store)
+        id = await a.submit("test", "user1", "filing1")
+
+        task = asyncio.create_task(a.process(id))
+        await started.wait()
+
+        # a stalls past its lease, and b takes the job over
+        await expire_lease(a, id)
+        assert await b.claim(id) is not None
+
+        await asyncio.wait_for(task, 2)
+
+        return id, await a.get(id)
+
+    id, rec = asyncio.run(run())
+
+    # a stopped the handler, and left the job as b has it
+    assert cancelled == [id]
+    assert rec["state"] == "running"
+    assert rec["attempts"] == 2
+
+def test_sweep_resumes_expired(store):
+
+    async def run():
+
+        a, b = queue(store), queue(store)
+
+        running = await a.submit("test", "user1", "filing1")
+        expired = await a.submit("test", "user2", "filing2")
+        later = await a.submit("test", "user3", "filing3")
+
+        await a.claim(running)
+        await a.claim(expired)
+        await expire_lease(a, expired)
+
+        await a.state.job(later).doc.update({
+            "next_attempt": now() + timedelta(seconds=60),
+        })
+
+        await b.sweep()
+
+        return b.scheduler.queued, expired
+
+    queued, expired = asyncio.run(run())
+
+    assert queued == set([expired])
@@ -0,0 +1,171 @@
+
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+from google.api_core.exceptions import Aborted
+
+from accountsmachine.state import State
+from accountsmachine.state.store import async_transactional
+
+def test_transaction_retries_on_conflict(store):
+
+    db = store.docstore.db
+    ref = db.collection("counters").document("c1")
+
+    calls = []
+
+    @async_transactional
+    async def incr(tx):
+
+        calls.append(1)
+
+        snap = await ref.get(transaction=tx)
+        n = snap.to_dict()["n"]
+
+        # Someone else writes between the read and the commit, first time
+        if len(calls) == 1:
+            await ref.set({"n": 100})
+
+        tx.update(ref, {"n": n + 1})
+
+    async def run():
+        await ref.set({"n": 0})
+        await incr(db.transaction())
+        return (await ref.get()).to_dict()
+
+    assert asyncio.run(run()) == {"n": 101}
+    assert len(calls) == 2
+
+def test_transaction_gives_up(store):
+
+    db = store.docstore.db
+    ref = db.collection("counters").document("c1")
+    other = db.collection("counters").document("c2")
+
+    @async_transactional
+    async def incr(tx):
+        snap = await ref.get(transaction=tx)
+        await ref.set({"n": snap.to_dict()["n"] + 10})
+        tx.set(other, {"n": 1})
+
+    async def run():
+        await ref.set({"n": 0})
+        with pytest.raises(Aborted):
+            await incr(db.transaction(max_attempts=3))
+        return (await other.get()).exists
+
+    # None of the failed attempts' writes got applied
+    assert asyncio.run(run()) is False
+
+def test_concurrent_transactions(store):
+
+    db = store.docstore.db
+    ref = db.collection("counters").document("c1")
+
+    @async_transactional
+    async def incr(tx):
+        snap = await ref.get(transaction=tx)
+        n = snap.to_dict()["n"]
+        await asyncio.sleep(0)
+        tx.update(ref, {"n": n + 1})
+
+    async def run():
+        await ref.set({"n": 0})
+        await asyncio.gather(*[
+            incr(db.transaction(max_attempts=20)) for i in range(8)
+        ])
+        return (await ref.get()).to_dict()["n"]
+
+    # No increment lost
+    assert asyncio.run(run()) == 8
+
+def add_transactions(user, count):
+
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    async def add():
+        for i in range(count):
+            await user.transaction("tx%02d" % i).put({
+                "type": "order",
+                "status": "complete" if i % 2 else "created",
+                "time": start + timedelta(days=i),
+            })
+
+    return add()
+
+def test_page_cursors(store):
+
+    user = State(store).user("user1")
+
+    async def run():
+
+        await add_transactions(user, 7)
+
+        pages = []
+        cursor = None
+
+        while True:
+            page, cursor = await user.transactions().page(
+                limit=3, cursor=cursor
+            )
+            pages.append(list(page))
+            if cursor is None:
+                break
+
+        return pages
+
+    # Most recent first
+    assert asyncio.run(run()) == [
+        ["tx06", "tx05", "tx04"], ["tx03", "tx02", "tx01"], ["tx00"],
+    ]
+
+def test_page_full_last_page(store):
+
+    user = State(store).user("user1")
+
+    async def run():
+
+        await add_transactions(user, 6)
+
+        page, cursor = await user.transactions().page(limit=3)
+        page, cursor = await user.transactions().page(limit=3, cursor=cursor)
+
+        # A full page gives a cursor, the page after it is empty
+        assert cursor == "tx00"
+
+        return await user.transactions().page(limit=3, cursor=cursor)
+
+    assert asyncio.run(run()) == ({}, None)
+
+def test_page_filters(store):
+
+    user = State(store).user("user1")
+
+    async def run():
+
+        await add_transactions(user, 7)
+
+        page, cursor = await user.transactions().page(
+            limit=2, status="complete"
+        )
+        first = list(page)
+
+        page, cursor = await user.transactions().page(
+            limit=2, status="complete", cursor=cursor
+        )
+
+        return first, list(page), cursor
+
+    assert asyncio.run(run()) == (["tx05", "tx03"], ["tx01"], None)
+
+def test_page_bad_cursor(store):
+
+    user = State(store).user("user1")
+
+    async def run():
+        await add_transactions(user, 2)
+        await user.transactions().page(limit=1, cursor="nonesuch")
+
+    with pytest.raises(KeyError):
+        asyncio.run(run())